@@ -0,0 +1,170 @@
+# bench_chat_latency.py
+# Chat latency while a large file is being relayed
+# Usage: python3 bench/bench_chat_latency.py [--engine threaded|asyncio] [--size-mb 512] [--json]
+#
+# Starts a server in a temp directory, then one client uploads a file as fast
+# as it can while another sends a chat message every 10 ms. Two receivers
+# time each message from send to arrival: one joined with the 'chunks'
+# feature (file arrives as interleaved file_chunk frames) and one without it
+# (file arrives as a single 'file' frame that holds the connection).
+# The server gets a large --queue-size so the legacy receiver is not
+# disconnected while messages pile up behind its file frame.
+
+import argparse
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def send_frame(sock, header, payload=b''):
+    hb = json.dumps(header).encode('utf-8')
+    sock.sendall(struct.pack('>I', len(hb)) + hb + payload)
+
+def recv_exact(sock, n) -> bytes:
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError('closed')
+        data += chunk
+    return bytes(data)
+
+def discard(sock, n, buf):
+    """Read and drop an n-byte payload; only its length matters here."""
+    view = memoryview(buf)
+    while n:
+        r = sock.recv_into(view, min(n, len(buf)))
+        if not r:
+            raise ConnectionError('closed')
+        n -= r
+
+def join(port, name, features):
+    s = socket.create_connection(('127.0.0.1', port))
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    send_frame(s, {'type': 'join', 'username': name, 'features': features})
+    return s
+
+def receive(sock, latencies, t0, done):
+    """Read every frame; record (arrival - sent) for bench messages."""
+    buf = bytearray(1 << 20)
+    try:
+        while not done.is_set():
+            n = struct.unpack('>I', recv_exact(sock, 4))[0]
+            header = json.loads(recv_exact(sock, n))
+            typ = header.get('type')
+            if typ == 'message' and header.get('text', '').startswith('t='):
+                sent = float(header['text'][2:])
+                latencies.append(time.perf_counter() - t0 - sent)
+            elif typ == 'file':
+                discard(sock, int(header['filesize']), buf)
+            elif typ in ('file_chunk', 'fetch_chunk'):
+                discard(sock, int(header['size']), buf)
+    except (ConnectionError, OSError):
+        pass
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+def main():
+    parser = argparse.ArgumentParser(description='chat latency during a file relay')
+    parser.add_argument('--engine', choices=['threaded', 'asyncio'], default='threaded')
+    parser.add_argument('--size-mb', type=int, default=512)
+    parser.add_argument('--interval-ms', type=float, default=10)
+    parser.add_argument('--json', action='store_true', help='machine-readable output')
+    args = parser.parse_args()
+    size = args.size_mb * 1024 * 1024
+
+    with tempfile.TemporaryDirectory() as tmp:
+        port = free_port()
+        code = (f"import sys, server_tcp; server_tcp.PORT = {port}; "
+                f"sys.argv = ['server_tcp.py', '--engine', '{args.engine}', '--queue-size', '100000']; "
+                f"server_tcp.main()")
+        server = subprocess.Popen([sys.executable, '-c', code], cwd=tmp, stdout=subprocess.DEVNULL,
+                                  env=dict(os.environ, PYTHONPATH=str(REPO)))
+        try:
+            for _ in range(100):
+                try:
+                    socket.create_connection(('127.0.0.1', port)).close()
+                    break
+                except OSError:
+                    time.sleep(0.05)
+
+            t0 = time.perf_counter()
+            done = threading.Event()
+            results = {}
+            readers = []
+            for name, features in (('chunks', ['chunks']), ('legacy', [])):
+                results[name] = []
+                s = join(port, 'recv_' + name, features)
+                th = threading.Thread(target=receive, args=(s, results[name], t0, done), daemon=True)
+                th.start()
+                readers.append(s)
+            # both read (and drop) whatever they are sent, like real clients
+            chatter = join(port, 'chatter', ['chunks'])
+            uploader = join(port, 'uploader', ['chunks'])
+            for s in (chatter, uploader):
+                threading.Thread(target=receive, args=(s, [], t0, done), daemon=True).start()
+            time.sleep(0.3)
+
+            def upload():
+                send_frame(uploader, {'type': 'file', 'filename': 'bench.bin', 'filesize': size})
+                block = os.urandom(1 << 20)
+                for _ in range(args.size_mb):
+                    uploader.sendall(block)
+            up = threading.Thread(target=upload, daemon=True)
+            start = time.perf_counter()
+            up.start()
+            sent = 0
+            while up.is_alive():
+                send_frame(chatter, {'type': 'message', 'text': f't={time.perf_counter() - t0:.6f}'})
+                sent += 1
+                time.sleep(args.interval_ms / 1000)
+            upload_s = time.perf_counter() - start
+            # messages queued behind a 'file' frame only arrive once the relay is done
+            deadline = time.perf_counter() + 30
+            while any(len(lat) < sent for lat in results.values()) and time.perf_counter() < deadline:
+                time.sleep(0.1)
+            done.set()
+            for s in readers + [chatter, uploader]:
+                s.close()
+        finally:
+            server.terminate()
+            server.wait()
+
+    report = {'engine': args.engine, 'size_mb': args.size_mb, 'upload_s': upload_s, 'receivers': {}}
+    for name, lat in results.items():
+        report['receivers'][name] = {
+            'messages': len(lat),
+            'p50_ms': percentile(lat, 50) and percentile(lat, 50) * 1000,
+            'p99_ms': percentile(lat, 99) and percentile(lat, 99) * 1000,
+            'max_ms': max(lat) * 1000 if lat else None,
+        }
+    if args.json:
+        print(json.dumps(report))
+        return
+    print(f"{args.engine}: {args.size_mb} MB upload in {upload_s:.2f} s, a message every {args.interval_ms:g} ms")
+    for name, r in report['receivers'].items():
+        if not r['messages']:
+            print(f"  {name:7s} no messages received")
+            continue
+        print(f"  {name:7s} {r['messages']:5d} msgs   p50 {r['p50_ms']:7.1f} ms   p99 {r['p99_ms']:7.1f} ms"
+              f"   max {r['max_ms']:7.1f} ms")
+
+if __name__ == '__main__':
+    main()
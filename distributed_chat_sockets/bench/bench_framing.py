@@ -0,0 +1,124 @@
+# bench_framing.py
+# Frame codec throughput over loopback TCP
+# Usage: python3 bench/bench_framing.py [--frames 200000] [--payload-kb 64] [--json]
+#
+# Compares the old per-module helpers (recvall() growing a bytearray per
+# frame, one sendall() for the length and header and another for the payload)
+# with framing.py (buffered FrameReader, one send call per frame), with JSON
+# and with compact headers. Two workloads: small chat frames (header only) and
+# header + payload frames like file_chunk.
+
+import argparse
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from framing import FrameReader, send_frame
+
+# --- the helpers framing.py replaced ------------------------------------------
+
+def legacy_recvall(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        packet = sock.recv(n - len(data))
+        if not packet:
+            return None
+        data.extend(packet)
+    return bytes(data)
+
+def legacy_send(sock, header, payload=None):
+    header_bytes = json.dumps(header).encode('utf-8')
+    sock.sendall(struct.pack('>I', len(header_bytes)) + header_bytes)
+    if payload:
+        sock.sendall(payload)
+
+def legacy_read(sock, count):
+    for _ in range(count):
+        raw = legacy_recvall(sock, 4)
+        header = json.loads(legacy_recvall(sock, struct.unpack('>I', raw)[0]).decode())
+        size = int(header.get('size', 0))
+        if size:
+            legacy_recvall(sock, size)
+
+# --- framing.py -----------------------------------------------------------------
+
+def framing_read(sock, count):
+    reader = FrameReader(sock)
+    for _ in range(count):
+        header = reader.read_header()
+        size = int(header.get('size', 0))
+        if size:
+            reader.read_exact(size)
+
+def compact_send(sock, header, payload=None):
+    send_frame(sock, header, payload, compact=True)
+
+CODECS = {
+    'legacy': (legacy_send, legacy_read),
+    'framing': (send_frame, framing_read),
+    'compact': (compact_send, framing_read),
+}
+
+def socket_pair():
+    with socket.socket() as srv:
+        srv.bind(('127.0.0.1', 0))
+        srv.listen(1)
+        a = socket.create_connection(srv.getsockname())
+        b, _ = srv.accept()
+    for s in (a, b):
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return a, b
+
+def run(codec, count, payload):
+    """Send count frames one way; returns frames/sec measured at the receiver."""
+    send, read = CODECS[codec]
+    a, b = socket_pair()
+    header = {'type': 'file_chunk', 'id': '1', 'offset': 0, 'size': len(payload)} if payload \
+        else {'type': 'message', 'username': 'alice', 'text': 'hello there, how is it going?'}
+
+    def sender():
+        for _ in range(count):
+            send(a, header, payload or None)
+
+    th = threading.Thread(target=sender, daemon=True)
+    start = time.perf_counter()
+    th.start()
+    read(b, count)
+    elapsed = time.perf_counter() - start
+    th.join()
+    a.close()
+    b.close()
+    return count / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='frame codec throughput')
+    parser.add_argument('--frames', type=int, default=200000, help='chat frames per run')
+    parser.add_argument('--payload-kb', type=int, default=64, help='payload size of the chunk workload')
+    parser.add_argument('--json', action='store_true', help='machine-readable output')
+    args = parser.parse_args()
+    payload = os.urandom(args.payload_kb * 1024)
+    workloads = {
+        'chat': (args.frames, b''),
+        'chunk': (max(1, args.frames // 20), payload),
+    }
+
+    report = {}
+    for name, (count, data) in workloads.items():
+        report[name] = {codec: run(codec, count, data) for codec in CODECS}
+    if args.json:
+        print(json.dumps(report))
+        return
+    for name, rates in report.items():
+        line = '   '.join(f"{codec} {rate:9.0f}/s (x{rate / rates['legacy']:.2f})"
+                          for codec, rate in rates.items())
+        print(f"{name:6s} {line}")
+
+if __name__ == '__main__':
+    main()
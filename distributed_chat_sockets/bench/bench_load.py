@@ -0,0 +1,485 @@
+# bench_load.py
+# Load generator for the chat server: many clients, several traffic mixes
+# Usage: python3 bench/bench_load.py [--scenario chat|mixed|slow|churn|all] [--clients 50]
+#            [--duration 10] [--rate 500] [--engine threaded|asyncio] [--workers N] [--procs P]
+#            [--json] [--out results.jsonl]
+#        python3 bench/bench_load.py --compare old.jsonl new.jsonl
+#
+# Starts a server in a temp directory (or --server-cmd, any command that
+# serves the protocol on {port}), then connects --clients clients from
+# --procs load processes. Senders post messages carrying their send time;
+# every receiver records send-to-arrival time, so latency is fan-out
+# latency, end to end. Scenarios:
+#   chat   every client sends its share of --rate messages/s to the lobby
+#   mixed  chat, plus --uploaders clients uploading --file-mb files back to back
+#   slow   chat, plus --slow clients that read only ~40 KB/s (see --queue-policy)
+#   churn  chat, plus --churn clients/s connecting, staying a second and quitting
+# The server's RSS (peak) and CPU time are read from /proc (Linux), summed
+# over its worker processes. Each result is one JSON object; --out appends
+# them to a file, and --compare prints two such files side by side.
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import selectors
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+
+from framing import COMPACT, HDR, decode_header, send_frame
+
+FEATURES = ['chunks', COMPACT]
+SLOW_READ = 4096            # bytes a slow client reads per SLOW_EVERY seconds
+SLOW_EVERY = 0.1
+CHURN_STAY = 1.0            # seconds a churn client stays connected
+SAMPLE_MAX = 200_000        # latencies sent back per load process, at most
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def percentile(values, p):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+class Conn:
+    """A client connection read through the selector; frames are parsed from a buffer."""
+
+    def __init__(self, sock: socket.socket, role: str):
+        self.sock = sock
+        self.role = role
+        self.buf = bytearray()
+        self.skip = 0           # payload bytes still to drop
+        self.opened = time.monotonic()
+        self.joined = None      # time of the "session" reply (churn clients)
+
+    def frames(self, data: bytes, stats: dict):
+        """Headers of the whole frames in data (payloads are counted and dropped)."""
+        self.buf += data
+        pos = 0
+        while True:
+            if self.skip:
+                n = min(self.skip, len(self.buf) - pos)
+                self.skip -= n
+                pos += n
+                stats['file_bytes'] += n
+                if self.skip:
+                    break
+            if len(self.buf) - pos < HDR.size:
+                break
+            (n,) = HDR.unpack_from(self.buf, pos)
+            if len(self.buf) - pos - HDR.size < n:
+                break
+            header = decode_header(bytes(self.buf[pos + HDR.size:pos + HDR.size + n]))
+            pos += HDR.size + n
+            typ = header.get('type')
+            if typ == 'file':
+                self.skip = int(header.get('filesize', 0))
+            elif typ in ('file_chunk', 'fetch_chunk'):
+                self.skip = int(header.get('size', 0))
+            yield header
+        del self.buf[:pos]
+
+def connect(port: int, name: str, features) -> socket.socket:
+    s = socket.create_connection(('127.0.0.1', port))
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    send_frame(s, {'type': 'join', 'username': name, 'features': features})
+    return s
+
+def upload_loop(port: int, name: str, file_mb: float, end: float, stats: dict):
+    """Upload files back to back (one "file" frame each) until end."""
+    size = int(file_mb * 1024 * 1024)
+    block = os.urandom(min(size, 1 << 20))
+    try:
+        s = connect(port, name, FEATURES)
+        # its own copy of everyone's traffic is not read; keep the server from blocking on it
+        threading.Thread(target=lambda: [None for _ in iter(lambda: s.recv(1 << 20), b'')], daemon=True).start()
+        while time.monotonic() < end:
+            send_frame(s, {'type': 'file', 'filename': f'{name}.bin', 'filesize': size})
+            left = size
+            while left:
+                s.sendall(block[:min(left, len(block))])
+                left -= min(left, len(block))
+            stats['uploaded'] += size
+    except OSError:
+        stats['upload_errors'] += 1
+
+def load(index: int, port: int, args, start: float, results):
+    """One load process: its share of the clients, senders and extras; puts its stats on results."""
+    random.seed(index)
+    clients = [c for c in range(args.clients) if c % args.procs == index]
+    sel = selectors.DefaultSelector()
+    stats = {'sent': 0, 'deliveries': 0, 'file_bytes': 0, 'uploaded': 0, 'upload_errors': 0,
+             'disconnects': 0, 'slow_disconnects': 0, 'churned': 0}
+    latencies, join_times = [], []
+    conns = []
+    for c in clients:
+        conn = Conn(connect(port, f'load{c}', FEATURES), 'chat')
+        sel.register(conn.sock, selectors.EVENT_READ, conn)
+        conns.append(conn)
+    slow = []
+    if args.scenario == 'slow':
+        for c in range(index, args.slow, args.procs):
+            s = connect(port, f'slow{c}', FEATURES)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16384)
+            slow.append(Conn(s, 'slow'))
+    # the measured interval starts together in every process
+    time.sleep(max(0, start - time.monotonic()))
+    end = start + args.duration
+    uploaders = []
+    if args.scenario == 'mixed':
+        for u in range(index, args.uploaders, args.procs):
+            th = threading.Thread(target=upload_loop, args=(port, f'up{u}', args.file_mb, end, stats),
+                                  daemon=True)
+            th.start()
+            uploaders.append(th)
+
+    per_sender = args.rate / max(1, args.clients)
+    interval = 1 / per_sender if per_sender > 0 else 0
+    next_send = {id(c): start + random.random() * (interval or 0) for c in conns}
+    pad = 'x' * max(0, args.msg_bytes - 20)
+    churn_every = args.procs / args.churn if args.scenario == 'churn' and args.churn > 0 else None
+    next_churn = start
+    churn_n = 0
+    next_slow = start
+
+    def closed(conn):
+        try:
+            sel.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+        if conn in conns:
+            conns.remove(conn)
+            stats['disconnects'] += 1
+
+    def handle(conn, data, now):
+        for header in conn.frames(data, stats):
+            typ = header.get('type')
+            if typ == 'message':
+                text = header.get('text', '')
+                if text.startswith('t='):
+                    latencies.append(now - float(text[2:].split(' ', 1)[0]))
+                    stats['deliveries'] += 1
+            elif typ == 'session' and conn.role == 'churn':
+                conn.joined = now
+                join_times.append(now - conn.opened)
+
+    while True:
+        now = time.monotonic()
+        if now >= end:
+            break
+        # senders due now
+        if interval:
+            for conn in list(conns):
+                if next_send[id(conn)] <= now:
+                    next_send[id(conn)] += interval
+                    try:
+                        send_frame(conn.sock, {'type': 'message', 'text': f't={time.monotonic():.6f} {pad}'},
+                                   compact=True)
+                        stats['sent'] += 1
+                    except OSError:
+                        closed(conn)
+        elif conns:
+            # flat out: one message per client per loop
+            for conn in list(conns):
+                try:
+                    send_frame(conn.sock, {'type': 'message', 'text': f't={time.monotonic():.6f} {pad}'},
+                               compact=True)
+                    stats['sent'] += 1
+                except OSError:
+                    closed(conn)
+        if churn_every and now >= next_churn:
+            next_churn += churn_every
+            try:
+                conn = Conn(connect(port, f'churn{index}-{churn_n}', ['resume']), 'churn')
+                sel.register(conn.sock, selectors.EVENT_READ, conn)
+                churn_n += 1
+            except OSError:
+                stats['disconnects'] += 1
+        if slow and now >= next_slow:
+            next_slow += SLOW_EVERY
+            for conn in list(slow):
+                conn.sock.setblocking(False)
+                try:
+                    data = conn.sock.recv(SLOW_READ)
+                except BlockingIOError:
+                    data = None
+                except OSError:
+                    data = b''
+                conn.sock.setblocking(True)
+                if data == b'':
+                    slow.remove(conn)
+                    conn.sock.close()
+                    stats['slow_disconnects'] += 1
+                elif data:
+                    list(conn.frames(data, {'file_bytes': 0}))
+        wait = min([t for t in next_send.values()] + [end], default=end) - time.monotonic() if interval else 0
+        for key, _ in sel.select(max(0, min(wait, 0.05))):
+            conn = key.data
+            try:
+                data = conn.sock.recv(1 << 18)
+            except OSError:
+                data = b''
+            if not data:
+                if conn.role == 'churn':
+                    sel.unregister(conn.sock)
+                    conn.sock.close()
+                else:
+                    closed(conn)
+                continue
+            handle(conn, data, time.monotonic())
+        # churn clients leave after their stay
+        for key in list(sel.get_map().values()):
+            conn = key.data
+            if conn.role == 'churn' and conn.joined and now - conn.joined >= CHURN_STAY:
+                try:
+                    send_frame(conn.sock, {'type': 'quit'})
+                except OSError:
+                    pass
+                sel.unregister(conn.sock)
+                conn.sock.close()
+                stats['churned'] += 1
+
+    for th in uploaders:
+        th.join(5)
+    for key in list(sel.get_map().values()):
+        key.data.sock.close()
+    for conn in slow:
+        conn.sock.close()
+    if len(latencies) > SAMPLE_MAX:
+        latencies = random.sample(latencies, SAMPLE_MAX)
+    results.put((stats, latencies, join_times))
+
+def process_tree(pid: int):
+    """pid and its descendants (the --workers children), from /proc."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    tree, todo = [], [pid]
+    while todo:
+        p = todo.pop()
+        tree.append(p)
+        todo.extend(children.get(p, []))
+    return tree
+
+def proc_usage(pids):
+    """(RSS bytes, CPU seconds) summed over pids; None where /proc cannot tell."""
+    rss, cpu = 0, 0.0
+    tick = os.sysconf('SC_CLK_TCK')
+    page = os.sysconf('SC_PAGE_SIZE')
+    for p in pids:
+        try:
+            with open(f'/proc/{p}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            with open(f'/proc/{p}/statm') as f:
+                rss += int(f.read().split()[1]) * page
+            cpu += (int(fields[11]) + int(fields[12])) / tick
+        except (OSError, IndexError, ValueError):
+            continue
+    return rss, cpu
+
+class Sampler(threading.Thread):
+    """Peak RSS and CPU time of the server (and its workers) while the load runs."""
+
+    def __init__(self, pid: int):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.stop = threading.Event()
+        self.peak_rss = 0
+        self.cpu = {}           # pid -> latest CPU seconds
+        self.ok = os.path.exists(f'/proc/{pid}/stat')
+
+    def sample(self):
+        total = 0
+        for p in process_tree(self.pid):
+            rss, cpu = proc_usage([p])
+            self.cpu[p] = cpu       # kept after a process exits, so its CPU time still counts
+            total += rss
+        self.peak_rss = max(self.peak_rss, total)
+
+    def run(self):
+        while self.ok and not self.stop.wait(0.25):
+            self.sample()
+
+    def cpu_seconds(self) -> float:
+        return sum(self.cpu.values())
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def start_server(args, port: int, tmp: str) -> subprocess.Popen:
+    if args.server_cmd:
+        cmd = args.server_cmd.format(port=port, dir=tmp)
+        server = subprocess.Popen(cmd, shell=True, cwd=tmp, stdout=subprocess.DEVNULL)
+    else:
+        argv = ['server_tcp.py', '--engine', args.engine, '--port', str(port),
+                '--upload-dir', os.path.join(tmp, 'uploads'), '--workers', str(args.workers)] + args.server_arg
+        code = f"import sys, server_tcp; sys.argv = {argv!r}; server_tcp.main()"
+        server = subprocess.Popen([sys.executable, '-c', code], cwd=tmp, stdout=subprocess.DEVNULL,
+                                  env=dict(os.environ, PYTHONPATH=str(REPO)))
+    for _ in range(200):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.terminate()
+    raise SystemExit('server did not start')
+
+def run_scenario(args, scenario: str) -> dict:
+    args.scenario = scenario
+    with tempfile.TemporaryDirectory() as tmp:
+        port = free_port()
+        server = start_server(args, port, tmp)
+        sampler = Sampler(server.pid)
+        try:
+            results = multiprocessing.Queue()
+            start = time.monotonic() + 1.0 + args.clients / 500
+            procs = [multiprocessing.Process(target=load, args=(i, port, args, start, results))
+                     for i in range(args.procs)]
+            for p in procs:
+                p.start()
+            time.sleep(max(0, start - time.monotonic()))
+            sampler.sample()
+            cpu0 = sampler.cpu_seconds()
+            sampler.start()
+            gathered = [results.get(timeout=args.duration + 60) for _ in procs]
+            for p in procs:
+                p.join()
+            sampler.stop.set()
+            sampler.join()
+            if sampler.ok:
+                sampler.sample()
+            cpu = sampler.cpu_seconds() - cpu0
+        finally:
+            server.terminate()
+            server.wait()
+
+    stats = {k: sum(g[0][k] for g in gathered) for k in gathered[0][0]}
+    latencies = sorted(x for g in gathered for x in g[1])
+    joins = sorted(x for g in gathered for x in g[2])
+    ms = lambda v: v and round(v * 1000, 3)
+    d = args.duration
+    return {
+        'scenario': scenario, 'engine': args.engine if not args.server_cmd else args.server_cmd,
+        'workers': args.workers, 'clients': args.clients, 'duration_s': d, 'rate': args.rate,
+        'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'messages_sent': stats['sent'], 'msgs_per_s': round(stats['sent'] / d, 1),
+        'deliveries': stats['deliveries'], 'deliveries_per_s': round(stats['deliveries'] / d, 1),
+        'latency_ms': {'p50': ms(percentile(latencies, 50)), 'p99': ms(percentile(latencies, 99)),
+                       'p999': ms(percentile(latencies, 99.9)), 'max': ms(latencies[-1] if latencies else None)},
+        'file_mb_s': {'uploaded': round(stats['uploaded'] / d / 2**20, 2),
+                      'delivered': round(stats['file_bytes'] / d / 2**20, 2)},
+        'join_ms': {'p50': ms(percentile(joins, 50)), 'p99': ms(percentile(joins, 99))} if joins else None,
+        'disconnects': stats['disconnects'], 'slow_disconnects': stats['slow_disconnects'],
+        'churned': stats['churned'],
+        'server': {'rss_mb_peak': round(sampler.peak_rss / 2**20, 1) if sampler.ok else None,
+                   'cpu_s': round(cpu, 2) if sampler.ok else None,
+                   'cpu_pct': round(100 * cpu / d, 1) if sampler.ok else None},
+    }
+
+def print_report(r: dict):
+    lat, f, srv = r['latency_ms'], r['file_mb_s'], r['server']
+    print(f"{r['scenario']:6s} {r['engine']} x{r['workers']}, {r['clients']} clients, {r['duration_s']:g} s"
+          f" ({r['commit'] or 'no commit'})")
+    print(f"  {r['msgs_per_s']:9.1f} msgs/s sent   {r['deliveries_per_s']:10.1f} deliveries/s")
+    if lat['p50'] is not None:
+        print(f"  latency p50 {lat['p50']:8.2f} ms   p99 {lat['p99']:8.2f} ms   p999 {lat['p999']:8.2f} ms"
+              f"   max {lat['max']:8.2f} ms")
+    if f['uploaded'] or f['delivered']:
+        print(f"  files {f['uploaded']:8.2f} MB/s uploaded   {f['delivered']:8.2f} MB/s delivered")
+    if r['join_ms']:
+        print(f"  join p50 {r['join_ms']['p50']:.2f} ms   p99 {r['join_ms']['p99']:.2f} ms"
+              f"   ({r['churned']} churned)")
+    if r['disconnects'] or r['slow_disconnects']:
+        print(f"  disconnected: {r['disconnects']} clients, {r['slow_disconnects']} slow clients")
+    if srv['cpu_s'] is not None:
+        print(f"  server RSS peak {srv['rss_mb_peak']:.1f} MB   CPU {srv['cpu_s']:.2f} s ({srv['cpu_pct']:.0f}%)")
+
+METRICS = [('msgs/s', lambda r: r['msgs_per_s']), ('deliveries/s', lambda r: r['deliveries_per_s']),
+           ('p50 ms', lambda r: r['latency_ms']['p50']), ('p99 ms', lambda r: r['latency_ms']['p99']),
+           ('p999 ms', lambda r: r['latency_ms']['p999']), ('file MB/s', lambda r: r['file_mb_s']['delivered']),
+           ('RSS MB', lambda r: r['server']['rss_mb_peak']), ('CPU s', lambda r: r['server']['cpu_s'])]
+
+def compare(old_path: str, new_path: str):
+    """The last result per scenario and engine in each file, side by side."""
+    def last(path):
+        out = {}
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    r = json.loads(line)
+                    out[(r['scenario'], r['engine'], r['workers'])] = r
+        return out
+    old, new = last(old_path), last(new_path)
+    for key in sorted(old.keys() & new.keys(), key=str):
+        a, b = old[key], new[key]
+        print(f"{key[0]} {key[1]} x{key[2]}: {a['commit']} -> {b['commit']}")
+        for name, get in METRICS:
+            x, y = get(a), get(b)
+            if x is None or y is None:
+                continue
+            change = f"{(y - x) / x * 100:+7.1f}%" if x else ''
+            print(f"  {name:13s} {x:12.2f} {y:12.2f} {change}")
+
+def main():
+    parser = argparse.ArgumentParser(description='chat server load generator')
+    parser.add_argument('--scenario', choices=['chat', 'mixed', 'slow', 'churn', 'all'], default='chat')
+    parser.add_argument('--clients', type=int, default=50, help='chat clients (each sends and receives)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds measured per scenario')
+    parser.add_argument('--rate', type=float, default=500,
+                        help='messages/s sent by all clients together (0: as fast as they can)')
+    parser.add_argument('--msg-bytes', type=int, default=64, help='length of each message text')
+    parser.add_argument('--uploaders', type=int, default=2, help='mixed: clients uploading files')
+    parser.add_argument('--file-mb', type=float, default=8, help='mixed: size of each uploaded file')
+    parser.add_argument('--slow', type=int, default=5, help='slow: clients that barely read')
+    parser.add_argument('--churn', type=float, default=20, help='churn: new clients per second')
+    parser.add_argument('--procs', type=int, default=1, help='load generator processes')
+    parser.add_argument('--engine', choices=['threaded', 'asyncio'], default='threaded')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--server-arg', action='append', default=[], metavar='ARG',
+                        help='extra server_tcp.py argument (repeatable), e.g. --server-arg=--no-history')
+    parser.add_argument('--server-cmd', help='start this instead of server_tcp.py; {port} and {dir} are filled in')
+    parser.add_argument('--json', action='store_true', help='machine-readable output')
+    parser.add_argument('--out', help='append each result as a JSON line to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two --out files')
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    args.procs = max(1, min(args.procs, args.clients))
+    scenarios = ['chat', 'mixed', 'slow', 'churn'] if args.scenario == 'all' else [args.scenario]
+    for scenario in scenarios:
+        report = run_scenario(args, scenario)
+        if args.out:
+            with open(args.out, 'a') as f:
+                f.write(json.dumps(report) + '\n')
+        if args.json:
+            print(json.dumps(report))
+        else:
+            print_report(report)
+
+if __name__ == '__main__':
+    main()
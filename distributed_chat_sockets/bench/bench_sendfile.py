@@ -0,0 +1,99 @@
+# bench_sendfile.py
+# CPU cost of fanning a stored upload out to many receivers:
+# zero-copy sendfile() vs the read()+send() fallback in relay.py
+# Usage: python3 bench/bench_sendfile.py [--size-mb 256] [--receivers 50] [--json]
+#
+# Receivers run in a child process that just drains its sockets, so the CPU
+# time measured here is the server side of the fan-out only.
+
+import argparse
+import json
+import multiprocessing
+import os
+import selectors
+import socket
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import relay
+from relay import UploadStream, send_stream
+
+def drain(port: int, receivers: int):
+    sel = selectors.DefaultSelector()
+    for _ in range(receivers):
+        s = socket.create_connection(('127.0.0.1', port))
+        s.setblocking(False)
+        sel.register(s, selectors.EVENT_READ)
+    buf = bytearray(1 << 20)
+    open_socks = receivers
+    while open_socks:
+        for key, _ in sel.select():
+            try:
+                n = key.fileobj.recv_into(buf)
+            except BlockingIOError:
+                continue
+            if not n:
+                sel.unregister(key.fileobj)
+                key.fileobj.close()
+                open_socks -= 1
+
+def fan_out(socks, path: Path, size: int):
+    stream = UploadStream.complete(path, size)
+    threads = [threading.Thread(target=send_stream, args=(s, stream)) for s in socks]
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.process_time() - cpu, time.perf_counter() - wall
+
+def main():
+    parser = argparse.ArgumentParser(description='sendfile vs copy fan-out benchmark')
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--receivers', type=int, default=50)
+    parser.add_argument('--json', action='store_true', help='machine-readable output')
+    args = parser.parse_args()
+    size = args.size_mb * 1024 * 1024
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'payload.bin'
+        with open(path, 'wb') as f:
+            block = os.urandom(1 << 20)
+            for _ in range(args.size_mb):
+                f.write(block)
+
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(args.receivers)
+        port = listener.getsockname()[1]
+        child = multiprocessing.Process(target=drain, args=(port, args.receivers), daemon=True)
+        child.start()
+        socks = [listener.accept()[0] for _ in range(args.receivers)]
+
+        gb = size * args.receivers / (1 << 30)
+        results = {}
+        modes = [('sendfile', True), ('copy', False)] if hasattr(os, 'sendfile') else [('copy', False)]
+        for name, use in modes:
+            relay.USE_SENDFILE = use
+            cpu, wall = fan_out(socks, path, size)
+            results[name] = {'cpu_s_per_gb': cpu / gb, 'wall_s': wall, 'gb_per_s': gb / wall}
+
+        for s in socks:
+            s.close()
+        child.join()
+        listener.close()
+
+    if args.json:
+        print(json.dumps({'size_mb': args.size_mb, 'receivers': args.receivers, 'results': results}))
+        return
+    print(f"{args.size_mb} MB to {args.receivers} receivers ({gb:.1f} GB per run)")
+    for name, r in results.items():
+        print(f"  {name:9s} {r['cpu_s_per_gb']:.3f} CPU s/GB   {r['gb_per_s']:.2f} GB/s   {r['wall_s']:.2f} s wall")
+
+if __name__ == '__main__':
+    main()
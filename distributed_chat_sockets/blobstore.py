@@ -0,0 +1,193 @@
+# blobstore.py
+# Content-addressed upload store for the chat server
+#
+# Every upload is kept once per SHA-256 under UPLOAD_DIR/blobs/ and an
+# append-only filename -> hash index (UPLOAD_DIR/index.jsonl) maps the names
+# shown to users onto blobs. Uploading an identical file again costs no extra
+# disk, and with the file_offer step (see protocols.md) no upload bandwidth.
+# Names are also hard-linked into UPLOAD_DIR so the folder stays browsable.
+# Index entries also say which room a name was shared to: only that room's
+# members may fetch it. Entries from before rooms count as the lobby's.
+# Worker processes share the directory: a name is claimed by creating an
+# empty placeholder under it with O_EXCL, which the hard link later replaces,
+# so two workers never hand out the same name, and a name is never pointed
+# at other content once recorded.
+
+import json
+import os
+import re
+import tempfile
+import threading
+from pathlib import Path
+from typing import BinaryIO, Dict, Optional, Set, Tuple
+
+from rooms import DEFAULT_ROOM
+
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+class BlobStore:
+    def __init__(self, root: Path):
+        self.root = root
+        self.blob_dir = root / 'blobs'
+        self.tmp_dir = self.blob_dir / 'tmp'
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = root / 'index.jsonl'
+        self.lock = threading.Lock()
+        self.names: Dict[str, Tuple[str, int]] = {}   # name -> (sha256, size)
+        self.rooms: Dict[str, Set[str]] = {}          # name -> rooms it was shared to
+        self.reserved = set()                         # names of uploads still in flight
+        self.next_suffix: Dict[str, int] = {}         # name -> next _N to try
+        self._load()
+
+    def _load(self):
+        if not self.index_path.exists():
+            return
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                    self.names[rec['name']] = (rec['sha256'], int(rec['size']))
+                    room = rec['room'] if 'room' in rec else DEFAULT_ROOM
+                    if room:
+                        self.rooms.setdefault(rec['name'], set()).add(room)
+                except (ValueError, KeyError):
+                    continue    # torn last line after a crash
+
+    def blob_path(self, sha256: str) -> Path:
+        return self.blob_dir / sha256[:2] / sha256
+
+    def lookup(self, sha256: str, size: int) -> Optional[Path]:
+        """Path of the blob with this hash and size, or None."""
+        if not SHA256_RE.match(sha256 or ''):
+            return None
+        path = self.blob_path(sha256)
+        try:
+            if path.stat().st_size == size:
+                return path
+        except OSError:
+            pass
+        return None
+
+    def resolve(self, name: str) -> Optional[Tuple[str, int]]:
+        with self.lock:
+            return self.names.get(name)
+
+    def rooms_of(self, name: str) -> Set[str]:
+        """Rooms name was shared to (empty if it was never shared)."""
+        with self.lock:
+            return set(self.rooms.get(name, ()))
+
+    def reserve_name(self, filename: str, sha256: str = None) -> str:
+        """Pick the display name for an upload (name, name_1, ...).
+
+        If filename already refers to the same verified blob it is reused, so
+        re-sharing a file does not mint a new _N copy. Collisions are resolved
+        from the in-memory index first; only a free-looking name is claimed on
+        disk, which fails if another process (or a file from before the index)
+        has it.
+        """
+        safe = os.path.basename(filename) or 'file.bin'
+        stem, suf = os.path.splitext(safe)
+        with self.lock:
+            if sha256 and self.names.get(safe, (None,))[0] == sha256:
+                return safe
+            name, i = safe, self.next_suffix.get(safe, 1)
+            while not self._claim(name):
+                name = f"{stem}_{i}{suf}"
+                i += 1
+            if name != safe:
+                self.next_suffix[safe] = i
+            self.reserved.add(name)
+            return name
+
+    def _claim(self, name: str) -> bool:
+        if name in self.names or name in self.reserved:
+            return False
+        try:
+            os.close(os.open(self.root / name, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+            return True
+        except FileExistsError:
+            return False
+
+    def begin(self) -> Tuple[Path, BinaryIO]:
+        """Open a staging file for an upload whose hash is not known yet."""
+        fd, tmp = tempfile.mkstemp(dir=self.tmp_dir, prefix='up_')
+        # unbuffered: every write is visible to streaming readers immediately
+        return Path(tmp), os.fdopen(fd, 'wb', buffering=0)
+
+    def commit(self, name: str, tmp_path: Path, sha256: str, size: int, stream=None,
+               room: str = None) -> Path:
+        """Move a finished upload into place (or drop it if the blob exists); see record."""
+        blob = self.blob_path(sha256)
+        blob.parent.mkdir(exist_ok=True)
+        # readers open stream.path under stream.cond, so swap it atomically
+        with (stream.cond if stream else self.lock):
+            if blob.exists():
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            else:
+                os.replace(tmp_path, blob)
+            if stream:
+                stream.path = blob
+        self.record(name, sha256, size, room)
+        return blob
+
+    def record(self, name: str, sha256: str, size: int, room: str = None) -> bool:
+        """Point name at an existing blob and persist the index entry; room (None: not shared)
+        is where it was shared, one more room whose members may fetch it. False if name
+        already points at other content."""
+        with self.lock:
+            if self._conflicts(name, sha256):
+                return False
+            claimed = name in self.reserved
+            self.reserved.discard(name)
+            rooms = self.rooms.setdefault(name, set())
+            if self.names.get(name) == (sha256, size) and (room is None or room in rooms):
+                return True
+            self.names[name] = (sha256, size)
+            if room:
+                rooms.add(room)
+            with open(self.index_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'name': name, 'sha256': sha256, 'size': size, 'room': room}) + '\n')
+        try:
+            if claimed:
+                # over our placeholder, in one step
+                tmp = self.tmp_dir / f'ln_{os.getpid()}_{threading.get_ident()}'
+                os.link(self.blob_path(sha256), tmp)
+                os.replace(tmp, self.root / name)
+            else:
+                os.link(self.blob_path(sha256), self.root / name)
+        except OSError:
+            pass    # no hard links here (the placeholder keeps the name), or a legacy file has it
+        return True
+
+    def remember(self, name: str, sha256: str, size: int, room: str = None) -> bool:
+        """Learn an entry another process sharing this directory has already recorded;
+        False if name already points at other content here."""
+        with self.lock:
+            if self._conflicts(name, sha256):
+                return False
+            self.reserved.discard(name)
+            self.names[name] = (sha256, size)
+            if room:
+                self.rooms.setdefault(name, set()).add(room)
+            return True
+
+    def _conflicts(self, name: str, sha256: str) -> bool:
+        known = self.names.get(name)
+        if known and known[0] != sha256:
+            print(f"[store] {name} is {known[0][:12]}..., not {sha256[:12]}...; not recorded")
+            return True
+        return False
+
+    def abort(self, name: str, tmp_path: Path):
+        with self.lock:
+            claimed = name in self.reserved
+            self.reserved.discard(name)
+        for path in ([tmp_path, self.root / name] if claimed else [tmp_path]):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -3,11 +3,14 @@
 #
 # NOTE: Make sure SERVER_HOST and SERVER_PORT match your server_tcp.py settings.
 
+import bisect
+import collections
+import itertools
 import socket
 import threading
-import struct
-import json
+import time
 import os
+import queue
 import subprocess
 import sys
 from pathlib import Path
@@ -15,32 +18,39 @@ import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 from datetime import datetime
 
+from framing import COMPACT, FrameReader, send_frame
+from transfers import (PartialDownload, RESUMABLE_MIN_SIZE, make_transfer_id, range_proof,
+                       send_upload_chunks, sha256_file)
+
 # === CONFIG ===
 SERVER_HOST = '127.0.0.1'   # change to server IP when running on different machine
 SERVER_PORT = 9009
 DOWNLOAD_DIR = Path('downloads_gui')
 DOWNLOAD_DIR.mkdir(exist_ok=True)
 CHUNK_SIZE = 64 * 1024  # 64 KB chunks for sending files (so progress can be shown)
+REPLY_TIMEOUT = 3.0     # seconds to wait for a server reply (older servers never send one)
+AUTO_FETCH_MAX = 1024 * 1024   # announced files up to this size are downloaded right away
+HISTORY_PAGE = 20              # earlier messages shown on joining a room and per /history
+DEFAULT_ROOM = 'lobby'         # every client is in it; frames without "room" belong to it
+FEATURES = ['pull', 'chunks', COMPACT, 'resume', 'presence']  # sent with join: file_announce + fetch, interleaved
+                                        # file_chunk frames, compact binary headers, resumable session,
+                                        # roster of online users
+RECONNECT_MIN = 1.0     # seconds before the first reconnect attempt after a drop, doubling up to
+RECONNECT_MAX = 30.0
+RENDER_INTERVAL = 30    # ms between chat redraws; lines queued in between go in with one insert
+RENDER_BATCH_MAX = 500  # lines per redraw at most, so a flood cannot stall the window
+SCROLLBACK_LINES = 5000 # chat lines kept; older ones (and their file links) are dropped
+LATENCY_SAMPLES = 1000  # recent append-to-widget times kept for /latency
 # ==============
 
-def recvall(sock, n):
-    """Receive exactly n bytes or return None if connection closed."""
-    data = bytearray()
-    while len(data) < n:
-        try:
-            packet = sock.recv(n - len(data))
-        except Exception:
-            return None
-        if not packet:
-            return None
-        data.extend(packet)
-    return bytes(data)
+# held for each whole frame: chat from the UI thread goes out between upload chunks
+send_lock = threading.RLock()
+# set once the server confirms compact headers; until then everything goes out as JSON
+compact = False
 
 def send_header(sock, header):
-    """Send framed JSON header: [4-byte len][header_json]."""
-    hb = json.dumps(header).encode('utf-8')
-    sock.sendall(struct.pack('>I', len(hb)))
-    sock.sendall(hb)
+    """Send a framed header: [4-byte len][header]."""
+    send_frame(sock, header, lock=send_lock, compact=compact)
 
 def open_file(path: Path):
     """Open a file with the default OS application (cross-platform)."""
@@ -62,11 +72,29 @@ class ChatClientGUI:
         self.receiver_thread = None
         self.username = tk.StringVar(value="GUIUser")
         self.status_var = tk.StringVar(value="Disconnected")
-        self.users = set()
+        self.users = []     # sorted roster, as shown in user_listbox (Tk thread only)
         self._file_link_counter = 0
+        # chat lines go through a queue that the Tk loop drains in batches (see _render):
+        # (segments, on_click, queued_at), segments being (text, tag) pairs
+        self._lines = queue.SimpleQueue()
+        self._link_tags = collections.deque()   # file link tags in the chat, oldest first
+        self._latency = collections.deque(maxlen=LATENCY_SAMPLES)   # seconds from append to widget
+        self._pending_replies = {}      # ('offer', sha256) / ('upload', transfer_id) -> {'event', 'reply'}
+        self._partials = {}             # downloads in progress, by server filename
+        self._announced = {}            # files shared but not downloaded yet, by server filename
+        self._incoming = {}             # pushed files arriving as file_chunk frames, by transfer id
+        self._unfinished_uploads = {}   # transfer_id -> local path, resumed on reconnect
+        self.room = DEFAULT_ROOM        # where chat and files go (/join, /room)
+        self._oldest = {}               # room -> oldest history seq shown (0: nothing older)
+        self._last_seq = {}             # room -> newest seq seen; older frames are replays already shown
+        self._token = None              # session token; set while the server can resume us
+        self._unacked = collections.OrderedDict()   # message id -> header, resent after a reconnect
+        self._ids = itertools.count(1)
+        self._reconnecting = False
 
         self._build_ui()
         self._style_ui()
+        self.root.after(RENDER_INTERVAL, self._render)
 
     def _build_ui(self):
         # top frame
@@ -99,6 +127,7 @@ class ChatClientGUI:
         self.chat_text.tag_configure('me', foreground='#0b5394', font=('Helvetica', 10, 'bold'))
         self.chat_text.tag_configure('other', foreground='#1a1a1a', font=('Helvetica', 10))
         self.chat_text.tag_configure('time', foreground='#888', font=('Helvetica', 8))
+        self.chat_text.tag_configure('link', foreground='#0066cc', underline=True)
 
         chat_scroll = ttk.Scrollbar(chat_frame, orient='vertical', command=self.chat_text.yview)
         chat_scroll.pack(side='right', fill='y')
@@ -144,35 +173,96 @@ class ChatClientGUI:
         style.configure('TEntry', padding=6)
         style.configure('TLabel', padding=2)
 
-    def append(self, text, tag=None, include_time=True):
-        timestamp = ''
-        if include_time:
-            timestamp = datetime.now().strftime('%H:%M')
-        def do():
-            self.chat_text.config(state='normal')
-            if tag == 'system':
-                self.chat_text.insert('end', f"{text}\n", 'system')
+    def append(self, text, tag=None, include_time=True, when=None):
+        """Queue a chat line; safe from any thread, drawn by the next _render."""
+        if tag == 'system':
+            segments = [(f"{text}\n", 'system')]
+        else:
+            segments = []
+            if include_time:
+                segments.append((f"[{(when or datetime.now()).strftime('%H:%M')}] ", 'time'))
+            if tag == 'me':
+                segments.append((f"You: {text}\n", 'me'))
             else:
-                if include_time:
-                    self.chat_text.insert('end', f"[{timestamp}] ", 'time')
-                if tag == 'me':
-                    self.chat_text.insert('end', f"You: {text}\n", 'me')
-                elif tag == 'other':
-                    self.chat_text.insert('end', f"{text}\n", 'other')
-                else:
-                    self.chat_text.insert('end', f"{text}\n")
-            self.chat_text.see('end')
-            self.chat_text.config(state='disabled')
-        self.root.after(0, do)
+                segments.append((f"{text}\n", tag))
+        self._lines.put((segments, None, time.perf_counter()))
+
+    def _render(self):
+        """Draw what was queued since the last run, then come back in RENDER_INTERVAL ms."""
+        try:
+            batch = []
+            while len(batch) < RENDER_BATCH_MAX:
+                try:
+                    batch.append(self._lines.get_nowait())
+                except queue.Empty:
+                    break
+            if batch:
+                self._draw(batch)
+        finally:
+            self.root.after(RENDER_INTERVAL, self._render)
+
+    def _draw(self, batch):
+        """One insert for the whole batch, trim the scrollback, one scroll."""
+        text = self.chat_text
+        # follow new lines only if the user has not scrolled up to read
+        at_bottom = text.yview()[1] >= 1.0
+        args = []
+        for segments, on_click, _ in batch:
+            if on_click is not None:
+                # a per-link tag carries the click binding; 'link' the looks
+                tag_name = f"filelink_{self._file_link_counter}"
+                self._file_link_counter += 1
+                text.tag_bind(tag_name, '<Button-1>', lambda e, f=on_click: f())
+                self._link_tags.append(tag_name)
+                segments = [segments[0], (segments[1][0], ('link', tag_name))]
+            for chars, tag in segments:
+                args += (chars, tag or ())
+        text.config(state='normal')
+        text.insert('end', *args)
+        excess = int(text.index('end-1c').split('.')[0]) - 1 - SCROLLBACK_LINES
+        if excess > 0:
+            text.delete('1.0', f'{excess + 1}.0')
+            # links that scrolled out: drop their tags and, with them, the click handlers
+            while self._link_tags and not text.tag_ranges(self._link_tags[0]):
+                text.tag_delete(self._link_tags.popleft())
+        text.config(state='disabled')
+        if at_bottom:
+            text.see('end')
+        now = time.perf_counter()
+        self._latency.extend(now - queued for _, _, queued in batch)
+
+    def _show_latency(self):
+        samples = sorted(self._latency)
+        if not samples:
+            self.append("No chat lines drawn yet", tag='system')
+            return
+        pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+        self.append(f"Frame to screen over the last {len(samples)} lines: p50 {pick(0.5):.1f} ms, "
+                    f"p99 {pick(0.99):.1f} ms, max {samples[-1] * 1000:.1f} ms; "
+                    f"{self._lines.qsize()} waiting", tag='system')
 
-    def update_user_list(self):
+    def apply_presence(self, header):
+        """Roster snapshot or changes from the server; only changed rows are touched."""
         def do():
-            self.user_listbox.delete(0, 'end')
-            for u in sorted(self.users):
-                self.user_listbox.insert('end', u)
+            if header.get('snapshot'):
+                self.users = sorted(header.get('users', []))
+                self.user_listbox.delete(0, 'end')
+                self.user_listbox.insert('end', *self.users)
+                return
+            for u in header.get('offline', []):
+                i = bisect.bisect_left(self.users, u)
+                if i < len(self.users) and self.users[i] == u:
+                    del self.users[i]
+                    self.user_listbox.delete(i)
+            for u in header.get('online', []):
+                i = bisect.bisect_left(self.users, u)
+                if i == len(self.users) or self.users[i] != u:
+                    self.users.insert(i, u)
+                    self.user_listbox.insert(i, u)
         self.root.after(0, do)
 
     def connect(self):
+        global compact
         if self.sock:
             messagebox.showinfo("Info", "Already connected.")
             return
@@ -188,121 +278,311 @@ class ChatClientGUI:
             self.send_btn.config(state='normal')
             self.attach_btn.config(state='normal')
             self.username_str = self.username.get().strip() or "GUIUser"
+            compact = False
+            self.room = DEFAULT_ROOM
             # send join header
-            send_header(self.sock, {'type':'join','username': self.username_str})
+            self._join()
             self.append("Connected.", tag='system', include_time=False)
+            self._request_history(DEFAULT_ROOM)
             # start receiver thread
-            self.receiver_thread = threading.Thread(target=self.receiver, daemon=True)
+            self.receiver_thread = threading.Thread(target=self.receiver, args=(sock,), daemon=True)
             self.receiver_thread.start()
+            self._resume_transfers()
         except Exception as e:
             messagebox.showerror("Connection error", str(e))
 
+    def _join(self):
+        header = {'type':'join', 'username': self.username_str, 'features': FEATURES}
+        if self._token:
+            header['resume'] = self._token
+            header['seqs'] = dict(self._last_seq)
+        send_header(self.sock, header)
+
+    def _reconnect(self):
+        """After a drop: connect again with backoff and resume the session (runs on its own thread)."""
+        global compact
+        delay = RECONNECT_MIN
+        while self._reconnecting:
+            self.root.after(0, self.status_var.set, f"Connection lost; reconnecting in {delay:.0f}s...")
+            time.sleep(delay)
+            if not self._reconnecting:
+                return
+            try:
+                sock = socket.create_connection((SERVER_HOST, SERVER_PORT))
+            except OSError:
+                delay = min(delay * 2, RECONNECT_MAX)
+                continue
+            self._reconnecting = False
+            self.sock = sock
+            compact = False
+            self._join()
+            for header in list(self._unacked.values()):
+                send_header(sock, header)
+            self.root.after(0, self.status_var.set, f"Connected to {SERVER_HOST}:{SERVER_PORT}")
+            self.receiver_thread = threading.Thread(target=self.receiver, args=(sock,), daemon=True)
+            self.receiver_thread.start()
+            self._resume_transfers()
+
+    def _on_session(self, header):
+        had_session = self._token is not None
+        if header.get('resumed'):
+            self.append("Reconnected; catching up.", tag='system')
+            return
+        if had_session and header.get('token') == self._token:
+            return
+        self._token = header.get('token')
+        rooms = [r for r in self._last_seq if r != DEFAULT_ROOM]
+        self._last_seq = dict(header.get('seqs') or {})
+        if had_session:
+            # the old session expired: join the rooms again; what was missed is in /history
+            self.append("Reconnected (session expired; /history shows what was missed).", tag='system')
+            for room in rooms:
+                send_header(self.sock, {'type':'join_room', 'room': room})
+            if self.room not in rooms:
+                self.room = DEFAULT_ROOM
+
+    def _first_time(self, header):
+        """False for a room frame seen already (replayed after a reconnect)."""
+        seq = header.get('seq')
+        if seq is None:
+            return True
+        room = header.get('room') or DEFAULT_ROOM
+        if seq <= self._last_seq.get(room, 0):
+            return False
+        self._last_seq[room] = seq
+        return True
+
+    def _send_message(self, header):
+        if self._token:
+            header['id'] = next(self._ids)
+            self._unacked[header['id']] = header
+        send_header(self.sock, header)
+
+    def _resume_transfers(self):
+        """Pick up downloads and uploads cut short by an earlier disconnect."""
+        for d in PartialDownload.pending(DOWNLOAD_DIR):
+            self._partials[d.filename] = self._watch(d)
+            self.append(f"Resuming download of {d.filename} at {d.offset}/{d.filesize} bytes", tag='system')
+            send_header(self.sock, {'type':'fetch', 'filename': d.filename, 'offset': d.offset})
+        for path in list(self._unfinished_uploads.values()):
+            threading.Thread(target=self._send_file_thread, args=(path,), daemon=True).start()
+
     def disconnect(self):
-        if not self.sock:
+        if not self.sock and not self._reconnecting:
             return
-        try:
-            self.sock.close()
-        except:
-            pass
-        self.sock = None
+        sock, self.sock = self.sock, None
+        self._reconnecting = False
+        if sock:
+            try:
+                # leaving for good: the server need not keep our session
+                send_header(sock, {'type':'quit'})
+                sock.close()
+            except:
+                pass
+        self._token = None
+        self._last_seq.clear()
+        self._unacked.clear()
         self.status_var.set("Disconnected")
         self.connect_btn.config(state='normal')
         self.disconnect_btn.config(state='disabled')
         self.send_btn.config(state='disabled')
         self.attach_btn.config(state='disabled')
+        self.apply_presence({'snapshot': True, 'users': []})
         self.append("Disconnected.", tag='system')
 
-    def receiver(self):
+    def receiver(self, sock):
+        global compact
+        reader = FrameReader(sock)
         try:
-            while self.sock:
-                raw = recvall(self.sock, 4)
-                if raw is None:
-                    break
-                hdr_len = struct.unpack('>I', raw)[0]
-                hdr_bytes = recvall(self.sock, hdr_len)
-                if hdr_bytes is None:
+            while self.sock is sock:
+                header = reader.read_header()
+                if header is None:
                     break
-                header = json.loads(hdr_bytes.decode('utf-8'))
                 typ = header.get('type')
+                if not self._first_time(header):
+                    continue
                 if typ == 'system':
                     text = header.get('text', '')
-                    if 'joined' in text:
-                        who = text.split(' joined')[0]
-                        self.users.add(who)
-                        self.update_user_list()
-                    if 'left' in text:
-                        who = text.split(' left')[0]
-                        if who in self.users:
-                            self.users.remove(who)
-                            self.update_user_list()
+                    if 'last_seq' in header:
+                        # "Joined #room": the room's frames continue from here
+                        self._last_seq[header.get('room') or DEFAULT_ROOM] = header['last_seq']
+                    if header.get('room'):
+                        self.append(f"#{header['room']}: {text}", tag='system')
+                        continue
                     self.append(text, tag='system')
 
                 elif typ == 'message':
                     user = header.get('username', 'Anon')
                     text = header.get('text', '')
-                    self.append(f"{user}: {text}", tag='other')
-                    self.users.add(user)
-                    self.update_user_list()
+                    if header.get('to'):
+                        self.append(f"{user} (direct): {text}", tag='other')
+                    elif header.get('room'):
+                        self.append(f"#{header['room']} {user}: {text}", tag='other')
+                    else:
+                        self.append(f"{user}: {text}", tag='other')
+
+                elif typ == 'presence':
+                    self.apply_presence(header)
+
+                elif typ == 'features':
+                    compact = COMPACT in header.get('features', [])
+
+                elif typ == 'session':
+                    self._on_session(header)
+
+                elif typ == 'ack':
+                    self._unacked.pop(header.get('id'), None)
+
+                elif typ == 'history':
+                    self._show_history(header)
+
+                elif typ == 'search':
+                    self._show_search(header)
+
+                elif typ == 'file_offer_reply':
+                    self._resolve(('offer', header.get('sha256')), header)
+
+                elif typ == 'upload_status':
+                    if not self._resolve(('upload', header.get('transfer_id')), header) and header.get('error'):
+                        self.append(f"Upload stopped at {header.get('offset')} bytes ({header.get('error')}); "
+                                    f"it resumes when you send the file again", tag='system')
+
+                elif typ == 'upload_done':
+                    path = self._unfinished_uploads.pop(header.get('transfer_id'), None)
+                    if path:
+                        self.append(f"You sent file: {header.get('filename')} ({os.path.getsize(path)} bytes)", tag='me')
+
+                elif typ == 'file_error':
+                    self.append(f"Server refused {header.get('filename')}: {header.get('error')}", tag='system')
+
+                elif typ == 'fetch_chunk':
+                    data = reader.read_exact(int(header.get('size', 0)))
+                    if data is None:
+                        break
+                    d = self._partials.get(header.get('filename'))
+                    if d and not d.append_chunk(int(header.get('offset', -1)), data, header.get('sha256', '')):
+                        self.append(f"Bad chunk for {d.filename}, will retry on reconnect", tag='system')
+                        self._partials.pop(d.filename, None)
+
+                elif typ == 'fetch_done':
+                    d = self._partials.pop(header.get('filename'), None)
+                    if d and header.get('error'):
+                        self.append(f"Cannot resume {d.filename}: {header.get('error')}", tag='system')
+                        d.discard()
+                    elif d and d.complete:
+                        d.sha256 = d.sha256 or header.get('sha256')
+                        ann = self._announced.pop(d.filename, None)
+                        self._finish_download(d, ann['username'] if ann else 'download')
+
+                elif typ == 'file_start':
+                    d = PartialDownload.start(DOWNLOAD_DIR, header.get('filename'),
+                                              int(header.get('filesize', 0)), header.get('sha256'))
+                    self._incoming[header.get('id')] = (self._watch(d), header.get('username', 'someone'))
+
+                elif typ == 'file_chunk':
+                    data = reader.read_exact(int(header.get('size', 0)))
+                    if data is None:
+                        break
+                    entry = self._incoming.get(header.get('id'))
+                    if entry and not entry[0].append_chunk(int(header.get('offset', -1)), data):
+                        self.append(f"Out-of-order chunk for {entry[0].filename}, dropping it", tag='system')
+                        self._incoming.pop(header.get('id'), None)
+                        entry[0].discard()
+
+                elif typ == 'file_end':
+                    entry = self._incoming.pop(header.get('id'), None)
+                    if entry:
+                        d, username = entry
+                        if header.get('error'):
+                            self.append(f"File {d.filename} from {username} was interrupted", tag='system')
+                            d.discard()
+                        elif d.complete:
+                            d.sha256 = d.sha256 or header.get('sha256')
+                            self._finish_download(d, username)
+
+                elif typ == 'file_announce':
+                    username = header.get('username', 'someone')
+                    filename = header.get('filename')
+                    filesize = int(header.get('filesize', 0))
+                    self._announced[filename] = header
+                    if filesize <= AUTO_FETCH_MAX:
+                        self._fetch(header)
+                    else:
+                        self._insert_link(f"{username} shared file: {filename} ({filesize} bytes) (click to download)",
+                                          lambda h=header: self._fetch(h))
 
                 elif typ == 'file':
                     username = header.get('username', 'someone')
                     filename = header.get('filename')
                     filesize = int(header.get('filesize', 0))
 
-                    # read file bytes
-                    file_bytes = recvall(self.sock, filesize)
-                    if file_bytes is None:
-                        self.append("File transfer interrupted", tag='system')
-                        continue
+                    # write the payload to .partial/ as it arrives so a drop can be resumed
+                    d = self._watch(PartialDownload.start(DOWNLOAD_DIR, filename, filesize, header.get('sha256')))
+                    if not d.recv_payload(reader):
+                        self.append(f"File transfer interrupted at {d.offset}/{filesize} bytes "
+                                    f"(resumes on reconnect)", tag='system')
+                        break
 
-                    save_path = DOWNLOAD_DIR / filename
-                    # avoid overwrite
-                    i = 1
-                    base = save_path.stem
-                    suf = save_path.suffix
-                    while save_path.exists():
-                        save_path = DOWNLOAD_DIR / f"{base}_{i}{suf}"
-                        i += 1
-
-                    with open(save_path, 'wb') as f:
-                        f.write(file_bytes)
-
-                    # Add to chat as a clickable link
-                    self.users.add(username)
-                    self.update_user_list()
-
-                    tag_name = f"filelink_{self._file_link_counter}"
-                    self._file_link_counter += 1
-                    display_text = f"{username} sent file: {save_path.name} (click to open)\n"
-
-                    def make_insert(path, tag):
-                        def _do():
-                            self.chat_text.config(state='normal')
-                            # insert timestamp
-                            self.chat_text.insert('end', datetime.now().strftime('[%H:%M] '), 'time')
-                            start_index = self.chat_text.index('end-1c')
-                            self.chat_text.insert('end', display_text, tag)
-                            self.chat_text.see('end')
-                            self.chat_text.config(state='disabled')
-                            # configure tag appearance and bind click
-                            self.chat_text.tag_configure(tag, foreground='#0066cc', underline=True)
-                            self.chat_text.tag_bind(tag, '<Button-1>', lambda e, p=path: open_file(p))
-                        return _do
-
-                    self.root.after(0, make_insert(save_path, tag_name))
+                    self._finish_download(d, username)
 
                 else:
                     self.append(f"Unknown: {header}", tag='system')
+        except OSError:
+            pass    # socket closed (Disconnect pressed or server gone)
         except Exception as e:
             self.append("Receiver error: " + str(e), tag='system')
         finally:
             try:
-                if self.sock:
-                    self.sock.close()
+                sock.close()
             except:
                 pass
-            self.sock = None
-            self.root.after(0, lambda: self.disconnect())
+            if self.sock is sock:
+                # dropped, not Disconnect: reconnect if the server keeps our session
+                self.sock = None
+                if self._token:
+                    self._reconnecting = True
+                    self.append("Connection lost.", tag='system')
+                    threading.Thread(target=self._reconnect, daemon=True).start()
+                else:
+                    self._reconnecting = True   # lets disconnect() reset the UI
+                    self.root.after(0, self.disconnect)
+
+    def _watch(self, d):
+        """Show d's progress on the progress bar as its bytes come in."""
+        def progress(d):
+            value = 0 if d.complete else d.offset
+            self.root.after(0, lambda: self.progress.configure(maximum=max(d.filesize, 1), value=value))
+        d.progress = progress
+        return d
+
+    def _finish_download(self, d, username):
+        save_path = d.finish()
+        if save_path is None:
+            self.append(f"Download of {d.filename} failed verification, discarded", tag='system')
+            return
+
+        self._insert_link(f"{username} sent file: {save_path.name} (click to open)",
+                          lambda p=save_path: open_file(p))
+
+    def _fetch(self, header):
+        """Download an announced file (fetch from offset 0)."""
+        filename = header.get('filename')
+        if filename in self._partials or not self.sock:
+            return
+        d = PartialDownload.start(DOWNLOAD_DIR, filename, int(header.get('filesize', 0)), header.get('sha256'))
+        self._partials[filename] = self._watch(d)
+        if d.filesize > AUTO_FETCH_MAX:
+            self.append(f"Downloading {filename}...", tag='system')
+        try:
+            send_header(self.sock, {'type':'fetch', 'filename': filename, 'offset': 0})
+        except OSError as e:
+            self._partials.pop(filename, None)
+            self.append(f"Cannot download {filename}: {e}", tag='system')
+
+    def _insert_link(self, text, on_click):
+        """Queue a clickable line for the chat."""
+        segments = [(datetime.now().strftime('[%H:%M] '), 'time'), (text + "\n", None)]
+        self._lines.put((segments, on_click, time.perf_counter()))
 
     def send_msg(self):
         if not self.sock:
@@ -311,16 +591,97 @@ class ChatClientGUI:
         txt = self.msg_entry.get().strip()
         if not txt:
             return
-        header = {'type':'message', 'text': txt}
         try:
-            send_header(self.sock, header)
-            # show locally
-            self.append(txt, tag='me')
+            if txt.startswith('/'):
+                self._command(txt)
+            else:
+                self._send_message(self._in_room({'type':'message', 'text': txt}))
+                # show locally
+                self.append(txt if self.room == DEFAULT_ROOM else f"#{self.room} {txt}", tag='me')
             self.msg_entry.delete(0, 'end')
         except Exception as e:
             messagebox.showerror("Send error", str(e))
             self.disconnect()
 
+    def _command(self, txt):
+        """/join ROOM, /leave ROOM, /room ROOM (send there), /msg USER TEXT, /history, /search, /latency."""
+        cmd, _, arg = txt.partition(' ')
+        arg = arg.strip()
+        if cmd == '/join' and arg:
+            send_header(self.sock, {'type':'join_room', 'room': arg})
+            self.room = arg
+            self._request_history(arg)
+        elif cmd == '/leave' and arg:
+            send_header(self.sock, {'type':'leave_room', 'room': arg})
+            self._last_seq.pop(arg, None)
+            if arg == self.room:
+                self.room = DEFAULT_ROOM
+        elif cmd == '/room':
+            self.room = arg or DEFAULT_ROOM
+            self.append(f"Sending to #{self.room}", tag='system')
+        elif cmd == '/msg' and ' ' in arg:
+            to, text = arg.split(' ', 1)
+            self._send_message({'type':'message', 'to': to, 'text': text})
+            self.append(f"(to {to}) {text}", tag='me')
+        elif cmd == '/search' and arg:
+            words = arg.split()
+            header = {'type':'search', 'limit': HISTORY_PAGE}
+            if words[0].startswith('@'):
+                header['username'] = words.pop(0)[1:]
+            header['q'] = ' '.join(words)
+            send_header(self.sock, header)
+        elif cmd == '/latency':
+            self._show_latency()
+        elif cmd == '/history':
+            if self._oldest.get(self.room) == 0:
+                self.append(f"No earlier messages in #{self.room}", tag='system')
+            else:
+                self._request_history(self.room, self._oldest.get(self.room))
+        else:
+            self.append("Commands: /join ROOM, /leave ROOM, /room ROOM, /msg USER TEXT, /history, "
+                        "/search [@USER] WORDS, /latency", tag='system')
+
+    def _request_history(self, room, before=None):
+        header = {'type':'history', 'limit': HISTORY_PAGE}
+        if room != DEFAULT_ROOM:
+            header['room'] = room
+        if before:
+            header['before'] = before
+        send_header(self.sock, header)
+
+    def _show_history(self, header):
+        room = header.get('room') or DEFAULT_ROOM
+        records = header.get('messages', [])
+        first = records[0].get('seq', 0) if records else 0
+        self._oldest[room] = first if first > header.get('first_seq', 0) else 0
+        if not records:
+            self.append(f"No earlier messages in #{room}", tag='system')
+            return
+        self.append(f"— earlier in #{room} —", tag='system')
+        for rec in records:
+            when = datetime.fromtimestamp(rec['ts']) if rec.get('ts') else None
+            if rec.get('type') == 'message':
+                self.append(f"{rec.get('username', 'Anon')}: {rec.get('text', '')}", tag='other', when=when)
+            elif rec.get('type') == 'file_announce':
+                self.append(f"{rec.get('username')} shared {rec.get('filename')}", tag='other', when=when)
+            else:
+                self.append(rec.get('text', ''), tag='system')
+        self.append("—", tag='system')
+
+    def _show_search(self, header):
+        self.append(f"— {header.get('total', 0)} found for \"{header.get('q')}\" ({header.get('ms')} ms) —",
+                    tag='system')
+        for r in header.get('results', []):
+            when = datetime.fromtimestamp(r['ts']) if r.get('ts') else None
+            self.append(f"#{r.get('room')} {r.get('username')}: {r.get('text') or ''}", tag='other', when=when)
+        self.append("—", tag='system')
+
+    def _in_room(self, header):
+        """Address a chat or file frame to the current room."""
+        if self.room != DEFAULT_ROOM:
+            header['room'] = self.room
+        return header
+
     def choose_and_send_file(self):
         if not self.sock:
             messagebox.showwarning("Warning", "Not connected")
@@ -332,17 +693,71 @@ class ChatClientGUI:
         t = threading.Thread(target=self._send_file_thread, args=(path,), daemon=True)
         t.start()
 
+    def _request(self, key, header):
+        """Send header and wait for the reply registered under key (None on timeout)."""
+        entry = {'event': threading.Event(), 'reply': None}
+        self._pending_replies[key] = entry
+        try:
+            send_header(self.sock, header)
+            entry['event'].wait(REPLY_TIMEOUT)
+        finally:
+            self._pending_replies.pop(key, None)
+        return entry['reply']
+
+    def _resolve(self, key, header):
+        entry = self._pending_replies.get(key)
+        if not entry:
+            return False
+        entry['reply'] = header
+        entry['event'].set()
+        return True
+
+    def _send_resumable(self, path, fname, total):
+        """Upload in hashed chunks; the server tells us where to (re)start."""
+        tid = make_transfer_id(path)
+        self._unfinished_uploads[tid] = path
+        status = self._request(('upload', tid), self._in_room({'type':'upload_begin', 'transfer_id': tid,
+                                                               'filename': fname, 'filesize': total}))
+        if not status or status.get('error'):
+            self._unfinished_uploads.pop(tid, None)
+            raise RuntimeError(f"server refused resumable upload: {status and status.get('error')}")
+        offset = int(status.get('offset', 0))
+        if offset:
+            self.append(f"Resuming {fname} at {offset}/{total} bytes", tag='system')
+        self.root.after(0, lambda: self.progress.configure(maximum=total, value=offset))
+        send_upload_chunks(self.sock, path, tid, offset, total,
+                           progress=lambda s: self.root.after(0, lambda: self.progress.configure(value=s)),
+                           lock=send_lock, compact=compact)
+        # "You sent file" is shown when the server confirms with upload_done
+
     def _send_file_thread(self, path):
         try:
             total = os.path.getsize(path)
             fname = os.path.basename(path)
-            header = {'type':'file', 'filename': fname, 'filesize': total}
-            # send header first
-            send_header(self.sock, header)
-            # send file in chunks so we can update progressbar
+            sha256 = sha256_file(path)
+            reply = self._request(('offer', sha256), self._in_room({'type':'file_offer', 'filename': fname,
+                                                                    'filesize': total, 'sha256': sha256}))
+            if reply and reply.get('challenge'):
+                # the server has these bytes; prove we have them too instead of sending them
+                reply = self._request(('offer', sha256), {'type':'file_proof', 'sha256': sha256,
+                                                          'proof': range_proof(path, reply['challenge'])})
+            if reply and reply.get('have'):
+                self.append(f"You shared file: {fname} ({total} bytes, already on server)", tag='me')
+                self.root.after(0, lambda: self.file_label.config(text="No file selected"))
+                return
+            if reply and total >= RESUMABLE_MIN_SIZE:
+                # the server answered the offer, so it speaks the chunked/resumable protocol
+                self._send_resumable(path, fname, total)
+                self.root.after(0, lambda: self.progress.configure(value=0))
+                self.root.after(0, lambda: self.file_label.config(text="No file selected"))
+                return
+            header = self._in_room({'type':'file', 'filename': fname, 'filesize': total})
             self.root.after(0, lambda: self.progress.configure(maximum=total, value=0))
             sent = 0
-            with open(path, 'rb') as f:
+            # older server: header and payload are one frame, nothing may go out in between
+            with send_lock, open(path, 'rb') as f:
+                send_header(self.sock, header)
+                # send file in chunks so we can update progressbar
                 while True:
                     chunk = f.read(CHUNK_SIZE)
                     if not chunk:
@@ -352,15 +767,14 @@ class ChatClientGUI:
                     # update progress
                     self.root.after(0, lambda s=sent: self.progress.configure(value=s))
             # completed
-            self.root.after(0, lambda: self.append(f"You sent file: {fname} ({total} bytes)", tag='me'))
+            self.append(f"You sent file: {fname} ({total} bytes)", tag='me')
             self.root.after(0, lambda: self.progress.configure(value=0))
             self.root.after(0, lambda: self.file_label.config(text="No file selected"))
         except Exception as e:
-            self.root.after(0, lambda: messagebox.showerror("File send error", str(e)))
+            self.root.after(0, lambda err=str(e): messagebox.showerror("File send error", err))
             self.root.after(0, lambda: self.progress.configure(value=0))
 
 if __name__ == '__main__':
-    import struct, json
     root = tk.Tk()
     app = ChatClientGUI(root)
     root.geometry('900x560')
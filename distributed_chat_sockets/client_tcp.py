@@ -3,68 +3,404 @@
 # Usage: python3 client_tcp.py
 # Commands:
 #   /name NEWNAME      -> change username locally (and send join)
-#   /file PATH         -> send a file at PATH
+#   /file PATH         -> send a file at PATH in the background (sending it again after a drop resumes it)
+#   /get NAME          -> download a file someone shared (larger files are not fetched automatically)
+#   /join ROOM         -> join a room and send there from now on
+#   /leave ROOM        -> leave a room (back to the lobby if it was the current one)
+#   /room ROOM         -> send to ROOM (one already joined) from now on
+#   /msg USER TEXT     -> direct message to one user
+#   /history           -> show older messages of the current room
+#   /search [@USER] WORDS -> find messages with all the WORDS in your rooms (optionally by USER)
+#   /who               -> list who is online
 #   /quit              -> exit
+#
+# If the connection drops the client reconnects by itself and resumes its
+# session: it gets what it missed in its rooms, and resends the messages the
+# server had not acknowledged yet.
 
+import collections
+import itertools
 import socket
 import threading
-import struct
-import json
+import time
 import os
 from pathlib import Path
 
+from framing import COMPACT, FrameReader, send_frame
+from transfers import (PartialDownload, RESUMABLE_MIN_SIZE, make_transfer_id, range_proof,
+                       send_upload_chunks, sha256_file)
+
 SERVER_HOST = '127.0.0.1'  # change to server IP if running across machines
 SERVER_PORT = 9009         # must match server PORT
 BUFFER = 4096
 DOWNLOAD_DIR = Path('downloads')
 DOWNLOAD_DIR.mkdir(exist_ok=True)
+REPLY_TIMEOUT = 3.0        # seconds to wait for a server reply (older servers never send one)
+AUTO_FETCH_MAX = 1024 * 1024   # announced files up to this size are downloaded right away
+PROGRESS_MIN_SIZE = 8 * 1024 * 1024   # downloads from this size up print their progress every 25%
+HISTORY_PAGE = 20              # messages shown on joining a room and per /history
+DEFAULT_ROOM = 'lobby'         # every client is in it; frames without "room" belong to it
+FEATURES = ['pull', 'chunks', COMPACT, 'resume', 'presence']  # sent with join: file_announce + fetch,
+                                        # interleaved file_chunk frames, compact binary headers, resumable
+                                        # session, roster of online users
+RECONNECT_MIN = 1.0        # seconds before the first reconnect attempt, doubling up to
+RECONNECT_MAX = 30.0
 
-def recvall(sock, n):
-    data = bytearray()
-    while len(data) < n:
-        packet = sock.recv(n - len(data))
-        if not packet:
-            return None
-        data.extend(packet)
-    return bytes(data)
+# requests waiting for the server's answer: key -> {'event', 'reply'}
+#   ('offer', sha256) -> file_offer_reply, ('upload', transfer_id) -> upload_status
+pending_replies = {}
+# downloads in progress, by server filename
+partials = {}
+# files announced by the server (not downloaded yet), by server filename
+announced = {}
+# pushed files arriving as file_chunk frames, by transfer id
+incoming = {}
+# held for each whole frame, so chat from the input thread can go out between upload chunks
+send_lock = threading.Lock()
+# set once the server confirms compact headers; until then everything goes out as JSON
+compact = False
+# room that chat and files are sent to
+current_room = DEFAULT_ROOM
+# oldest history seq shown per room, where /history continues from (0: nothing older)
+oldest_seq = {}
+# newest seq seen per joined room; sent when resuming, and older frames are duplicates
+last_seq = {}
+# who is online: the server's roster snapshot with its changes applied
+online = set()
+# session token from the server (None: the server does not resume sessions)
+session_token = None
+# messages sent with an id and not acknowledged yet, resent after a reconnect: id -> header
+unacked = collections.OrderedDict()
+message_ids = itertools.count(1)
+# the current connection (replaced on reconnect) and who we are on it
+server_sock = None
+username = None
+quitting = threading.Event()
 
 def send_framed(sock, header: dict, payload: bytes = None):
-    header_bytes = json.dumps(header).encode('utf-8')
-    sock.sendall(struct.pack('>I', len(header_bytes)))
-    sock.sendall(header_bytes)
-    if payload:
-        sock.sendall(payload)
+    send_frame(sock, header, payload, send_lock, compact)
+
+def in_room(header: dict) -> dict:
+    """Address a chat or file frame to the current room."""
+    if current_room != DEFAULT_ROOM:
+        header['room'] = current_room
+    return header
+
+def send_message(sock, header: dict):
+    """Send a chat message; with a session it carries an id and is kept until acknowledged."""
+    if session_token:
+        header['id'] = next(message_ids)
+        unacked[header['id']] = header
+    send_framed(sock, header)
+
+def apply_presence(header: dict):
+    if header.get('snapshot'):
+        online.clear()
+        online.update(header.get('users', []))
+        return
+    online.difference_update(header.get('offline', []))
+    online.update(header.get('online', []))
+
+def first_time(header: dict) -> bool:
+    """False for a room frame seen already (the server replays from the last seq we report)."""
+    seq = header.get('seq')
+    if seq is None:
+        return True
+    room = header.get('room') or DEFAULT_ROOM
+    if seq <= last_seq.get(room, 0):
+        return False
+    last_seq[room] = seq
+    return True
+
+def join(sock):
+    header = {'type':'join', 'username': username, 'features': FEATURES}
+    if session_token:
+        header['resume'] = session_token
+        header['seqs'] = dict(last_seq)
+    send_framed(sock, header)
+
+def on_session(sock, header: dict):
+    global session_token, current_room
+    had_session = session_token is not None
+    if header.get('resumed'):
+        print("Reconnected; catching up.")
+        return
+    if had_session and header.get('token') == session_token:
+        return      # the same session, joined again under a new /name
+    session_token = header.get('token')
+    rooms = [r for r in last_seq if r != DEFAULT_ROOM]
+    last_seq.clear()
+    last_seq.update(header.get('seqs') or {})
+    if had_session:
+        # the old session expired; join the rooms again, missed messages are in /history
+        print("Reconnected (session expired; see /history for what was missed).")
+        for room in rooms:
+            send_framed(sock, {'type':'join_room', 'room': room})
+        if current_room not in rooms:
+            current_room = DEFAULT_ROOM
+
+def reconnect():
+    """Connect again with backoff, resume the session and resend what was not acknowledged."""
+    global server_sock, compact
+    delay = RECONNECT_MIN
+    while not quitting.is_set():
+        print(f"Reconnecting in {delay:.0f}s...")
+        if quitting.wait(delay):
+            break
+        try:
+            sock = socket.create_connection((SERVER_HOST, SERVER_PORT))
+        except OSError as e:
+            print("Reconnect failed:", e)
+            delay = min(delay * 2, RECONNECT_MAX)
+            continue
+        compact = False     # negotiated again by the join
+        join(sock)
+        for header in list(unacked.values()):
+            send_framed(sock, header)
+        resume_downloads(sock)
+        server_sock = sock
+        return sock
+    return None
+
+def request_history(sock, room, before=None):
+    header = {'type':'history', 'limit': HISTORY_PAGE}
+    if room != DEFAULT_ROOM:
+        header['room'] = room
+    if before:
+        header['before'] = before
+    send_framed(sock, header)
+
+def chat_line(header: dict) -> str:
+    if header.get('type') != 'message':
+        return f"[SYSTEM] {header.get('text')}" if header.get('text') else f"[{header.get('type')}]"
+    if header.get('to'):
+        return f"[{header.get('username')} -> you] {header.get('text')}"
+    if header.get('room'):
+        return f"[#{header.get('room')}] [{header.get('username')}] {header.get('text')}"
+    return f"[{header.get('username')}] {header.get('text')}"
+
+def show_history(header: dict):
+    room = header.get('room') or DEFAULT_ROOM
+    records = header.get('messages', [])
+    if not records:
+        print(f"(no earlier messages in #{room})")
+        return
+    first = records[0].get('seq', 0)
+    oldest_seq[room] = first if first > header.get('first_seq', 0) else 0
+    print(f"--- #{room}, earlier ---")
+    for rec in records:
+        if rec.get('type') == 'file_announce':
+            print(f"[{rec.get('username')} shared {rec.get('filename')} ({rec.get('filesize')} bytes)]")
+        else:
+            print(chat_line(rec))
+    print("---")
+
+def show_search(header: dict):
+    results = header.get('results', [])
+    print(f"--- {header.get('total', 0)} found for \"{header.get('q')}\" ({header.get('ms')} ms) ---")
+    for r in results:
+        when = time.strftime('%Y-%m-%d %H:%M', time.localtime(r.get('ts', 0)))
+        print(f"{when} #{r.get('room')} [{r.get('username')}] {r.get('text')}")
+    print("---")
+
+def request(sock, key, header):
+    """Send header and wait for the reply registered under key (None on timeout)."""
+    entry = {'event': threading.Event(), 'reply': None}
+    pending_replies[key] = entry
+    try:
+        send_framed(sock, header)
+        entry['event'].wait(REPLY_TIMEOUT)
+    finally:
+        pending_replies.pop(key, None)
+    return entry['reply']
+
+def resolve(key, header):
+    entry = pending_replies.get(key)
+    if not entry:
+        return False
+    entry['reply'] = header
+    entry['event'].set()
+    return True
+
+def send_resumable(sock, path, fname, size):
+    """Upload in hashed chunks; the server tells us where to (re)start."""
+    tid = make_transfer_id(path)
+    status = request(sock, ('upload', tid), in_room({'type':'upload_begin', 'transfer_id': tid,
+                                                     'filename': fname, 'filesize': size}))
+    if not status or status.get('error'):
+        print("Server refused resumable upload:", status and status.get('error'))
+        return
+    offset = int(status.get('offset', 0))
+    if offset:
+        print(f"Resuming {fname} at {offset}/{size} bytes")
+    send_upload_chunks(sock, path, tid, offset, size, lock=send_lock, compact=compact)
+    print(f"Sent file: {fname} ({size} bytes), waiting for server to confirm")
+
+def send_file(sock, path):
+    size = os.path.getsize(path)
+    fname = os.path.basename(path)
+    sha256 = sha256_file(path)
+    reply = request(sock, ('offer', sha256), in_room({'type':'file_offer', 'filename': fname,
+                                                      'filesize': size, 'sha256': sha256}))
+    if reply and reply.get('challenge'):
+        # the server has these bytes; prove we have them too instead of sending them
+        reply = request(sock, ('offer', sha256), {'type':'file_proof', 'sha256': sha256,
+                                                  'proof': range_proof(path, reply['challenge'])})
+    if reply and reply.get('have'):
+        print(f"Shared file: {fname} ({size} bytes, already on server)")
+        return
+    if reply and size >= RESUMABLE_MIN_SIZE:
+        # the server answered the offer, so it speaks the chunked/resumable protocol
+        send_resumable(sock, path, fname, size)
+        return
+    with open(path, 'rb') as f:
+        data = f.read()
+    header = in_room({'type':'file', 'filename': fname, 'filesize': size})
+    send_framed(sock, header, data)
+    print(f"Sent file: {fname} ({size} bytes)")
+
+def resume_downloads(sock):
+    """Ask for the rest of any download cut short by an earlier disconnect."""
+    for d in PartialDownload.pending(DOWNLOAD_DIR):
+        partials[d.filename] = watch(d)
+        print(f"Resuming download of {d.filename} at {d.offset}/{d.filesize} bytes")
+        send_framed(sock, {'type':'fetch', 'filename': d.filename, 'offset': d.offset})
+
+def start_fetch(sock, ann):
+    d = PartialDownload.start(DOWNLOAD_DIR, ann['filename'], int(ann.get('filesize', 0)), ann.get('sha256'))
+    partials[d.filename] = watch(d)
+    send_framed(sock, {'type':'fetch', 'filename': d.filename, 'offset': 0})
+
+def watch(d):
+    """Print how far a large download has got, every quarter."""
+    if d.filesize >= PROGRESS_MIN_SIZE:
+        quarter = [int(d.fraction * 4)]
+        def progress(d):
+            q = int(d.fraction * 4)
+            if q > quarter[0] and not d.complete:
+                quarter[0] = q
+                print(f"Downloading {d.filename}: {q * 25}% ({d.offset}/{d.filesize} bytes)")
+        d.progress = progress
+    return d
+
+def finish_download(d, username=None):
+    partials.pop(d.filename, None)
+    save_path = d.finish(avoid_overwrite=False)
+    if save_path is None:
+        print(f"Download of {d.filename} failed verification, discarded")
+    elif username:
+        print(f"[{username}] sent file saved as: {save_path} ({d.filesize} bytes)")
+    else:
+        print(f"Download complete: {save_path} ({d.filesize} bytes)")
 
 def receiver(sock):
+    while sock is not None:
+        read_frames(sock)
+        if quitting.is_set():
+            break
+        sock = reconnect()
+
+def read_frames(sock):
+    global compact
+    reader = FrameReader(sock)
     try:
         while True:
-            raw = recvall(sock, 4)
-            if raw is None:
-                print("Disconnected from server.")
+            header = reader.read_header()
+            if header is None:
+                if not quitting.is_set():
+                    print("Disconnected from server.")
                 break
-            hdr_len = struct.unpack('>I', raw)[0]
-            hdr_bytes = recvall(sock, hdr_len)
-            if hdr_bytes is None:
-                break
-            header = json.loads(hdr_bytes.decode('utf-8'))
             typ = header.get('type')
-            if typ == 'system':
-                print(f"[SYSTEM] {header.get('text')}")
-            elif typ == 'message':
-                print(f"[{header.get('username')}] {header.get('text')}")
+            if not first_time(header):
+                continue
+            if typ in ('system', 'message'):
+                if 'last_seq' in header:
+                    # "Joined #room": the room's frames continue from here
+                    last_seq[header.get('room') or DEFAULT_ROOM] = header['last_seq']
+                print(chat_line(header))
+            elif typ == 'session':
+                on_session(sock, header)
+            elif typ == 'ack':
+                unacked.pop(header.get('id'), None)
+            elif typ == 'history':
+                show_history(header)
+            elif typ == 'search':
+                show_search(header)
+            elif typ == 'presence':
+                apply_presence(header)
+            elif typ == 'features':
+                compact = COMPACT in header.get('features', [])
+            elif typ == 'file_offer_reply':
+                resolve(('offer', header.get('sha256')), header)
+            elif typ == 'upload_status':
+                if not resolve(('upload', header.get('transfer_id')), header) and header.get('error'):
+                    print(f"Upload stopped at {header.get('offset')} bytes ({header.get('error')}); "
+                          f"send the file again to resume")
+            elif typ == 'upload_done':
+                print(f"Upload complete: {header.get('filename')}")
+            elif typ == 'file_error':
+                print(f"Server refused {header.get('filename')}: {header.get('error')}")
             elif typ == 'file':
                 username = header.get('username')
                 filename = header.get('filename')
                 filesize = int(header.get('filesize', 0))
-                # read file binary
-                file_bytes = recvall(sock, filesize)
-                if file_bytes is None:
-                    print("File transfer interrupted")
+                # write the payload to .partial/ as it arrives so a drop can be resumed
+                d = watch(PartialDownload.start(DOWNLOAD_DIR, filename, filesize, header.get('sha256')))
+                if not d.recv_payload(reader):
+                    print(f"File transfer interrupted at {d.offset}/{filesize} bytes (resumes on reconnect)")
+                    break
+                finish_download(d, username)
+            elif typ == 'file_start':
+                d = PartialDownload.start(DOWNLOAD_DIR, header.get('filename'),
+                                          int(header.get('filesize', 0)), header.get('sha256'))
+                incoming[header.get('id')] = (watch(d), header.get('username'))
+            elif typ == 'file_chunk':
+                data = reader.read_exact(int(header.get('size', 0)))
+                if data is None:
+                    break
+                entry = incoming.get(header.get('id'))
+                if entry and not entry[0].append_chunk(int(header.get('offset', -1)), data):
+                    print(f"Out-of-order chunk for {entry[0].filename}, dropping it")
+                    incoming.pop(header.get('id'), None)
+                    entry[0].discard()
+            elif typ == 'file_end':
+                entry = incoming.pop(header.get('id'), None)
+                if not entry:
+                    continue
+                d, username = entry
+                if header.get('error'):
+                    print(f"File {d.filename} from {username} was interrupted ({header.get('error')})")
+                    d.discard()
+                elif d.complete:
+                    d.sha256 = d.sha256 or header.get('sha256')
+                    finish_download(d, username)
+            elif typ == 'file_announce':
+                username = header.get('username')
+                filename = header.get('filename')
+                filesize = int(header.get('filesize', 0))
+                announced[filename] = header
+                if filesize <= AUTO_FETCH_MAX:
+                    start_fetch(sock, header)
+                else:
+                    print(f"[{username}] shared file: {filename} ({filesize} bytes) - /get {filename} to download")
+            elif typ == 'fetch_chunk':
+                data = reader.read_exact(int(header.get('size', 0)))
+                if data is None:
                     break
-                save_path = DOWNLOAD_DIR / filename
-                with open(save_path, 'wb') as f:
-                    f.write(file_bytes)
-                print(f"[{username}] sent file saved as: {save_path} ({filesize} bytes)")
+                d = partials.get(header.get('filename'))
+                if d and not d.append_chunk(int(header.get('offset', -1)), data, header.get('sha256', '')):
+                    print(f"Bad chunk for {d.filename}, will retry on reconnect")
+                    partials.pop(d.filename, None)
+            elif typ == 'fetch_done':
+                d = partials.get(header.get('filename'))
+                if d and header.get('error'):
+                    print(f"Cannot resume {d.filename}: {header.get('error')}")
+                    partials.pop(d.filename, None)
+                    d.discard()
+                elif d and d.complete:
+                    d.sha256 = d.sha256 or header.get('sha256')
+                    ann = announced.pop(d.filename, None)
+                    finish_download(d, ann and ann.get('username'))
             else:
                 print("Unknown incoming header:", header)
     except Exception as e:
@@ -76,50 +412,94 @@ def receiver(sock):
             pass
 
 def main():
+    global current_room, server_sock, username
     username = input("Enter your username: ").strip() or "Anonymous"
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.connect((SERVER_HOST, SERVER_PORT))
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_sock.connect((SERVER_HOST, SERVER_PORT))
     # send join header
-    send_framed(sock, {'type':'join', 'username': username})
-    t = threading.Thread(target=receiver, args=(sock,), daemon=True)
+    join(server_sock)
+    t = threading.Thread(target=receiver, args=(server_sock,), daemon=True)
     t.start()
+    resume_downloads(server_sock)
+    request_history(server_sock, DEFAULT_ROOM)
 
     try:
         while True:
             cmd = input()
             if not cmd:
                 continue
+            # the receiver swaps in a new socket after a reconnect
+            sock = server_sock
             if cmd.startswith('/file '):
                 path = cmd[len('/file '):].strip()
                 if not os.path.isfile(path):
                     print("File not found:", path)
                     continue
-                size = os.path.getsize(path)
-                fname = os.path.basename(path)
-                with open(path, 'rb') as f:
-                    data = f.read()
-                header = {'type':'file', 'filename': fname, 'filesize': size}
-                send_framed(sock, header, data)
-                print(f"Sent file: {fname} ({size} bytes)")
+                # upload in the background so chat keeps flowing
+                threading.Thread(target=send_file, args=(sock, path), daemon=True).start()
+            elif cmd.startswith('/get '):
+                name = cmd[len('/get '):].strip()
+                ann = announced.get(name)
+                if not ann:
+                    print("No shared file named", name)
+                    continue
+                start_fetch(sock, ann)
+                print(f"Downloading {name}...")
+            elif cmd.startswith('/join '):
+                room = cmd[len('/join '):].strip()
+                if room:
+                    send_framed(sock, {'type':'join_room', 'room': room})
+                    current_room = room
+                    request_history(sock, room)
+            elif cmd.startswith('/leave '):
+                room = cmd[len('/leave '):].strip()
+                send_framed(sock, {'type':'leave_room', 'room': room})
+                last_seq.pop(room, None)
+                if room == current_room:
+                    current_room = DEFAULT_ROOM
+            elif cmd.startswith('/room '):
+                current_room = cmd[len('/room '):].strip() or DEFAULT_ROOM
+                print("Sending to", '#' + current_room)
+            elif cmd == '/history':
+                before = oldest_seq.get(current_room)
+                if before == 0:
+                    print(f"(no earlier messages in #{current_room})")
+                    continue
+                request_history(sock, current_room, before)
+            elif cmd.startswith('/search '):
+                words = cmd[len('/search '):].split()
+                header = {'type':'search', 'limit': HISTORY_PAGE}
+                if words and words[0].startswith('@'):
+                    header['username'] = words.pop(0)[1:]
+                header['q'] = ' '.join(words)
+                send_framed(sock, header)
+            elif cmd == '/who':
+                print(f"Online ({len(online)}): {', '.join(sorted(online))}")
+            elif cmd.startswith('/msg '):
+                to, _, text = cmd[len('/msg '):].strip().partition(' ')
+                if to and text:
+                    send_message(sock, {'type':'message', 'to': to, 'text': text})
             elif cmd.startswith('/name '):
                 newname = cmd[len('/name '):].strip()
                 if newname:
                     username = newname
                     print("Local username changed to", username)
                     # optionally inform server (resend join)
-                    send_framed(sock, {'type':'join', 'username': username})
+                    send_framed(sock, {'type':'join', 'username': username, 'features': FEATURES})
             elif cmd == '/quit':
                 print("Quitting...")
                 break
             else:
                 # send as message
-                header = {'type':'message', 'text': cmd}
-                send_framed(sock, header)
+                send_message(sock, in_room({'type':'message', 'text': cmd}))
     except KeyboardInterrupt:
         pass
     finally:
+        quitting.set()
         try:
-            sock.close()
+            # tell the server not to keep our session
+            send_framed(server_sock, {'type':'quit'})
+            server_sock.close()
         except:
             pass
 
@@ -0,0 +1,395 @@
+# cluster.py
+# Federation: several chat server processes acting as one chat
+# Usage: python3 server_tcp.py --port 9009 --cluster-key SECRET --peer 127.0.0.1:9010 --peer 127.0.0.1:9011
+#
+# Every node hands the events its own clients cause (chat in a room, join and
+# leave notices, direct messages, presence, shared files) to a broker, which
+# gets them to the other nodes. Each node then delivers them to its own
+# clients. Events carry "<node>:<seq>" ids and every node remembers the ids
+# it has seen, so an event that reaches a node twice (over two paths, or
+# resent after a link dropped) is delivered once. Nodes forward what they
+# receive to their own peers, so a chain A - B - C works as well as a full
+# mesh.
+#
+# Files are not copied between nodes when shared: the event carries a
+# reference (origin address, name, size, sha256, room). A node pulls the bytes
+# from the origin, with a peer_fetch that carries the cluster key, only when
+# one of its clients (a member of the room) asks for the file or has to be
+# pushed it. A node forwarding the event points it at itself, so files are
+# only ever pulled from a configured peer.
+#
+# Brokers:
+#   PeerBroker   TCP links to the peers' chat ports (--peer). Links are one
+#                way, so two nodes that should talk list each other.
+#   LocalBroker  in-process stand-in, for nodes created in one process.
+#   WorkerBus    Unix-socket links between the --workers of one server
+#                (workers.py); a full mesh, so nothing is forwarded.
+
+import collections
+import hashlib
+import itertools
+import socket
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from framing import FrameReader, encode_header, send_frame, send_parts
+from rooms import DEFAULT_ROOM
+
+SEEN_MAX = 65536          # event ids remembered for de-duplication
+LINK_QUEUE = 10000        # events buffered per peer link while it is down
+RECONNECT_MAX = 10.0      # seconds between reconnect attempts, at most
+FETCH_TIMEOUT = 30.0      # seconds a pull from another node may stall
+
+def parse_addr(text: str) -> Tuple[str, int]:
+    """'host:port' (or just 'port', meaning this machine) -> (host, port)."""
+    host, _, port = text.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+def connect(addr: Union[Tuple[str, int], str], timeout: float) -> socket.socket:
+    """TCP connection to (host, port), or Unix socket connection to a path."""
+    if isinstance(addr, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(addr)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+    sock = socket.create_connection(addr, timeout=timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+class RecentIds:
+    """Bounded set of the last n ids added."""
+
+    def __init__(self, n: int = SEEN_MAX):
+        self.n = n
+        self.ids = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, key: str) -> bool:
+        """Remember key; False if it was already there."""
+        with self.lock:
+            if key in self.ids:
+                return False
+            self.ids[key] = None
+            if len(self.ids) > self.n:
+                self.ids.popitem(last=False)
+            return True
+
+class Cluster:
+    """This node's view of the cluster.
+
+    deliver(event) is called for every event from another node, once; the
+    server turns it into frames for its own clients. store is the node's
+    BlobStore, where files pulled from other nodes end up. With shared_store
+    all nodes use the same upload directory, so files are never pulled.
+    """
+
+    def __init__(self, node_id: str, advertise: str, broker, store, deliver: Callable, key: str = '',
+                 shared_store: bool = False):
+        self.node_id = node_id
+        self.advertise = advertise      # host:port other nodes fetch files from
+        self.broker = broker
+        self.store = store
+        self.deliver = deliver
+        self.key = key
+        self.shared_store = shared_store
+        self._seq = itertools.count(1)
+        self.seen = RecentIds()
+        self.lock = threading.Lock()
+        self.local_users = set()
+        self.remote_users: Dict[str, str] = {}      # username -> node
+        self.files: Dict[str, Dict] = {}            # local name -> file event not pulled yet
+        self._pulls: Dict[str, threading.Lock] = {}
+
+    def start(self):
+        self.broker.start(self)
+        print(f"[cluster] node {self.node_id} up, files served from {self.advertise}")
+
+    # ------------------------------------------------------------ outgoing
+
+    def publish(self, kind: str, **fields):
+        """Send an event caused by one of our clients to the other nodes."""
+        event = dict(fields, kind=kind, origin=self.node_id, id=f"{self.node_id}:{next(self._seq)}")
+        self.seen.add(event['id'])
+        self.broker.publish(event)
+
+    def user_online(self, username: str):
+        with self.lock:
+            self.local_users.add(username)
+        self.publish('presence', users=[username], online=True)
+
+    def user_offline(self, username: str):
+        with self.lock:
+            self.local_users.discard(username)
+        self.publish('presence', users=[username], online=False)
+
+    def snapshot(self) -> Dict:
+        """Presence of all our users; sent whenever a link (re)connects."""
+        with self.lock:
+            users = sorted(self.local_users)
+        return {'kind': 'presence', 'users': users, 'snapshot': True, 'origin': self.node_id,
+                'id': f"{self.node_id}:{next(self._seq)}"}
+
+    def has_user(self, username: str) -> bool:
+        with self.lock:
+            return username in self.remote_users
+
+    def remote_names(self) -> List[str]:
+        """Users online on the other nodes."""
+        with self.lock:
+            return list(self.remote_users)
+
+    # ------------------------------------------------------------ incoming
+
+    def receive(self, event: Dict):
+        """An event from a peer: drop repeats, pass it on, deliver it here."""
+        if event.get('origin') == self.node_id or not self.seen.add(event.get('id', '')):
+            return
+        kind = event.get('kind')
+        if kind == 'file':
+            if not self._add_file(event):
+                return
+            if self.broker.forwards:
+                # our peers may not reach the node it came from: they pull it from us, by our name
+                self.broker.publish(dict({k: v for k, v in event.items() if k != 'name'},
+                                         addr=self.advertise, filename=event['name']))
+        elif self.broker.forwards:
+            self.broker.publish(event)
+        if kind == 'presence':
+            self._presence(event)
+        self.deliver(event)
+
+    def serve_peer(self, reader: FrameReader, hello: Dict):
+        """Read events from an inbound peer link until it closes (threaded engine)."""
+        node = hello.get('node')
+        print(f"[cluster] link from node {node}")
+        try:
+            while True:
+                header = reader.read_header()
+                if header is None:
+                    break
+                if header.get('type') == 'cluster':
+                    self.receive(header)
+        finally:
+            self.peer_lost(node)
+
+    def peer_lost(self, node: str):
+        print(f"[cluster] link from node {node} closed")
+        with self.lock:
+            for name in [u for u, n in self.remote_users.items() if n == node]:
+                del self.remote_users[name]
+
+    def _presence(self, event: Dict):
+        node = event.get('origin')
+        with self.lock:
+            if event.get('snapshot'):
+                for name in [u for u, n in self.remote_users.items() if n == node]:
+                    del self.remote_users[name]
+            for name in event.get('users', []):
+                if event.get('online', True):
+                    self.remote_users[name] = node
+                elif self.remote_users.get(name) == node:
+                    del self.remote_users[name]
+
+    # ------------------------------------------------------------ files
+
+    def _add_file(self, event: Dict) -> bool:
+        """Give a file shared on another node a local name; event['name'] is set to it.
+        False (and the event dropped) if it would be pulled from a node that is not our peer,
+        or its name here points at other content."""
+        sha256, size = event.get('sha256', ''), int(event.get('filesize', 0))
+        room = event.get('room') or DEFAULT_ROOM
+        if self.shared_store:
+            # the origin already stored and indexed it under this name
+            event['name'] = event.get('filename')
+            return self.store.remember(event['name'], sha256, size, room)
+        if not self.broker.knows(event.get('addr', '')):
+            print(f"[cluster] file {event.get('filename')!r} from unknown address {event.get('addr')!r} dropped")
+            return False
+        name = self.store.reserve_name(event.get('filename', 'file.bin'), sha256)
+        event['name'] = name
+        if self.store.lookup(sha256, size):
+            self.store.record(name, sha256, size, room)    # same bytes are here already
+            return True
+        with self.lock:
+            self.files[name] = event
+        return True
+
+    def has_file(self, name: str) -> bool:
+        with self.lock:
+            return name in self.files
+
+    def file_rooms(self, name: str) -> List[str]:
+        """The room a file shared on another node, and not pulled yet, went to."""
+        with self.lock:
+            event = self.files.get(name)
+        return [event.get('room') or DEFAULT_ROOM] if event else []
+
+    def ensure_local(self, name: str) -> Optional[Tuple[str, int]]:
+        """(sha256, size) of name in the local store, pulling it from its node first if needed.
+
+        Blocks for the whole pull; one pull per name at a time.
+        """
+        with self.lock:
+            lock = self._pulls.setdefault(name, threading.Lock())
+        with lock:
+            entry = self.store.resolve(name)
+            if entry:
+                return entry
+            with self.lock:
+                event = self.files.get(name)
+            if event is None:
+                return None
+            if self._pull(name, event):
+                with self.lock:
+                    self.files.pop(name, None)
+                return self.store.resolve(name)
+            return None
+
+    def _pull(self, name: str, event: Dict) -> bool:
+        sha256, size = event.get('sha256', ''), int(event.get('filesize', 0))
+        tmp_path, f = self.store.begin()
+        ok = False
+        try:
+            with socket.create_connection(parse_addr(event['addr']), timeout=FETCH_TIMEOUT) as sock:
+                # no join: the cluster key lets a node fetch what was shared in any room
+                send_frame(sock, {'type': 'peer_fetch', 'filename': event.get('filename'), 'offset': 0,
+                                  'key': self.key})
+                reader = FrameReader(sock)
+                hasher = hashlib.sha256()
+                got = 0
+                while True:
+                    header = reader.read_header()
+                    if header is None:
+                        break
+                    if header.get('type') == 'fetch_chunk':
+                        data = reader.read_exact(int(header.get('size', 0)))
+                        if data is None or int(header.get('offset', -1)) != got \
+                                or hashlib.sha256(data).hexdigest() != header.get('sha256'):
+                            break
+                        f.write(data)
+                        hasher.update(data)
+                        got += len(data)
+                    elif header.get('type') == 'fetch_done':
+                        ok = not header.get('error') and got == size and hasher.hexdigest() == sha256
+                        break
+        except (OSError, ValueError) as e:
+            print(f"[cluster] pulling {name} from {event.get('addr')} failed: {e}")
+        finally:
+            f.close()
+        if not ok:
+            self.store.abort(name, tmp_path)
+            return False
+        self.store.commit(name, tmp_path, sha256, size, room=event.get('room') or DEFAULT_ROOM)
+        print(f"[cluster] pulled {name} ({size} bytes) from node {event.get('origin')}")
+        return True
+
+# -------------------------------------------------------------------- brokers
+
+class PeerLink:
+    """Outbound link to one peer: a thread sending queued events, reconnecting as needed."""
+
+    def __init__(self, addr: Union[Tuple[str, int], str], key: str = ''):
+        self.addr = addr
+        self.key = key
+        self.queue = collections.deque(maxlen=LINK_QUEUE)   # oldest events go first when full
+        self.cond = threading.Condition()
+
+    @property
+    def name(self) -> str:
+        return self.addr if isinstance(self.addr, str) else f'{self.addr[0]}:{self.addr[1]}'
+
+    def start(self, cluster: Cluster):
+        self.cluster = cluster
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def put(self, frame: bytes):
+        with self.cond:
+            self.queue.append(frame)
+            self.cond.notify()
+
+    def _run(self):
+        delay = 0.5
+        while True:
+            try:
+                sock = connect(self.addr, timeout=5)
+            except OSError:
+                time.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX)
+                continue
+            delay = 0.5
+            try:
+                sock.settimeout(None)
+                send_frame(sock, {'type': 'peer_hello', 'node': self.cluster.node_id, 'key': self.key})
+                send_frame(sock, dict(self.cluster.snapshot(), type='cluster'))
+                print(f"[cluster] linked to {self.name}")
+                self._pump(sock)
+            except OSError:
+                pass
+            finally:
+                sock.close()
+            print(f"[cluster] link to {self.name} lost, reconnecting")
+
+    def _pump(self, sock: socket.socket):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                batch = list(self.queue)
+                self.queue.clear()
+            try:
+                send_parts(sock, batch)
+            except OSError:
+                # resend after reconnecting; the peer drops what it already has
+                with self.cond:
+                    self.queue.extendleft(reversed(batch))
+                raise
+
+class PeerBroker:
+    """Events go to every --peer over its PeerLink; inbound links are served by the chat server."""
+
+    forwards = True     # pass received events on: peers need not form a full mesh
+
+    def __init__(self, peers: List[Union[Tuple[str, int], str]], key: str = ''):
+        self.links = [PeerLink(addr, key) for addr in peers]
+
+    def start(self, cluster: Cluster):
+        for link in self.links:
+            link.start(cluster)
+
+    def publish(self, event: Dict):
+        frame = encode_header(dict(event, type='cluster'))
+        for link in self.links:
+            link.put(frame)
+
+    def knows(self, addr: str) -> bool:
+        """Is addr ('host:port') one of our peers? Files are only pulled from those."""
+        try:
+            return parse_addr(addr) in [link.addr for link in self.links]
+        except (AttributeError, ValueError):
+            return False
+
+class LocalBroker:
+    """In-process stand-in for PeerBroker: every node started on the same hub sees the others."""
+
+    forwards = False
+
+    def __init__(self, hub: list = None):
+        self.hub = hub if hub is not None else []
+        self.cluster = None
+
+    def start(self, cluster: Cluster):
+        self.cluster = cluster
+        self.hub.append(cluster)
+
+    def publish(self, event: Dict):
+        for other in list(self.hub):
+            if other is not self.cluster:
+                other.receive(dict(event))
+
+    def knows(self, addr: str) -> bool:
+        return any(other.advertise == addr for other in self.hub if other is not self.cluster)
@@ -0,0 +1,242 @@
+# framing.py
+# Frame codec shared by the server, the clients and the web bridge
+#
+# Wire format (see protocols.md): [4-byte big-endian header length][header][payload].
+# The header is JSON, or, between peers that agreed on it at join (feature
+# 'compact'), a fixed binary layout for the frequent frame types.
+#
+# FrameReader keeps one receive buffer per connection and fills it with
+# recv_into(), so reading a header allocates nothing but the decoded dict,
+# and payloads can be read straight into the caller's own buffer.
+# send_frame() hands length, header and payload to the kernel in a single
+# call: small frames are joined into one buffer, large payloads go out
+# uncopied next to the header with sendmsg() (writev).
+
+import json
+import socket
+import struct
+from typing import Dict, Optional, Sequence, Tuple
+
+HDR = struct.Struct('>I')
+BUFFER_SIZE = 256 * 1024      # per-connection receive buffer
+MAX_HEADER = 1024 * 1024      # larger header lengths are a protocol error
+IOV_MAX = 1024                # buffers per sendmsg() call
+COPY_MAX = 16 * 1024          # payloads smaller than this are copied into the header buffer
+HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')   # not on Windows
+
+# ------------------------------------------------------------ compact headers
+#
+# [tag byte][int fields, 8 bytes each][string lengths, 4 bytes each][utf-8 strings]
+#
+# A tag names the frame type and its exact set of fields. Headers that do not
+# match a schema (extra fields, other types) are sent as JSON, which always
+# starts with '{', so a reader can take either form. Tags are part of the
+# protocol: add new ones at the end, never renumber (and stay below 0x20).
+
+COMPACT = 'compact'           # join feature asking for compact headers
+
+class Schema:
+    def __init__(self, tag: int, type: str, ints: Tuple[str, ...] = (), strs: Tuple[str, ...] = ()):
+        self.tag = tag
+        self.type = type
+        self.ints = ints
+        self.strs = strs
+        self.fields = len(ints) + len(strs) + 1     # + 'type'
+        self.fixed = struct.Struct('>B' + 'q' * len(ints) + 'I' * len(strs))
+
+SCHEMAS = [
+    Schema(1, 'message', strs=('username', 'text')),      # server -> client
+    Schema(2, 'message', strs=('text',)),                 # client -> server
+    Schema(3, 'system', strs=('text',)),
+    Schema(4, 'file_chunk', ints=('offset', 'size'), strs=('id',)),
+    Schema(5, 'file_end', ints=('filesize',), strs=('id', 'sha256')),
+    Schema(6, 'fetch_chunk', ints=('offset', 'size'), strs=('filename', 'sha256')),
+    Schema(7, 'upload_chunk', ints=('offset', 'size'), strs=('transfer_id', 'sha256')),
+    Schema(8, 'message', strs=('username', 'text', 'room')),
+    Schema(9, 'message', strs=('text', 'room')),
+    Schema(10, 'message', strs=('username', 'text', 'to')),
+    Schema(11, 'message', strs=('text', 'to')),
+    Schema(12, 'system', strs=('text', 'room')),
+    # room frames carry their seq, and a client with a session numbers its messages
+    Schema(13, 'message', ints=('seq',), strs=('username', 'text')),
+    Schema(14, 'message', ints=('seq',), strs=('username', 'text', 'room')),
+    Schema(15, 'message', ints=('id',), strs=('text',)),
+    Schema(16, 'message', ints=('id',), strs=('text', 'room')),
+    Schema(17, 'message', ints=('id',), strs=('text', 'to')),
+    Schema(18, 'system', ints=('seq',), strs=('text',)),
+    Schema(19, 'system', ints=('seq',), strs=('text', 'room')),
+    Schema(20, 'ack', ints=('id', 'seq')),
+    Schema(21, 'file_announce', ints=('filesize', 'seq'),
+           strs=('id', 'username', 'filename', 'orig_filename', 'sha256')),
+    Schema(22, 'file_announce', ints=('filesize', 'seq'),
+           strs=('id', 'username', 'filename', 'orig_filename', 'sha256', 'room')),
+]
+_by_tag = {s.tag: s for s in SCHEMAS}
+_by_type: Dict[str, list] = {}
+for _s in SCHEMAS:
+    _by_type.setdefault(_s.type, []).append(_s)
+
+def _encode_compact(header: Dict) -> Optional[bytes]:
+    for s in _by_type.get(header.get('type'), ()):
+        if len(header) != s.fields:
+            continue
+        try:
+            ints = [header[k] for k in s.ints]
+            strs = [header[k].encode('utf-8') for k in s.strs]
+            if not all(type(v) is int for v in ints):
+                continue
+            return s.fixed.pack(s.tag, *ints, *map(len, strs)) + b''.join(strs)
+        except (KeyError, AttributeError, struct.error):
+            continue
+    return None
+
+def decode_header(data) -> Dict:
+    """Header from its encoded bytes (bytes, bytearray or memoryview), JSON or compact."""
+    if not data or data[0] >= 0x20:
+        return json.loads(str(data, 'utf-8'))
+    s = _by_tag.get(data[0])
+    if s is None:
+        raise ValueError(f"unknown compact header tag {data[0]}")
+    values = s.fixed.unpack_from(data)
+    n = len(s.ints)
+    header = {'type': s.type}
+    header.update(zip(s.ints, values[1:n + 1]))
+    pos = s.fixed.size
+    for k, size in zip(s.strs, values[n + 1:]):
+        header[k] = str(data[pos:pos + size], 'utf-8')
+        pos += size
+    return header
+
+# --------------------------------------------------------------------- frames
+
+def encode_header(header: Dict, compact: bool = False) -> bytes:
+    """[4-byte header_len][header], ready to queue; the optional payload follows it.
+
+    compact asks for the binary layout where the header fits one; only use it
+    for a peer that joined with the 'compact' feature.
+    """
+    header_bytes = (compact and _encode_compact(header)) or json.dumps(header).encode('utf-8')
+    return HDR.pack(len(header_bytes)) + header_bytes
+
+def send_parts(sock: socket.socket, parts: Sequence) -> None:
+    """Write byte buffers back to back with as few syscalls as possible."""
+    if len(parts) == 1:
+        sock.sendall(parts[0])
+        return
+    if not HAVE_SENDMSG:
+        for p in parts:
+            if p:
+                sock.sendall(p)
+        return
+    views = [memoryview(p) for p in parts if p]
+    i = 0
+    while i < len(views):
+        sent = sock.sendmsg(views[i:i + IOV_MAX])
+        # skip the buffers that went out whole, trim the one cut short
+        while i < len(views) and sent >= views[i].nbytes:
+            sent -= views[i].nbytes
+            i += 1
+        if sent:
+            views[i] = views[i][sent:]
+
+def send_frame(sock: socket.socket, header: Dict, payload: bytes = None, lock=None,
+               compact: bool = False) -> None:
+    """Send one frame. lock, if given, is held for the whole frame."""
+    frame = encode_header(header, compact)
+    if not payload or len(payload) < COPY_MAX:
+        # one small buffer beats building an iovec
+        parts = (frame + payload if payload else frame,)
+    else:
+        parts = (frame, payload)
+    if lock is None:
+        send_parts(sock, parts)
+        return
+    with lock:
+        send_parts(sock, parts)
+
+class FrameReader:
+    """Buffered reader for one connection's frames (blocking socket).
+
+    Once a connection has a FrameReader every read must go through it, since
+    it may already hold the start of the next frame. It also offers
+    recv_into(), so it can stand in for the socket in code that streams a
+    payload (relay.recv_to_file, transfers.PartialDownload.recv_payload).
+    """
+
+    def __init__(self, sock: socket.socket, bufsize: int = BUFFER_SIZE):
+        self.sock = sock
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+        self.start = 0      # first unread byte
+        self.end = 0        # end of received data
+        self.received = 0   # bytes read from the socket so far
+
+    def _fill(self, n: int) -> bool:
+        """Have at least n (<= bufsize) unread bytes buffered; False on EOF."""
+        if self.end - self.start >= n:
+            return True
+        if self.start + n > len(self.buf):
+            # move the unread tail to the front
+            size = self.end - self.start
+            self.view[:size] = self.view[self.start:self.end]
+            self.start, self.end = 0, size
+        while self.end - self.start < n:
+            got = self.sock.recv_into(self.view[self.end:])
+            if not got:
+                return False
+            self.end += got
+            self.received += got
+        return True
+
+    def read_header(self) -> Optional[Dict]:
+        """Next frame's header, or None if the peer closed the connection."""
+        if not self._fill(4):
+            return None
+        (n,) = HDR.unpack_from(self.buf, self.start)
+        if n > MAX_HEADER:
+            raise ValueError(f"header of {n} bytes")
+        self.start += 4
+        if n > len(self.buf):
+            data = self.read_exact(n)
+            return None if data is None else decode_header(data)
+        if not self._fill(n):
+            return None
+        # decode straight from the buffer, no intermediate bytes object
+        header = decode_header(self.view[self.start:self.start + n])
+        self.start += n
+        return header
+
+    def read_exact(self, n: int):
+        """Next n bytes (bytes-like), or None if the connection closed first.
+        A negative n (a size from a bad header) raises ValueError: a protocol error."""
+        if n < 0:
+            raise ValueError(f"read of {n} bytes")
+        if n <= len(self.buf):
+            if not self._fill(n):
+                return None
+            data = self.buf[self.start:self.start + n]
+            self.start += n
+            return data
+        data = bytearray(n)
+        view = memoryview(data)
+        got = 0
+        while got < n:
+            r = self.recv_into(view[got:])
+            if not r:
+                return None
+            got += r
+        return data
+
+    def recv_into(self, buffer, nbytes: int = 0) -> int:
+        """socket.recv_into() semantics: buffered bytes first, then the socket directly."""
+        view = memoryview(buffer)
+        n = nbytes or view.nbytes
+        avail = self.end - self.start
+        if avail:
+            k = min(n, avail)
+            view[:k] = self.view[self.start:self.start + k]
+            self.start += k
+            return k
+        got = self.sock.recv_into(view, n)
+        self.received += got
+        return got
@@ -0,0 +1,773 @@
+# hub.py
+# Frame handling shared by the two server engines
+#
+# server_tcp.py (a thread per client) and server_async.py (one event loop)
+# differ only in how they read and write sockets. What a frame does once its
+# header is read - joins, rooms, chat and acks, file offers and shares,
+# fetches, history, search - is done here, by the Hub holding the chat state
+# of the process. Frames that read a payload or take over the connection
+# (file, upload_chunk, peer_hello, mux_hello) are read by the engine, which
+# calls the hub before and after.
+#
+# Work that may block (hashing a finished upload, reading history pages and
+# index pages, pulling a file from another node) goes through two hooks the
+# engine provides:
+#   blocking(client, fn, args, then)   then(fn(*args)) before client's next frame is handled
+#   background(fn, args, then)         then(fn(*args)) later, holding up no one
+# The defaults suit the threaded engine: inline, and on a thread of its own.
+
+import hashlib
+import hmac
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from relay import UploadStream
+from lanes import Bulk, TokenBucket, new_transfer_id, stream_frames
+from framing import COMPACT, encode_header
+from rooms import DEFAULT_ROOM, Rooms, Users, tag_room, target_room, valid_room
+from cluster import Cluster, PeerBroker, parse_addr
+import workers
+from msglog import MessageLog, open_history
+from sessions import SESSION_TTL, RoomFeed, Session, Sessions
+from search import SearchIndex, open_search, search_reply
+from presence import Presence
+from blobstore import BlobStore
+from transfers import Staging, FetchReply, MAX_CHUNK_SIZE, new_challenge, range_proof, sha256_file
+from metrics import BROADCAST_SECONDS, FRAMES_OUT, SLOW_CONSUMERS, TRANSFER_SECONDS, TimedLock, timed_frames
+
+MUX_QUEUE_FACTOR = 64       # a bridge's mux link queues this many times --queue-size frames
+MAX_OFFERS = 8              # file_offers per client waiting for their proof
+PAYLOAD_FRAMES = ('file', 'upload_chunk')   # a payload follows the header (read by the engine)
+# frame type -> (fields that must be strings, fields that must be ints) when present; a frame
+# with another type in one of them gets a system error instead of being acted on
+FIELD_TYPES = {
+    'join': (('username',), ()),
+    'message': (('text', 'to', 'room'), ()),
+    'join_room': (('room',), ()),
+    'leave_room': (('room',), ()),
+    'file_offer': (('filename', 'sha256', 'room'), ('filesize',)),
+    'upload_begin': (('transfer_id', 'filename', 'room'), ('filesize',)),
+    'fetch': (('filename',), ('offset',)),
+    'peer_fetch': (('filename',), ('offset',)),
+    'history': (('room',), ('before', 'after', 'limit')),
+    'search': (('q', 'room', 'username'), ('limit',)),
+}
+
+class Client:
+    """One connection (or one user behind a mux link). outq is the engine's outbound queue."""
+
+    def __init__(self, addr: Tuple[str, int], outq, bulk_rate: float = 0, bus: bool = False):
+        self.addr = addr
+        self.bus = bus          # accepted on this worker's bus socket, not the chat port
+        self.username = None
+        self.pull = False       # gets file_announce instead of file payloads
+        self.chunks = False     # gets pushed files as interleaved file_chunk frames
+        self.compact = False    # gets compact binary headers (framing.COMPACT)
+        self.presence = False   # gets the roster and its changes (see presence.py)
+        self.rooms = set()      # names of the rooms joined; only its own handler changes it
+        self.upload_rooms = {}  # resumable transfer_id -> room the file goes to
+        self.offers = {}        # sha256 -> file_offer waiting for its file_proof (see Hub.handle)
+        self.session: Session = None    # set for clients that joined with "resume"
+        self.ingest = TokenBucket(bulk_rate)    # paces this client's uploads
+        self.vid = None         # set for a user behind a bridge's mux link (VirtualClient)
+        self.pending = None     # asyncio engine: blocking work to finish before its next frame
+        self.outq = outq
+
+class VirtualClient(Client):
+    """A user behind a web bridge's mux link (see Hub.mux_client). It has no connection of
+    its own; its frames go out on the link."""
+
+    def __init__(self, link: Client, vid):
+        super().__init__(link.addr, link.outq, link.ingest.rate)
+        self.vid = vid
+
+class FileUpload:
+    """A legacy 'file' upload while the engine reads its payload into f."""
+
+    def __init__(self, client: Client, filename: str, name: str, filesize: int, room: Optional[str],
+                 tmp_path: Path, f):
+        self.client = client
+        self.filename = filename
+        self.name = name
+        self.filesize = filesize
+        self.room = room
+        self.tmp_path = tmp_path
+        self.f = f
+        # recipients get the header now and follow the file as it is written
+        self.stream = UploadStream(tmp_path, filesize)
+        self.hasher = hashlib.sha256()
+        self.started = time.perf_counter()
+
+def bad_field(header: Dict, strs=(), ints=()) -> Optional[str]:
+    """The first of strs / ints that header has with another type (a bool is not an int)."""
+    for key in strs:
+        if header.get(key) is not None and not isinstance(header[key], str):
+            return key
+    for key in ints:
+        if header.get(key) is not None and type(header[key]) is not int:
+            return key
+    return None
+
+def run_inline(client: Client, fn: Callable, args: tuple, then: Callable):
+    then(fn(*args))
+
+def run_thread(fn: Callable, args: tuple, then: Callable):
+    threading.Thread(target=lambda: then(fn(*args)), daemon=True).start()
+
+class Hub:
+    """The chat state of one server process, and what frames from its clients do to it."""
+
+    def __init__(self, store: BlobStore, staging: Staging, file_delivery: str = 'push',
+                 msglog: MessageLog = None, search: SearchIndex = None, session_ttl: float = SESSION_TTL,
+                 blocking: Callable = run_inline, background: Callable = run_thread, resumable: bool = True):
+        self.store = store              # content-addressed uploads + name index
+        self.staging = staging          # resumable uploads until complete
+        self.file_delivery = file_delivery      # push | announce (--file-delivery)
+        self.msglog = msglog            # room history (see msglog.py), unless --no-history
+        self.search = search            # full-text index of the history (see search.py)
+        self.feed = RoomFeed(msglog)    # per-room seqs and recent frames (see sessions.py)
+        self.sessions = Sessions(session_ttl)   # resumable sessions of dropped clients
+        # off for --workers: a session lives in one worker, and the reconnect may reach another
+        self.resumable = resumable
+        self.presence = Presence()      # who is online, for the clients' user lists (see presence.py)
+        self.cluster: Cluster = None    # set when this node has --peer nodes or --workers
+        # Fan-out goes by room (see rooms.py), direct messages by username
+        self.rooms = Rooms()
+        self.users = Users()
+        # Connected (joined) clients. The lock only guards membership; it is never held across I/O.
+        self.clients = set()
+        self.clients_lock = TimedLock('clients')
+        self.blocking = blocking
+        self.background = background
+
+    def start_cluster(self, args, port: int, worker: int = None, bus_dir: str = None, deliver: Callable = None):
+        """Join the other --workers, or the --peer nodes; deliver defaults to on_cluster_event."""
+        deliver = deliver or self.on_cluster_event
+        if worker is not None:
+            self.cluster = workers.worker_cluster(bus_dir, worker, args.workers, f'127.0.0.1:{port}',
+                                                  self.store, deliver)
+        elif args.peer:
+            broker = PeerBroker([parse_addr(p) for p in args.peer], args.cluster_key)
+            self.cluster = Cluster(args.node_id, args.advertise, broker, self.store, deliver, args.cluster_key)
+        else:
+            return
+        self.cluster.start()
+        self.presence.remote = self.cluster.remote_names
+
+    def close(self):
+        if self.search:
+            self.search.close()
+        if self.msglog:
+            self.msglog.close()
+
+    # ------------------------------------------------------------ sending
+
+    def send_framed(self, client: Client, header: Dict, payload: bytes = None):
+        """Queue one frame for a single client (written by its writer)."""
+        if client.vid is not None:
+            header = dict(header, vid=client.vid)
+        client.outq.put(encode_header(header, client.compact), payload)
+        FRAMES_OUT.inc(1, (header.get('type'),))
+
+    def room_of(self, client: Client, header: Dict) -> Optional[str]:
+        """Room a frame is posted to; None (after telling the client) if it is not a member."""
+        room = target_room(client, header)
+        if room is None:
+            self.send_framed(client, {'type':'system', 'text': f"You are not in #{header.get('room')}"})
+        return room
+
+    def send_to(self, targets, header: Dict, payload: bytes = None):
+        """Queue one frame for several clients; only enqueues, never waits for the network."""
+        # encode once per header format, not once per recipient
+        frames = {}
+        links = {}      # (mux link queue, compact) -> vids of its users among targets
+        queued = 0
+        for c in targets:
+            if c.outq.closed:
+                continue
+            if c.vid is not None:
+                links.setdefault((c.outq, c.compact), []).append(c.vid)
+                continue
+            frame = frames.get(c.compact)
+            if frame is None:
+                frame = frames[c.compact] = encode_header(header, c.compact)
+            if c.outq.put(frame, payload):
+                queued += 1
+            else:
+                SLOW_CONSUMERS.inc()
+                print(f"Disconnecting slow consumer {c.addr} ({c.username}): outbound queue full")
+        for (outq, compact), vids in links.items():
+            # one copy per bridge; it hands the frame to each of vids
+            if outq.put(encode_header(dict(header, vids=vids), compact), payload):
+                queued += len(vids)
+            else:
+                SLOW_CONSUMERS.inc()
+                print(f"Disconnecting slow mux link ({len(vids)} users): outbound queue full")
+        FRAMES_OUT.inc(queued, (header.get('type'),))
+
+    def broadcast_except(self, sender: Optional[Client], header: Dict, payload: bytes = None, where=None,
+                         room: str = DEFAULT_ROOM):
+        """Send to everyone in room but the sender; room None reaches no one."""
+        with BROADCAST_SECONDS.time():
+            # a snapshot of the room's members, enqueued outside its lock
+            targets = [c for c in self.rooms.members(room)
+                       if c is not sender and (where is None or where(c))]
+            self.send_to(targets, header, payload)
+
+    def post_room(self, sender: Optional[Client], header: Dict, room: str, where=None,
+                  relay: bool = True) -> int:
+        """Number header in room's feed (and history) and send it to the members but the sender.
+        Unless relay is off the other nodes get it too. Returns its seq."""
+        def deliver(h):
+            self.broadcast_except(sender, h, None, where=where, room=room)
+            if self.search:
+                self.search.add(room, h)     # still in seq order
+        seq = self.feed.post(room, header, deliver)
+        if relay and self.cluster:
+            self.cluster.publish('room', rooms=[room], frame=header)
+        return seq
+
+    # ------------------------------------------------------------ rooms and sessions
+
+    def join_room(self, client: Client, room: str) -> int:
+        """Add client to room; returns the room's seq at that point. Every later frame of the
+        room reaches the client, so seqs it sees from the room continue from there."""
+        with self.feed.ring(room).lock:
+            if self.rooms.join(room, client):
+                client.rooms.add(room)
+            return self.feed.last_seq(room)
+
+    def announce_left(self, username: str, rooms):
+        print(f"{username} disconnected")
+        for room in sorted(rooms):
+            text = f'{username} left' if room == DEFAULT_ROOM else f'{username} left #{room}'
+            self.post_room(None, tag_room({'type':'system', 'text': text}, room), room)
+        self.presence.offline(username)
+        if self.cluster:
+            self.cluster.user_offline(username)
+
+    def resume_session(self, client: Client, session: Session, seqs: Dict):
+        """Put a returning client back in its rooms, send what it missed there, then what was held.
+        Frames older than the in-memory ring are read from the history log first, off the loop."""
+        after = {}
+        for room in session.rooms:
+            seq = seqs.get(room)
+            after[room] = seq if type(seq) is int else self.feed.last_seq(room)
+        run = self.blocking if self.msglog else run_inline
+        run(client, self.feed.older, (after,), lambda older: self._replay(client, session, after, older))
+
+    def _replay(self, client: Client, session: Session, after: Dict, older: Dict):
+        for room in session.rooms:
+            with self.feed.ring(room).lock:
+                # nothing is posted to the room between the join and the replay
+                if self.rooms.join(room, client):
+                    client.rooms.add(room)
+                frames = older.get(room) or []
+                recent, complete = self.feed.since(room, frames[-1]['seq'] if frames else after[room])
+                if older.get(room) is None or not complete:
+                    self.send_framed(client, tag_room({'type':'system',
+                                                       'text': f'Some messages in #{room} were missed (see /history)'},
+                                                      room))
+                for h in frames + recent:
+                    if h.get('type') != 'message' or h.get('username') != session.username:
+                        self.send_framed(client, h)
+        while session.held:
+            self.send_framed(client, session.held.popleft())
+
+    def flush_presence(self):
+        """Tell clients who came and went (the engine calls this every FLUSH_INTERVAL)."""
+        def send(frame):
+            # under the roster lock: a client that joins now gets its snapshot either before
+            # this (and is among the targets) or after it (with the new roster)
+            with self.clients_lock:
+                targets = [c for c in self.clients if c.presence]
+            self.send_to(targets, frame)
+        self.presence.flush(send)
+
+    def expire_sessions(self):
+        """Users whose dropped session was not resumed in time leave for good (called every second)."""
+        for session in self.sessions.expired():
+            self.announce_left(session.username, session.rooms)
+
+    def queue_depths(self) -> List[Dict]:
+        """Per-client outbound queue depth, deepest (most lagging) first."""
+        with self.clients_lock:
+            snapshot = list(self.clients)
+        rows = [{'username': c.username, 'addr': f'{c.addr[0]}:{c.addr[1]}',
+                 'depth': c.outq.depth, 'dropped': c.outq.dropped} for c in snapshot]
+        return sorted(rows, key=lambda r: r['depth'], reverse=True)
+
+    def mux_client(self, link: Client, users: Dict, header: Dict) -> Optional[Client]:
+        """The user behind a bridge's mux link a frame is from (its 'vid' is taken off the
+        header). users is the link's vid -> VirtualClient; a user appears with its join."""
+        vid = header.pop('vid', None)
+        client = users.get(vid)
+        if client is None:
+            if vid is None or header.get('type') != 'join':
+                return None
+            client = users[vid] = VirtualClient(link, vid)
+        return client
+
+    def drop_client(self, client: Client):
+        """Remove a gone client from the clients table, its rooms and the username index.
+        The engine closes the connection itself."""
+        with self.clients_lock:
+            self.clients.discard(client)
+        if client.vid is None:
+            client.outq.close()
+        for room in client.rooms:
+            self.rooms.leave(room, client)
+        username = client.username
+        if username:
+            self.users.remove(username, client)
+            if client.session:
+                # the others hear nothing yet, and direct messages wait, in case it comes back
+                self.sessions.detach(client.session, client.rooms)
+                print(f"{username} dropped; session kept for {self.sessions.ttl:.0f}s")
+            else:
+                self.announce_left(username, client.rooms)
+        client.rooms.clear()
+
+    # ------------------------------------------------------------ cluster
+
+    def on_cluster_event(self, event: Dict):
+        """Deliver an event from another node to our own clients (called once per event)."""
+        kind = event.get('kind')
+        if kind == 'room':
+            for room in event.get('rooms', []):
+                # numbered again by our own feed
+                self.post_room(None, dict(event.get('frame')), room, relay=False)
+        elif kind == 'direct':
+            target = self.users.get(event.get('to'))
+            if target:
+                self.send_framed(target, event.get('frame'))
+            else:
+                self.sessions.hold(event.get('to'), event.get('frame'))
+        elif kind == 'file':
+            room = event.get('room') or DEFAULT_ROOM
+            members = self.rooms.members(room)
+            ann = {
+                'type':'file_announce',
+                'id': event.get('sha256'),
+                'username': event.get('username'),
+                'filename': event['name'],
+                'orig_filename': event.get('orig_filename'),
+                'filesize': event.get('filesize'),
+                'sha256': event.get('sha256')
+            }
+            self.post_room(None, tag_room(ann, room), room, where=lambda c: c.pull, relay=False)
+            if any(not c.pull for c in members):
+                # push clients need the bytes, so pull them here now
+                self.background(self.cluster.ensure_local, (event['name'],),
+                                lambda entry: self.push_remote_file(event, room, entry))
+
+    def push_remote_file(self, event: Dict, room: str, entry: Optional[Tuple[str, int]]):
+        if entry is None:
+            return
+        sha256, filesize = entry
+        out_hdr = {
+            'type':'file',
+            'username': event.get('username'),
+            'filename': event['name'],
+            'orig_filename': event.get('orig_filename'),
+            'filesize': filesize,
+            'sha256': sha256
+        }
+        self.push_file(None, tag_room(out_hdr, room),
+                       UploadStream.complete(self.store.blob_path(sha256), filesize), room)
+
+    def admit_peer(self, client: Client, hello: Dict) -> bool:
+        """May this connection become another node's link (peer_hello)? Workers only take
+        links from their bus, which needs no key; --peer nodes only from the chat port, with
+        the cluster key."""
+        cluster = self.cluster
+        if cluster is not None and client.vid is None and isinstance(cluster.broker, workers.WorkerBus):
+            ok = client.bus
+        else:
+            ok = self.peer_key_ok(client, hello.get('key'))
+        if not ok:
+            print(f"Refused peer link from {client.addr}")
+        return ok
+
+    def peer_key_ok(self, client: Client, key) -> bool:
+        """Is key the cluster key of our --peer nodes, presented on the chat port?"""
+        cluster = self.cluster
+        if cluster is None or client.vid is not None or client.bus or isinstance(cluster.broker, workers.WorkerBus):
+            return False
+        return bool(cluster.key) and isinstance(key, str) and hmac.compare_digest(key.encode(), cluster.key.encode())
+
+    # ------------------------------------------------------------ files
+
+    def push_file(self, sender: Optional[Client], header: Dict, stream: UploadStream, room: str = DEFAULT_ROOM):
+        """Send a file to every push client: interleaved chunk frames where supported,
+        otherwise one 'file' frame that holds the connection until it is done."""
+        self.broadcast_except(sender, header, stream, where=lambda c: not c.pull and not c.chunks, room=room)
+        targets = [c for c in self.rooms.members(room) if c is not sender and c.chunks and not c.pull]
+        tid = new_transfer_id()
+        for c in targets:
+            if c.outq.closed:
+                continue
+            if not c.outq.put_bulk(Bulk(timed_frames(stream_frames(stream, header, tid, c.compact), 'push'),
+                                        stream)):
+                SLOW_CONSUMERS.inc()
+                print(f"Disconnecting slow consumer {c.addr} ({c.username}): outbound queue full")
+
+    def share_file(self, sender: Client, username: str, name: str, orig_filename: str,
+                   filesize: int, sha256: str, blob: Path, room: str = DEFAULT_ROOM):
+        """Share a stored file: payload to push clients, file_announce to pull clients."""
+        out_hdr = {
+            'type':'file',
+            'username': username,
+            'filename': name,
+            'orig_filename': orig_filename,
+            'filesize': filesize,
+            'sha256': sha256
+        }
+        self.push_file(sender, tag_room(out_hdr, room), UploadStream.complete(blob, filesize), room)
+        self.announce_file(sender, username, name, orig_filename, filesize, sha256, room)
+
+    def announce_file(self, sender: Client, username: str, name: str, orig_filename: str,
+                      filesize: int, sha256: str, room: str = DEFAULT_ROOM):
+        ann = {
+            'type':'file_announce',
+            'id': sha256,
+            'username': username,
+            'filename': name,
+            'orig_filename': orig_filename,
+            'filesize': filesize,
+            'sha256': sha256
+        }
+        if room:
+            self.post_room(sender, tag_room(ann, room), room, where=lambda c: c.pull, relay=False)
+        if self.cluster and room:
+            # other nodes get a reference and pull the bytes from us when needed
+            self.cluster.publish('file', addr=self.cluster.advertise, username=username, filename=name,
+                                 orig_filename=orig_filename, filesize=filesize, sha256=sha256, room=room)
+
+    def begin_file(self, client: Client, header: Dict) -> Optional[FileUpload]:
+        """A 'file' frame: reserve its name and start pushing it; the engine then reads the
+        payload into the returned upload and calls end_file. None (after a file_error to the
+        client) if there is no payload to read."""
+        filename = header.get('filename', 'file.bin')
+        filesize = int(header.get('filesize', 0))
+        if filesize < 0:
+            print(f"File {filename} from {client.addr} has a negative size ({filesize})")
+            self.send_framed(client, {'type':'file_error', 'filename': filename, 'error': 'invalid filesize'})
+            return None
+        # outside its room the upload is still read and stored, just not shared
+        room = self.room_of(client, header)
+        name = self.store.reserve_name(filename)
+        tmp_path, f = self.store.begin()
+        up = FileUpload(client, filename, name, filesize, room, tmp_path, f)
+        out_hdr = {
+            'type':'file',
+            'username': client.username,
+            'filename': name,
+            'orig_filename': filename,
+            'filesize': filesize
+        }
+        self.push_file(client, tag_room(out_hdr, room), up.stream, room)
+        return up
+
+    def end_file(self, up: FileUpload, ok: bool):
+        """Store a 'file' upload whose payload was read (ok), or abort it."""
+        up.f.close()
+        client, name, room = up.client, up.name, up.room
+        if not ok:
+            # sender vanished mid-upload: pad recipients' copies and tell them
+            up.stream.fail()
+            print(f"Upload of {name} from {client.username} interrupted ({up.stream.written}/{up.stream.size} bytes)")
+            self.store.abort(name, up.tmp_path)
+            self.broadcast_except(client, tag_room({'type':'system',
+                                                    'text': f'File {name} from {client.username} was interrupted (incomplete)'},
+                                                   room), room=room)
+            return
+        sha256 = up.hasher.hexdigest()
+        self.store.commit(name, up.tmp_path, sha256, up.filesize, up.stream, room)
+        TRANSFER_SECONDS.observe(time.perf_counter() - up.started, ('upload',))
+        # pull clients only hear about it once the whole file is stored
+        self.announce_file(client, client.username, name, up.filename, up.filesize, sha256, room)
+        print(f"Received file from {client.username}: {name} ({up.filesize} bytes, sha256 {sha256[:12]})")
+
+    def chunk_size(self, client: Client, header: Dict) -> Optional[int]:
+        """Payload size of an upload_chunk frame, checked before any of it is read. None if the
+        frame is malformed: its payload cannot be skipped, so the engine closes the connection."""
+        size, offset = header.get('size'), header.get('offset')
+        if type(size) is not int or not 0 < size <= MAX_CHUNK_SIZE:
+            print(f"Chunk of {size!r} bytes from {client.addr} rejected")
+            return None
+        t = self.staging.get(header.get('transfer_id', ''))
+        if type(offset) is not int or offset < 0 or (t is not None and offset > t.filesize):
+            print(f"Chunk at offset {offset!r} from {client.addr} rejected")
+            return None
+        return size
+
+    def write_chunk(self, client: Client, header: Dict, data: bytes):
+        """An upload_chunk's payload, read by the engine."""
+        tid = header.get('transfer_id', '')
+        t = self.staging.get(tid)
+        if t is None or not self.staging.write_chunk(t, header['offset'], data, header.get('sha256', '')):
+            # tell the client where to continue from
+            self.send_framed(client, {'type':'upload_status', 'transfer_id': tid,
+                                      'offset': t.offset if t else 0, 'error': 'chunk rejected'})
+        elif t.complete:
+            self.finish_upload(client, t)
+
+    def finish_upload(self, client: Client, t):
+        """A resumable upload has all its bytes: store it and share it."""
+        part_path = self.staging.finish(t)
+        self.blocking(client, sha256_file, (part_path,), lambda sha256: self._store_upload(client, t, part_path, sha256))
+
+    def _store_upload(self, client: Client, t, part_path: Path, sha256: str):
+        room = client.upload_rooms.pop(t.id, DEFAULT_ROOM)
+        name = self.store.reserve_name(t.filename, sha256)
+        blob = self.store.commit(name, part_path, sha256, t.filesize, room=room)
+        self.send_framed(client, {'type':'upload_done', 'transfer_id': t.id, 'filename': name, 'sha256': sha256})
+        print(f"Received file from {client.username}: {name} ({t.filesize} bytes, resumable, sha256 {sha256[:12]})")
+        self.share_file(client, client.username, name, t.filename, t.filesize, sha256, blob, room)
+
+    def may_fetch(self, client: Client, name: str) -> bool:
+        """Files go to joined members of a room they were shared to, and to no one else."""
+        if not client.username:
+            return False
+        rooms = self.store.rooms_of(name)
+        if self.cluster:
+            rooms.update(self.cluster.file_rooms(name))
+        return bool(rooms & client.rooms)
+
+    def fetch(self, client: Client, name: str, offset: int):
+        """Answer a fetch. A file shared on another node is pulled here first."""
+        if not self.may_fetch(client, name):
+            # the same answer as for a name that does not exist
+            self.fetch_reply(client, name, offset, None)
+            return
+        entry = self.store.resolve(name)
+        if entry is None and self.cluster and self.cluster.has_file(name):
+            # still on the node it was shared on: pull it without holding up this client
+            self.background(self.cluster.ensure_local, (name,),
+                            lambda entry: self.fetch_reply(client, name, offset, entry))
+        else:
+            self.fetch_reply(client, name, offset, entry)
+
+    def fetch_reply(self, client: Client, name: str, offset: int, entry: Optional[Tuple[str, int]]):
+        if entry is None:
+            self.send_framed(client, {'type':'fetch_done', 'filename': name, 'error': 'not found'})
+            return
+        sha256, filesize = entry
+        # fetch_chunk frames are produced lazily by the client's writer, between chat frames
+        reply = FetchReply(self.store.blob_path(sha256), name, offset, filesize, sha256)
+        client.outq.put_bulk(Bulk(timed_frames(reply.frames(client.compact), 'fetch')))
+
+    # ------------------------------------------------------------ frames
+
+    def handle(self, client: Client, header: Dict) -> bool:
+        """Act on one frame from client. False once the client is done (for a user behind a
+        mux link, just that user)."""
+        username = client.username
+        addr = client.addr
+        typ = header.get('type')
+        field = bad_field(header, *FIELD_TYPES.get(typ, ((), ())))
+        if field:
+            self.send_framed(client, {'type':'system', 'text': f'Bad {typ} frame: {field} has the wrong type'})
+            return True
+        if typ == 'join':
+            features = header.get('features')
+            if not isinstance(features, list):
+                features = []
+            resume = 'resume' in features and self.resumable
+            resumed = self.sessions.resume(header.get('resume')) if resume else None
+            if username:
+                self.users.remove(username, client)
+                self.presence.offline(username)
+                if self.cluster:
+                    self.cluster.user_offline(username)
+            username = resumed.username if resumed else header.get('username', f'{addr[0]}:{addr[1]}')
+            client.username = username
+            self.users.add(username, client)
+            if not resumed:
+                self.presence.online(username)     # a kept session was counted all along
+            if self.cluster:
+                self.cluster.user_online(username)
+            # users behind a mux link always pull: a pushed 'file' frame would hold up the link, and
+            # the queue, that all the bridge's other users share
+            client.pull = 'pull' in features and (self.file_delivery == 'announce' or client.vid is not None)
+            # chunk frames carry no vid, so users behind a mux link that do not pull take whole 'file' frames
+            client.chunks = 'chunks' in features and client.vid is None
+            if COMPACT in features:
+                # confirm in JSON; from here on both directions may use compact headers
+                self.send_framed(client, {'type':'features', 'features': [COMPACT]})
+                client.compact = True
+            client.presence = 'presence' in features
+            with self.clients_lock:
+                self.clients.add(client)
+            if client.presence:
+                self.presence.snapshot(lambda frame: self.send_framed(client, frame))
+            if resumed:
+                client.session = resumed
+                self.send_framed(client, {'type':'session', 'token': resumed.token, 'resumed': True})
+                seqs = header.get('seqs')
+                self.resume_session(client, resumed, seqs if isinstance(seqs, dict) else {})
+                print(f"{username} resumed from {addr}")
+                return True
+            if resume:
+                client.session = client.session or self.sessions.new(username)
+                client.session.username = username
+                self.send_framed(client, {'type':'session', 'token': client.session.token, 'resumed': False,
+                                          'seqs': {DEFAULT_ROOM: self.join_room(client, DEFAULT_ROOM)}})
+            else:
+                self.join_room(client, DEFAULT_ROOM)
+            print(f"{username} joined from {addr}")
+            self.post_room(client, {'type':'system', 'text': f'{username} joined'}, DEFAULT_ROOM)
+        elif typ == 'message':
+            text = header.get('text', '')
+            to = header.get('to')
+            msg_id = header.get('id')
+            if msg_id is not None and type(msg_id) not in (int, str):
+                self.send_framed(client, {'type':'system', 'text': 'Bad message frame: id has the wrong type'})
+                return True
+            if msg_id is not None and client.session and msg_id in client.session.acked:
+                # sent again after a drop, but it got through the first time
+                self.send_framed(client, {'type':'ack', 'id': msg_id, 'seq': client.session.acked[msg_id]})
+                return True
+            seq = None
+            if to:
+                # direct message, found through the username index
+                target = self.users.get(to)
+                out_hdr = {'type':'message', 'username': username, 'text': text, 'to': to}
+                if target is not None:
+                    self.send_framed(target, out_hdr)
+                elif self.sessions.hold(to, out_hdr):
+                    self.send_framed(client, {'type':'system', 'text': f'{to} is away; they get it when back'})
+                elif self.cluster and self.cluster.has_user(to):
+                    self.cluster.publish('direct', to=to, frame=out_hdr)
+                else:
+                    self.send_framed(client, {'type':'system', 'text': f'No user named {to}'})
+                    return True
+                print(f"[{username} -> {to}] {text}")
+            else:
+                room = self.room_of(client, header)
+                if room is None:
+                    return True
+                print(f"[{room}] [{username}] {text}" if room != DEFAULT_ROOM else f"[{username}] {text}")
+                seq = self.post_room(client, tag_room({'type':'message', 'username': username, 'text': text},
+                                                      room), room)
+            if msg_id is not None:
+                if client.session:
+                    client.session.ack(msg_id, seq)
+                self.send_framed(client, {'type':'ack', 'id': msg_id, 'seq': seq})
+        elif typ == 'join_room':
+            room = header.get('room')
+            if not username or not valid_room(room):
+                self.send_framed(client, {'type':'system', 'text': 'Cannot join that room'})
+                return True
+            if room in client.rooms:
+                self.send_framed(client, tag_room({'type':'system', 'text': f'Already in #{room}'}, room))
+                return True
+            # the reply carries the room's seq so far; the client counts on from it
+            seq = self.join_room(client, room)
+            self.send_framed(client, tag_room({'type':'system', 'last_seq': seq,
+                                               'text': f'Joined #{room} ({self.rooms.count(room)} members)'}, room))
+            self.post_room(client, tag_room({'type':'system', 'text': f'{username} joined #{room}'}, room), room)
+        elif typ == 'leave_room':
+            room = header.get('room')
+            if room not in client.rooms:
+                self.send_framed(client, {'type':'system', 'text': f'You are not in #{room}'})
+                return True
+            client.rooms.discard(room)
+            self.rooms.leave(room, client)
+            self.post_room(client, tag_room({'type':'system', 'text': f'{username} left #{room}'}, room), room)
+            self.send_framed(client, tag_room({'type':'system', 'text': f'Left #{room}'}, room))
+        elif typ == 'file_offer':
+            # client sends the hash first; if we have the blob, it skips the upload once it has
+            # shown it holds the bytes too (a hash alone would hand out any file it names)
+            filename = header.get('filename', 'file.bin')
+            filesize = header.get('filesize') or 0
+            sha256 = header.get('sha256') or ''
+            room = self.room_of(client, header)
+            blob = self.store.lookup(sha256, filesize)
+            if blob is None:
+                self.send_framed(client, {'type':'file_offer_reply', 'sha256': sha256, 'have': False})
+                return True
+            challenge = new_challenge(filesize)
+            def ask(proof):
+                if len(client.offers) >= MAX_OFFERS:
+                    client.offers.pop(next(iter(client.offers)))
+                client.offers[sha256] = (filename, filesize, room, blob, proof)
+                self.send_framed(client, {'type':'file_offer_reply', 'sha256': sha256, 'have': False,
+                                          'challenge': challenge})
+            self.blocking(client, range_proof, (blob, challenge), ask)
+        elif typ == 'file_proof':
+            sha256 = str(header.get('sha256', ''))
+            offer = client.offers.pop(sha256, None)
+            proof = header.get('proof')
+            if offer is None or not isinstance(proof, str) or \
+                    not hmac.compare_digest(proof.encode(), offer[4].encode()):
+                print(f"File offer from {username} not proven: {sha256[:12]}")
+                self.send_framed(client, {'type':'file_offer_reply', 'sha256': sha256, 'have': False})
+                return True
+            filename, filesize, room, blob, _ = offer
+            name = self.store.reserve_name(filename, sha256)
+            self.store.record(name, sha256, filesize, room)
+            self.send_framed(client, {'type':'file_offer_reply', 'sha256': sha256, 'have': True, 'filename': name})
+            print(f"Re-shared file from {username}: {name} ({filesize} bytes, already stored)")
+            self.share_file(client, username, name, filename, filesize, sha256, blob, room)
+        elif typ == 'upload_begin':
+            tid = header.get('transfer_id', '')
+            t = self.staging.begin(tid, header.get('filename') or 'file.bin',
+                                   header.get('filesize') or 0)
+            if t is None:
+                self.send_framed(client, {'type':'upload_status', 'transfer_id': tid, 'offset': 0,
+                                          'error': 'invalid transfer'})
+                return True
+            client.upload_rooms[tid] = self.room_of(client, header)
+            self.send_framed(client, {'type':'upload_status', 'transfer_id': tid, 'offset': t.offset})
+            if t.complete:
+                self.finish_upload(client, t)
+        elif typ == 'fetch':
+            self.fetch(client, header.get('filename') or '', max(0, header.get('offset') or 0))
+        elif typ == 'peer_fetch':
+            # another node pulling a file shared here (cluster.py); the cluster key stands in for a join
+            if not self.peer_key_ok(client, header.get('key')):
+                print(f"Refused peer_fetch from {addr}")
+                return False
+            name = header.get('filename') or ''
+            self.fetch_reply(client, name, max(0, header.get('offset') or 0), self.store.resolve(name))
+        elif typ == 'quit':
+            # leaving for good: no session to come back to
+            client.session = None
+            return False
+        elif typ == 'history':
+            room = self.room_of(client, header)
+            if room is None:
+                return True
+            reply = lambda page: self.send_framed(client, tag_room({'type':'history', 'messages': page[0],
+                                                                    'first_seq': page[1], 'last_seq': page[2]},
+                                                                   room))
+            if self.msglog:
+                # may wait briefly for queued records to reach the disk
+                self.blocking(client, self.msglog.history, (room, header.get('before'), header.get('after'),
+                                                            header.get('limit') or 50), reply)
+            else:
+                reply(([], 0, 0))
+        elif typ == 'search':
+            # mmapped pages of the index may have to be read from disk
+            self.blocking(client, search_reply, (self.search, header, set(client.rooms)),
+                          lambda frame: self.send_framed(client, frame))
+        elif typ == 'stats':
+            self.send_framed(client, {'type':'stats', 'queues': self.queue_depths()})
+        else:
+            # unknown type - ignore or send error
+            self.send_framed(client, {'type':'system', 'text':'Unknown message type'})
+        return True
+
+def open_hub(args, upload_dir: Path, worker: int = None, **hooks) -> Hub:
+    """The hub for server_tcp.py's parsed args (history and search unless turned off)."""
+    msglog = search = None
+    if not args.no_history:
+        msglog = open_history(args.history_dir or upload_dir / 'history', worker)
+        if not args.no_search:
+            search = open_search(msglog)
+    return Hub(BlobStore(upload_dir), Staging(upload_dir / 'staging'), args.file_delivery, msglog, search,
+               args.session_ttl, resumable=worker is None, **hooks)
@@ -0,0 +1,184 @@
+# lanes.py
+# Priority lanes for the per-client outbound writers
+#
+# Control frames (chat, system notices, replies) sit in the client's normal
+# FrameQueue and always go out first. File transfers go to a separate bulk
+# lane as a series of chunk frames, and the writer only sends the next chunk
+# when no control frame is waiting, so a message is never stuck behind more
+# than one chunk of a file. Transfers to the same client take turns chunk by
+# chunk, and a per-client token bucket (--bulk-rate) paces its bulk bytes so
+# one transfer cannot take all the bandwidth.
+#
+# Chunk frames: file_start / file_chunk (+ bytes) / file_end for pushed files
+# (clients that send 'chunks' in join features), fetch_chunk / fetch_done for
+# fetch replies (see transfers.FetchReply).
+
+import itertools
+import time
+from typing import Iterator, Optional, Tuple
+
+from relay import UploadStream, FileSlice
+from framing import encode_header
+
+BULK_CHUNK = 64 * 1024    # pushed file_chunk size
+MAX_ACTIVE = 4            # transfers interleaved at once per client; the rest wait their turn
+
+_ids = itertools.count(1)
+
+def new_transfer_id() -> str:
+    """Id tying a pushed file's file_start/file_chunk/file_end frames together."""
+    return str(next(_ids))
+
+class TokenBucket:
+    """Byte-rate limiter. rate is bytes/s; 0 means unlimited."""
+
+    def __init__(self, rate: float = 0, burst: float = None):
+        self.rate = rate
+        self.burst = burst or max(rate, 4 * BULK_CHUNK)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self) -> float:
+        """Seconds until the bucket is out of debt (0 = may send now)."""
+        if not self.rate:
+            return 0.0
+        self._refill()
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def take(self, n: int) -> float:
+        """Spend n bytes; returns how long the caller should pause to stay at rate."""
+        if not self.rate:
+            return 0.0
+        self._refill()
+        self.tokens -= n
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+class Bulk:
+    """One transfer in the bulk lane: an iterator of chunk frames.
+
+    The iterator yields a frame (tuple of parts) or None when nothing is ready
+    yet (a live upload that has not caught up). stream, if given, is watched
+    so the writer wakes up when more of the upload arrives.
+    """
+
+    def __init__(self, frames: Iterator, stream: UploadStream = None):
+        self.frames = frames
+        self.stream = stream
+        self._kick = None
+
+    def start(self, kick):
+        if self.stream:
+            self._kick = kick
+            self.stream.add_listener(kick)
+
+    def close(self):
+        if self._kick:
+            self.stream.remove_listener(self._kick)
+            self._kick = None
+        self.frames.close()
+
+def stream_frames(stream: UploadStream, header: dict, transfer_id: str, compact: bool = False) -> Iterator:
+    """Chunk frames for a pushed file, following the upload while it is written.
+
+    header is the usual 'file' header; it goes out as file_start. If the
+    upload fails the transfer ends with file_end carrying "error". compact
+    selects the receiver's header encoding (see framing.encode_header).
+    """
+    start = dict(header, type='file_start', id=transfer_id)
+    yield (encode_header(start, compact),)
+    sent = 0
+    f = None
+    try:
+        while sent < stream.size:
+            avail = stream.written
+            if avail <= sent:
+                if stream.failed:
+                    break
+                yield None
+                continue
+            if f is None:
+                f = stream.open()
+                if f is None:
+                    break
+            n = min(BULK_CHUNK, avail - sent)
+            yield (encode_header({'type': 'file_chunk', 'id': transfer_id, 'offset': sent, 'size': n}, compact),
+                   FileSlice(f, sent, n))
+            sent += n
+        end = {'type': 'file_end', 'id': transfer_id, 'filesize': stream.size}
+        if sent < stream.size:
+            end['error'] = 'interrupted'
+        elif header.get('sha256'):
+            end['sha256'] = header['sha256']
+        yield (encode_header(end, compact),)
+    finally:
+        if f:
+            f.close()
+
+def frame_size(frame: Tuple) -> int:
+    return sum(p.count if isinstance(p, FileSlice) else len(p) for p in frame)
+
+class BulkLane:
+    """Transfers waiting for / being sent on one connection. Owned by its writer.
+
+    pending is a FrameQueue of (Bulk,) frames, so the client's queue policy
+    also applies to transfers that have not started yet; only the writer
+    touches the active ones.
+    """
+
+    def __init__(self, pending, rate: float = 0):
+        self.pending = pending
+        self.active = []
+        self.bucket = TokenBucket(rate)
+        self._turn = 0
+
+    def __len__(self):
+        return len(self.pending) + len(self.active)
+
+    def can_activate(self) -> bool:
+        return bool(len(self.pending)) and len(self.active) < MAX_ACTIVE
+
+    def activate(self, kick):
+        """Move waiting transfers into the active set (call where pending is guarded)."""
+        while len(self.active) < MAX_ACTIVE:
+            frame = self.pending.pop()
+            if frame is None:
+                return
+            frame[0].start(kick)
+            self.active.append(frame[0])
+
+    def next_frame(self) -> Tuple[Optional[Tuple], float]:
+        """Next chunk frame, round-robin over active transfers.
+
+        Returns (frame, 0), or (None, wait) with wait > 0 if the token bucket
+        is empty, or (None, 0) if no transfer has data ready.
+        """
+        wait = self.bucket.wait_time()
+        if wait:
+            return None, wait
+        for _ in range(len(self.active)):
+            if not self.active:
+                break
+            self._turn %= len(self.active)
+            bulk = self.active[self._turn]
+            try:
+                frame = next(bulk.frames)
+            except StopIteration:
+                bulk.close()
+                del self.active[self._turn]
+                continue
+            self._turn += 1
+            if frame is not None:
+                self.bucket.take(frame_size(frame))
+                return frame, 0.0
+        return None, 0.0
+
+    def close(self):
+        for bulk in self.active:
+            bulk.close()
+        self.active.clear()
+        self.pending.close()
@@ -0,0 +1,367 @@
+# metrics.py
+# In-process metrics for the chat server, served in Prometheus text format
+# Usage: python3 server_tcp.py --metrics 9100       (or HOST:PORT, or a Unix socket path)
+#        curl -s 127.0.0.1:9100/metrics
+#        curl -s '127.0.0.1:9100/profile?seconds=10' > chat.folded
+#
+# Counters and histograms live in one registry; the engines update them as
+# frames, bytes and transfers pass. Gauges (connected clients, send queue
+# depths) are read from the server's state when scraped. The endpoint:
+#   GET /metrics              everything, Prometheus text format 0.0.4
+#   GET /profile/start        start sampling the stacks of all threads
+#   GET /profile/stop         stop, and return the samples as folded stacks
+#   GET /profile?seconds=N    start, wait N seconds, stop
+# Folded stacks ("a;b;c 42" per line) are what flamegraph.pl and speedscope
+# read. The profiler measures wall-clock time: threads blocked in recv() or
+# select() show up too, under those calls. Its cost grows with the number of
+# threads sampled, so keep ?hz= low on a threaded server with many clients.
+# With --workers each worker serves its own metrics, on PORT + its index
+# (or PATH.<index>).
+
+import http.server
+import os
+import socketserver
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as Tally
+from typing import Callable, Dict, Iterator, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+MAX_SERIES = 200        # label sets per metric; further ones are counted under "other"
+PROFILE_HZ = 100        # default stack samples per second
+PROFILE_MAX_SECONDS = 300
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds, for latencies from microseconds (a queued broadcast) up to a few seconds
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+# seconds, for file transfers
+TRANSFER_BUCKETS = (0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = '') -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _number(v) -> str:
+    if v == float('inf'):
+        return '+Inf'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+
+    def _key(self, labels: Tuple, table: Dict) -> Tuple:
+        # label values often come from clients (frame types); don't let them grow the table
+        if labels not in table and len(table) >= MAX_SERIES:
+            return ('other',) * len(self.labelnames)
+        return labels
+
+    def samples(self) -> Iterator[str]:
+        return iter(())
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    """A total that only goes up, per label set."""
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, labels: Tuple = ()):
+        with self.lock:
+            key = self._key(labels, self.values)
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, labels: Tuple = ()) -> float:
+        return self.values.get(labels, 0)
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        if not items and not self.labelnames:
+            items = [((), 0)]
+        for labels, v in items:
+            yield f'{self.name}{_labels(self.labelnames, labels)} {_number(v)}'
+
+class Histogram(Metric):
+    """Observations counted into fixed buckets, per label set."""
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, buckets=LATENCY_BUCKETS, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self.bounds = tuple(sorted(buckets))
+        self.series: Dict[Tuple, list] = {}    # labels -> [count per bucket..., +Inf count, sum]
+
+    def observe(self, value: float, labels: Tuple = ()):
+        i = bisect_left(self.bounds, value)
+        with self.lock:
+            key = self._key(labels, self.series)
+            row = self.series.get(key)
+            if row is None:
+                row = self.series[key] = [0] * (len(self.bounds) + 1) + [0.0]
+            row[i] += 1
+            row[-1] += value
+
+    def time(self, labels: Tuple = ()):
+        """Context manager observing the seconds its block takes."""
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self.lock:
+            items = sorted((k, list(v)) for k, v in self.series.items())
+        for labels, row in items:
+            total = 0
+            for bound, n in zip(self.bounds + (float('inf'),), row):
+                total += n
+                le = 'le="' + _number(bound) + '"'
+                yield f'{self.name}_bucket{_labels(self.labelnames, labels, le)} {total}'
+            yield f'{self.name}_sum{_labels(self.labelnames, labels)} {_number(row[-1])}'
+            yield f'{self.name}_count{_labels(self.labelnames, labels)} {total}'
+
+class _Timer:
+    __slots__ = ('hist', 'labels', 'start')
+
+    def __init__(self, hist: Histogram, labels: Tuple):
+        self.hist = hist
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.start, self.labels)
+
+class Gauge(Metric):
+    """A value read when scraped: fn() returns a number, or {label values: number}."""
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, fn: Callable, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+
+    def samples(self):
+        v = self.fn()
+        items = v.items() if isinstance(v, dict) else [((), v)]
+        for labels, value in items:
+            yield f'{self.name}{_labels(self.labelnames, labels)} {_number(value)}'
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        # re-registering a name replaces it (gauges are set up again per server start)
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        parts = []
+        for m in list(self.metrics.values()):
+            try:
+                parts.append(m.render())
+            except Exception as e:
+                # one broken gauge should not hide the rest
+                parts.append(f'# {m.name}: {e}')
+        return '\n'.join(parts) + '\n'
+
+REGISTRY = Registry()
+
+def counter(name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, help, labelnames))
+
+def histogram(name: str, help: str, buckets=LATENCY_BUCKETS, labelnames: Tuple[str, ...] = ()) -> Histogram:
+    return REGISTRY.register(Histogram(name, help, buckets, labelnames))
+
+def gauge(name: str, help: str, fn: Callable, labelnames: Tuple[str, ...] = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, help, fn, labelnames))
+
+# What both engines record
+CONNECTIONS = counter('chat_connections_total', 'Connections accepted')
+FRAMES_IN = counter('chat_frames_in_total', 'Frames received from clients, by type', ('type',))
+FRAMES_OUT = counter('chat_frames_out_total', 'Frames queued for clients, by type (one per recipient)',
+                     ('type',))
+BYTES_IN = counter('chat_bytes_in_total', 'Bytes received from clients, headers and payloads')
+BYTES_OUT = counter('chat_bytes_out_total', 'Bytes written to clients, headers and payloads')
+SLOW_CONSUMERS = counter('chat_slow_consumers_total', 'Clients disconnected because their send queue was full')
+BROADCAST_SECONDS = histogram('chat_broadcast_seconds', 'Time to queue one room frame for all its members')
+LOCK_WAIT_SECONDS = histogram('chat_lock_wait_seconds', 'Time spent waiting to acquire a lock, by lock',
+                              labelnames=('lock',))
+TRANSFER_SECONDS = histogram('chat_file_transfer_seconds',
+                             'File transfer durations: upload (from a client), push (to one recipient), '
+                             'fetch (a download served)', TRANSFER_BUCKETS, ('kind',))
+
+def timed_frames(frames: Iterator, kind: str) -> Iterator:
+    """Pass a bulk transfer's frames through, recording its duration once all went out."""
+    start = time.perf_counter()
+    yield from frames
+    TRANSFER_SECONDS.observe(time.perf_counter() - start, (kind,))
+
+class TimedLock:
+    """threading.Lock that records how long acquiring it waited (uncontended: no clock read)."""
+
+    def __init__(self, name: str):
+        self.lock = threading.Lock()
+        self.labels = (name,)
+
+    def __enter__(self):
+        if not self.lock.acquire(False):
+            start = time.perf_counter()
+            self.lock.acquire()
+            LOCK_WAIT_SECONDS.observe(time.perf_counter() - start, self.labels)
+        else:
+            LOCK_WAIT_SECONDS.observe(0.0, self.labels)
+        return self
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+class Profiler:
+    """Samples every thread's stack hz times a second into folded-stack counts."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+        self.stacks = Tally()
+        self.samples = 0
+        self.started = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None
+
+    def start(self, hz: float = PROFILE_HZ) -> bool:
+        """False if it was already running."""
+        with self.lock:
+            if self.thread is not None:
+                return False
+            self.stacks = Tally()
+            self.samples = 0
+            self.started = time.monotonic()
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._run, args=(1 / max(1.0, min(hz, 1000.0)),),
+                                           name='profiler', daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self) -> str:
+        """Stop (if running) and return what was collected, folded, most frequent first."""
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.stop_event.set()
+            thread.join()
+        elapsed = (time.monotonic() - self.started) if self.started else 0
+        lines = [f'{stack} {n}' for stack, n in self.stacks.most_common()]
+        head = f'# {self.samples} samples over {elapsed:.1f}s\n'
+        return head + '\n'.join(lines) + ('\n' if lines else '')
+
+    def _run(self, interval: float):
+        me = threading.get_ident()
+        names = {}
+        while not self.stop_event.wait(interval):
+            if len(names) != threading.active_count():
+                names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                # handler threads share one name per target, so their stacks add up
+                name = names.get(ident, 'thread').split(' ', 1)[-1].strip('()')
+                stack.append(name)
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+PROFILER = Profiler()
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        try:
+            hz = float(query.get('hz', PROFILE_HZ))
+            if url.path == '/metrics':
+                self._reply(200, REGISTRY.render(), CONTENT_TYPE)
+            elif url.path == '/profile/start':
+                started = PROFILER.start(hz)
+                self._reply(200 if started else 409, 'started\n' if started else 'already running\n')
+            elif url.path == '/profile/stop':
+                self._reply(200, PROFILER.stop())
+            elif url.path == '/profile':
+                seconds = min(float(query.get('seconds', 10)), PROFILE_MAX_SECONDS)
+                if not PROFILER.start(hz):
+                    self._reply(409, 'already running\n')
+                    return
+                time.sleep(seconds)
+                self._reply(200, PROFILER.stop())
+            else:
+                self._reply(404, 'try /metrics, /profile?seconds=N, /profile/start, /profile/stop\n')
+        except ValueError as e:
+            self._reply(400, f'{e}\n')
+
+    def _reply(self, status: int, body: str, content_type: str = 'text/plain; charset=utf-8'):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass    # scrapes every few seconds would drown the chat log
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        sock, _ = super().get_request()
+        return sock, ('local', 0)     # BaseHTTPRequestHandler expects a (host, port)
+
+def serve_http(addr: str, worker: int = None):
+    """Serve /metrics and /profile on addr (PORT, HOST:PORT or a Unix socket path) in a
+    background thread. As one of --workers, on PORT + worker or PATH.<worker>."""
+    if '/' in addr:
+        path = addr if worker is None else f'{addr}.{worker}'
+        if os.path.exists(path):
+            os.unlink(path)
+        server = _UnixHTTPServer(path, _Handler)
+        where = path
+    else:
+        host, _, port = addr.rpartition(':')
+        port = int(port) + (worker or 0)
+        server = http.server.ThreadingHTTPServer((host or '127.0.0.1', port), _Handler)
+        server.daemon_threads = True
+        where = f'http://{host or "127.0.0.1"}:{port}/metrics'
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    print(f"Metrics on {where}")
+    return server
+
+def watch_server(client_count: Callable[[], int], queue_depths: Callable[[], list], top: int = 20):
+    """Gauges over an engine's clients; queue_depths() gives rows as in a 'stats' reply,
+    deepest first. Only the top deepest queues get a series of their own."""
+    gauge('chat_clients', 'Clients connected and joined', client_count)
+    gauge('chat_send_queue_depth', f'Frames waiting in the send queues of the {top} most lagging clients',
+          lambda: {(r['username'], r['addr']): r['depth'] for r in queue_depths()[:top]}, ('user', 'addr'))
+    gauge('chat_send_queue_frames', 'Frames waiting in all send queues',
+          lambda: sum(r['depth'] for r in queue_depths()))
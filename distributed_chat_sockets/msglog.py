@@ -0,0 +1,327 @@
+# msglog.py
+# Persistent chat history: an append-only, segmented log per room
+#
+# Room messages, join/leave notices and file announcements are appended to
+# their room's log as [4-byte length][8-byte seq][8-byte time][header JSON].
+# Sequence numbers count up from 1 per room without gaps. A log is split
+# into segments of at most SEGMENT_BYTES, each named after its first seq,
+# and every segment has a sparse index (.idx: seq and offset about every
+# INDEX_EVERY bytes). A history page is found by two binary searches and a
+# short forward scan, never by reading the whole log.
+#
+# append() only queues the record. One writer thread writes whatever has
+# queued up and then fsyncs once for the whole batch (group commit), so chat
+# frames never wait for the disk.
+
+import bisect
+import json
+import os
+import struct
+import threading
+import time
+import urllib.parse
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+SEGMENT_BYTES = 64 * 1024 * 1024    # rotate to a new segment past this size
+INDEX_EVERY = 64 * 1024             # bytes of records between index entries
+PAGE_MAX = 200                      # records per history page, at most
+PAGE_BYTES = 256 * 1024             # and about this many bytes of headers
+REC = struct.Struct('>IQd')         # header length, seq, unix time
+IDX = struct.Struct('>QQ')          # seq, offset
+SYNC_WAIT = 1.0                     # seconds history waits for queued records
+
+class Segment:
+    def __init__(self, path: Path, first: int):
+        self.path = path
+        self.first = first
+        self.index_path = path.with_suffix('.idx')
+        self.seqs: List[int] = []
+        self.offsets: List[int] = []
+        self.size = 0
+
+    def load_index(self):
+        try:
+            data = self.index_path.read_bytes()
+        except OSError:
+            data = b''
+        for pos in range(0, len(data) - len(data) % IDX.size, IDX.size):
+            seq, offset = IDX.unpack_from(data, pos)
+            self.add_index(seq, offset)
+
+    def add_index(self, seq: int, offset: int):
+        # offsets first: readers size their search by seqs
+        self.offsets.append(offset)
+        self.seqs.append(seq)
+
+    def start(self, seq: int) -> int:
+        """Offset to scan from to find seq."""
+        i = bisect.bisect_right(self.seqs, seq) - 1
+        return self.offsets[i] if i >= 0 else 0
+
+def read_records(f, offset: int, end: int):
+    """(seq, time, header bytes, next offset) for the whole records in f[offset:end]."""
+    f.seek(offset)
+    while offset + REC.size <= end:
+        raw = f.read(REC.size)
+        if len(raw) < REC.size:
+            return
+        length, seq, ts = REC.unpack(raw)
+        if offset + REC.size + length > end:
+            return
+        body = f.read(length)
+        if len(body) < length:
+            return
+        offset += REC.size + length
+        yield seq, ts, body, offset
+
+def room_dir(room: str) -> str:
+    """Directory name of a room's log: quoted, and never '.', '..' or hidden."""
+    name = urllib.parse.quote(room, safe='')
+    return '%2E' + name[1:] if name.startswith('.') else name
+
+class RoomLog:
+    """One room's segments. Only the writer thread writes; readers stop at durable_seq."""
+
+    def __init__(self, root: Path, room: str):
+        self.room = room
+        self.dir = root / room_dir(room)
+        self.lock = threading.Lock()
+        self.segments: List[Segment] = []
+        self.next_seq = 1
+        self.durable_seq = 0
+        self.file = None
+        self.index_file = None
+        self.since_index = 0
+        self._load()
+
+    def _load(self):
+        if not self.dir.is_dir():
+            return
+        for path in sorted(self.dir.glob('*.log')):
+            try:
+                seg = Segment(path, int(path.stem))
+            except ValueError:
+                continue
+            seg.size = path.stat().st_size
+            seg.load_index()
+            self.segments.append(seg)
+        if self.segments:
+            self._recover(self.segments[-1])
+
+    def _recover(self, seg: Segment):
+        """Find the last whole record of the newest segment; cut off a torn tail."""
+        self._drop_index(seg, seg.size)
+        offset = seg.offsets[-1] if seg.offsets else 0
+        last = (seg.seqs[-1] - 1) if seg.seqs else seg.first - 1
+        with open(seg.path, 'rb') as f:
+            for seq, _, _, end in read_records(f, offset, seg.size):
+                if seq != last + 1:
+                    break
+                last, offset = seq, end
+        if offset < seg.size:
+            print(f"[history] #{self.room}: dropping {seg.size - offset} torn bytes from {seg.path.name}")
+            os.truncate(seg.path, offset)
+            seg.size = offset
+        # entries past the end go; missing ones are not needed, the scan starts earlier
+        self._drop_index(seg, offset)
+        with open(seg.index_path, 'wb') as f:
+            f.write(b''.join(IDX.pack(s, o) for s, o in zip(seg.seqs, seg.offsets)))
+        self.since_index = offset - (seg.offsets[-1] if seg.offsets else 0)
+        self.next_seq = last + 1
+        self.durable_seq = last
+
+    @staticmethod
+    def _drop_index(seg: Segment, end: int):
+        while seg.offsets and seg.offsets[-1] >= end:
+            seg.offsets.pop()
+            seg.seqs.pop()
+
+    @property
+    def first_seq(self) -> int:
+        return self.segments[0].first if self.segments else self.next_seq
+
+    # ------------------------------------------------------------ writer thread
+
+    def write(self, seq: int, ts: float, body: bytes):
+        rec = REC.pack(len(body), seq, ts) + body
+        seg = self.segments[-1] if self.segments else None
+        if seg is None or (seg.size and seg.size + len(rec) > SEGMENT_BYTES):
+            seg = self._rotate(seq)
+        elif self.file is None:
+            self._open(seg)
+        if seg.size == 0 or self.since_index >= INDEX_EVERY:
+            seg.add_index(seq, seg.size)
+            self.index_file.write(IDX.pack(seq, seg.size))
+            self.since_index = 0
+        self.file.write(rec)
+        seg.size += len(rec)
+        self.since_index += len(rec)
+
+    def _open(self, seg: Segment):
+        self.file = open(seg.path, 'ab')
+        self.index_file = open(seg.index_path, 'ab')
+
+    def _rotate(self, seq: int) -> Segment:
+        self.close()
+        self.dir.mkdir(parents=True, exist_ok=True)
+        seg = Segment(self.dir / f'{seq:020d}.log', seq)
+        self._open(seg)
+        with self.lock:
+            self.segments.append(seg)
+        return seg
+
+    def sync(self):
+        if self.file:
+            self.file.flush()
+            self.index_file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file:
+            self.sync()
+            self.file.close()
+            self.index_file.close()
+            self.file = self.index_file = None
+
+    # ------------------------------------------------------------ readers
+
+    def read(self, lo: int, hi: int) -> List[Dict]:
+        """Records lo..hi (all durable), oldest first, stopping at PAGE_BYTES."""
+        with self.lock:
+            segments = list(self.segments)
+        i = max(0, bisect.bisect_right([s.first for s in segments], lo) - 1)
+        out, size, seq = [], 0, lo
+        for seg in segments[i:]:
+            with open(seg.path, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                for rec_seq, ts, body, _ in read_records(f, seg.start(seq), f.tell()):
+                    if rec_seq < lo:
+                        continue
+                    if rec_seq > hi or size + len(body) > PAGE_BYTES and out:
+                        return out
+                    header = json.loads(body)
+                    header['seq'], header['ts'] = rec_seq, round(ts, 3)
+                    out.append(header)
+                    size += len(body)
+                    seq = rec_seq + 1
+        return out
+
+class MessageLog:
+    """The history of every room, under root/<quoted room name>/."""
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.rooms: Dict[str, RoomLog] = {}
+        self.lock = threading.Lock()            # guards rooms and the seq counters
+        self.cond = threading.Condition()       # guards pending
+        self.pending: List[Tuple[RoomLog, int, float, Dict]] = []
+        self.closed = False
+        self.writer = threading.Thread(target=self._run, daemon=True)
+        self.writer.start()
+
+    def _room(self, room: str) -> RoomLog:
+        log = self.rooms.get(room)
+        if log is None:
+            with self.lock:
+                log = self.rooms.get(room)
+                if log is None:
+                    log = self.rooms[room] = RoomLog(self.root, room)
+        return log
+
+    def append(self, room: str, header: Dict) -> int:
+        """Queue header for room's log and set header['seq']; returns the seq.
+        header must not change afterwards (it is encoded by the writer thread)."""
+        log = self._room(room)
+        with self.lock:
+            seq = header['seq'] = log.next_seq
+            log.next_seq += 1
+            # enqueue under the seq lock so the writer sees seqs in order
+            with self.cond:
+                self.pending.append((log, seq, time.time(), header))
+                self.cond.notify()
+        return seq
+
+    def last_seq(self, room: str) -> int:
+        return self._room(room).next_seq - 1
+
+    def get(self, room: str, seq: int) -> Optional[Dict]:
+        """The record seq of room if it is on disk already (does not wait)."""
+        log = self._room(room)
+        if not log.first_seq <= seq <= log.durable_seq:
+            return None
+        records = log.read(seq, seq)
+        return records[0] if records else None
+
+    def room_names(self) -> List[str]:
+        """Rooms that have a log under root."""
+        return sorted(urllib.parse.unquote(p.name) for p in self.root.iterdir()
+                      if p.is_dir() and any(p.glob('*.log')))
+
+    def history(self, room: str, before: int = None, after: int = None, limit: int = 50) -> Tuple[List[Dict], int, int]:
+        """A page of room's history: the limit records before seq before (default: the newest),
+        or the limit records after seq after. Returns (records, first seq, last seq) of the log."""
+        log = self._room(room)
+        limit = max(1, min(int(limit), PAGE_MAX))
+        last = self._wait(log, log.next_seq - 1)
+        first = log.first_seq
+        if after is not None:
+            lo = max(int(after) + 1, first)
+            hi = min(lo + limit - 1, last)
+        else:
+            hi = last if before is None else min(int(before) - 1, last)
+            lo = max(hi - limit + 1, first)
+        records = log.read(lo, hi) if lo <= hi else []
+        if after is None and records and records[-1]['seq'] < hi:
+            # a byte-capped page going backwards keeps the newest end
+            records = log.read(hi - len(records) + 1, hi)
+        return records, first, last
+
+    def _wait(self, log: RoomLog, seq: int) -> int:
+        deadline = time.monotonic() + SYNC_WAIT
+        with self.cond:
+            while log.durable_seq < seq and not self.closed:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self.cond.wait(left)
+            return log.durable_seq
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                batch, self.pending = self.pending, []
+                if not batch and self.closed:
+                    return
+            touched = {}
+            for log, seq, ts, header in batch:
+                try:
+                    log.write(seq, ts, json.dumps(header).encode('utf-8'))
+                except OSError as e:
+                    print(f"[history] cannot write #{log.room}: {e}")
+                touched[log] = seq
+            for log, seq in touched.items():
+                try:
+                    log.sync()
+                except OSError as e:
+                    print(f"[history] cannot sync #{log.room}: {e}")
+            with self.cond:
+                for log, seq in touched.items():
+                    log.durable_seq = seq
+                self.cond.notify_all()
+
+    def close(self):
+        """Write out what is queued and close the segments."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.writer.join(5)
+        for log in list(self.rooms.values()):
+            log.close()
+
+def open_history(root: Path, worker: int = None) -> MessageLog:
+    """The log of this server process; each of --workers keeps its own (complete) copy."""
+    return MessageLog(root / f'worker-{worker}' if worker is not None else root)
@@ -0,0 +1,266 @@
+# outbound.py
+# Bounded per-client outbound queues for the chat server
+#
+# Every connection gets its own queue drained by a dedicated writer, so a
+# broadcast only enqueues and one slow receiver never blocks the others.
+# What happens when a client's queue is full is decided by the policy:
+#   drop_oldest -> discard the oldest queued frame (whole frames, framing stays intact)
+#   disconnect  -> close the slow consumer
+#   spill       -> append further frames to a temp file and replay them in order
+# Frames are dropped or spilled whole, so a file payload is never cut in half.
+# File transfers that can be sent in chunks go to a second, lower-priority
+# lane (see lanes.py) so they never hold up chat frames.
+
+import socket
+import struct
+import tempfile
+import threading
+from collections import deque
+from typing import Optional, Tuple, Union
+
+from framing import send_parts
+from lanes import Bulk, BulkLane
+from metrics import BYTES_OUT
+from relay import FileSlice, UploadStream, send_slice, send_stream
+
+POLICIES = ('drop_oldest', 'disconnect', 'spill')
+DEFAULT_QUEUE_SIZE = 256       # frames
+DEFAULT_POLICY = 'disconnect'
+WRITE_BATCH = 64               # buffers coalesced into one sendmsg() by the writer
+
+# A queued frame is a tuple of parts written back to back, e.g. (len+header, payload).
+# A part is a byte buffer shared between recipients (never copied), an
+# UploadStream whose bytes are read from disk as the upload arrives (legacy
+# 'file' frames to clients without chunk support), or a FileSlice of an open file.
+# The bulk lane's pending queue holds (Bulk,) frames.
+Frame = Tuple[Union[bytes, UploadStream, FileSlice, Bulk], ...]
+
+class FrameQueue:
+    """Bounded FIFO of frames applying a full-queue policy. Not thread-safe."""
+
+    def __init__(self, maxsize: int = DEFAULT_QUEUE_SIZE, policy: str = DEFAULT_POLICY):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown queue policy: {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.frames = deque()
+        self.dropped = 0
+        self._spill = None
+        self._spill_pos = 0
+        self._spilled = 0
+        self._spill_refs = {}     # spilled non-bytes parts, kept by reference
+        self._next_ref = 0
+
+    def __len__(self):
+        return len(self.frames) + self._spilled
+
+    def push(self, frame: Frame) -> bool:
+        """Queue a frame. Returns False if the consumer should be disconnected."""
+        if self._spilled or len(self.frames) >= self.maxsize:
+            if self.policy == 'disconnect':
+                return False
+            if self.policy == 'spill':
+                self._spill_write(frame)
+                return True
+            _discard(self.frames.popleft())
+            self.dropped += 1
+        self.frames.append(frame)
+        return True
+
+    def pop(self) -> Optional[Frame]:
+        if self.frames:
+            return self.frames.popleft()
+        if self._spilled:
+            return self._spill_read()
+        return None
+
+    def pop_batch(self, limit: int = WRITE_BATCH) -> Optional[Frame]:
+        """Pop the next frame; if it is plain bytes, merge in the plain-bytes
+        frames queued right behind it (up to limit parts) so they go out together."""
+        frame = self.pop()
+        if frame is None or not _plain(frame):
+            return frame
+        parts = list(frame)
+        while len(parts) < limit and self.frames and _plain(self.frames[0]):
+            parts.extend(self.frames.popleft())
+        return tuple(parts)
+
+    def close(self):
+        """Drop everything queued; transfers that never started are closed too."""
+        for frame in self.frames:
+            _discard(frame)
+        self.frames.clear()
+        _discard(self._spill_refs.values())
+        if self._spill:
+            self._spill.close()
+            self._spill = None
+        self._spilled = 0
+        self._spill_refs.clear()
+
+    # spill file layout: [4-byte part count] then per part either
+    # [b'B'][8-byte len][bytes] or [b'S'][8-byte ref] for an UploadStream/Bulk
+    def _spill_write(self, frame: Frame):
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile(prefix='chat_spill_')
+        self._spill.seek(0, 2)
+        parts = [p for p in frame if p]
+        self._spill.write(struct.pack('>I', len(parts)))
+        for p in parts:
+            if not isinstance(p, bytes):
+                self._spill_refs[self._next_ref] = p
+                self._spill.write(b'S' + struct.pack('>Q', self._next_ref))
+                self._next_ref += 1
+            else:
+                self._spill.write(b'B' + struct.pack('>Q', len(p)))
+                self._spill.write(p)
+        self._spilled += 1
+
+    def _spill_read(self) -> Frame:
+        f = self._spill
+        f.seek(self._spill_pos)
+        count = struct.unpack('>I', f.read(4))[0]
+        parts = []
+        for _ in range(count):
+            kind = f.read(1)
+            n = struct.unpack('>Q', f.read(8))[0]
+            parts.append(self._spill_refs.pop(n) if kind == b'S' else f.read(n))
+        self._spill_pos = f.tell()
+        self._spilled -= 1
+        if not self._spilled:
+            # fully replayed: reuse the file from the start
+            f.seek(0)
+            f.truncate()
+            self._spill_pos = 0
+        return tuple(parts)
+
+def _discard(parts):
+    # a Bulk holds open files and stream listeners until closed
+    for p in parts:
+        if isinstance(p, Bulk):
+            p.close()
+
+def _plain(frame: Frame) -> bool:
+    return all(p is None or isinstance(p, bytes) for p in frame)
+
+def frame_size(frame: Frame) -> int:
+    """Bytes a popped frame puts on the wire."""
+    n = 0
+    for p in frame:
+        if isinstance(p, UploadStream):
+            n += p.size
+        elif isinstance(p, FileSlice):
+            n += p.count
+        elif p:
+            n += len(p)
+    return n
+
+class OutboundQueue:
+    """FrameQueue drained by a dedicated writer thread onto a blocking socket.
+
+    Control frames go first; between them the writer sends bulk chunk frames
+    (bulk_rate bytes/s at most, 0 = unlimited).
+    """
+
+    def __init__(self, sock: socket.socket, maxsize: int = DEFAULT_QUEUE_SIZE,
+                 policy: str = DEFAULT_POLICY, bulk_rate: float = 0):
+        self.sock = sock
+        self.queue = FrameQueue(maxsize, policy)
+        self.bulk = BulkLane(FrameQueue(maxsize, policy), bulk_rate)
+        self.cond = threading.Condition()
+        self.closed = False
+        self.kicked = False     # a live upload in the bulk lane has new data
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @property
+    def depth(self) -> int:
+        return len(self.queue) + len(self.bulk)
+
+    @property
+    def dropped(self) -> int:
+        return self.queue.dropped + self.bulk.pending.dropped
+
+    def put(self, *parts: bytes) -> bool:
+        """Enqueue one frame; never blocks on the network. False if the client is gone."""
+        with self.cond:
+            if self.closed:
+                return False
+            if not self.queue.push(parts):
+                self._close_locked()
+                return False
+            self.cond.notify()
+            return True
+
+    def put_bulk(self, bulk: Bulk) -> bool:
+        """Queue a chunked transfer behind all control frames."""
+        with self.cond:
+            if self.closed:
+                bulk.close()
+                return False
+            if not self.bulk.pending.push((bulk,)):
+                bulk.close()
+                self._close_locked()
+                return False
+            self.cond.notify()
+            return True
+
+    def close(self):
+        with self.cond:
+            self._close_locked()
+
+    def _kick(self):
+        with self.cond:
+            self.kicked = True
+            self.cond.notify()
+
+    def _close_locked(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.close()
+        self.bulk.pending.close()
+        self.cond.notify()
+        # wake the reader thread so the connection gets cleaned up
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _run(self):
+        try:
+            while True:
+                with self.cond:
+                    if self.closed:
+                        return
+                    frame = self.queue.pop_batch()
+                    if frame is None:
+                        self.bulk.activate(self._kick)
+                        self.kicked = False
+                wait = 0.0
+                if frame is None:
+                    # the active transfers are only touched by this thread
+                    frame, wait = self.bulk.next_frame()
+                if frame is None:
+                    with self.cond:
+                        if not (self.closed or len(self.queue) or self.bulk.can_activate() or self.kicked):
+                            self.cond.wait(wait or None)
+                    continue
+                pending = []    # byte parts waiting to go out in one sendmsg()
+                for part in frame:
+                    if isinstance(part, (UploadStream, FileSlice)):
+                        send_parts(self.sock, pending)
+                        pending = []
+                        if isinstance(part, UploadStream):
+                            send_stream(self.sock, part)
+                        else:
+                            send_slice(self.sock, part)
+                    elif part:
+                        pending.append(part)
+                send_parts(self.sock, pending)
+                BYTES_OUT.inc(frame_size(frame))
+        except (OSError, ValueError):
+            # ValueError: socket.sendfile() on a socket closed under us
+            self.close()
+        finally:
+            with self.cond:
+                self.bulk.close()
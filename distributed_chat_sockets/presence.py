@@ -0,0 +1,64 @@
+# presence.py
+# Who is online, for the clients' user lists
+#
+# The server keeps one roster: the users joined here (a dropped user whose
+# session is kept still counts, as the others have not been told it left)
+# plus the users of the other cluster nodes. Clients that join with the
+# 'presence' feature get the whole roster once as a snapshot and then only
+# the changes. Changes are not sent as they happen: every FLUSH_INTERVAL the
+# roster is compared with what the clients were last told and the difference
+# goes out as one frame, so a storm of joins costs each client a frame per
+# interval, and someone who comes and goes within one is never mentioned.
+#
+#   {"type": "presence", "snapshot": true, "users": ["alice", "bob"]}
+#   {"type": "presence", "online": ["carol"], "offline": ["bob"]}
+
+import threading
+from typing import Callable, Dict, Iterable, Set
+
+FLUSH_INTERVAL = 0.25     # seconds changes are collected before clients hear of them
+
+class Presence:
+    """The roster, and what clients were last told of it.
+
+    remote() returns the names online on other nodes. Frames are handed to
+    send() with the roster lock held, so a snapshot and the deltas that
+    follow it reach a client in order; send() must only queue them.
+    """
+
+    def __init__(self, remote: Callable[[], Iterable[str]] = None):
+        self.remote = remote
+        self.local: Dict[str, int] = {}     # name -> clients or kept sessions holding it
+        self.sent: Set[str] = set()         # roster as of the last flush
+        self.lock = threading.Lock()
+
+    def online(self, name: str):
+        with self.lock:
+            self.local[name] = self.local.get(name, 0) + 1
+
+    def offline(self, name: str):
+        with self.lock:
+            n = self.local.get(name, 0) - 1
+            if n > 0:
+                self.local[name] = n
+            else:
+                self.local.pop(name, None)
+
+    def snapshot(self, send: Callable[[Dict], None]):
+        """Send the roster to a client that just joined; later flushes continue from it.
+        The client must already be among those flush() sends to."""
+        with self.lock:
+            send({'type': 'presence', 'snapshot': True, 'users': sorted(self.sent)})
+
+    def flush(self, send: Callable[[Dict], None]):
+        """Send what changed since the last flush, if anything, as one frame."""
+        with self.lock:
+            users = set(self.local)
+            if self.remote:
+                users.update(self.remote())
+            if users == self.sent:
+                return
+            frame = {'type': 'presence', 'online': sorted(users - self.sent),
+                     'offline': sorted(self.sent - users)}
+            self.sent = users
+            send(frame)
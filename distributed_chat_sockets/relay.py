@@ -0,0 +1,253 @@
+# relay.py
+# Streaming file relay for the chat server
+#
+# An upload is read from the sender in fixed-size chunks and written straight
+# to a staging file in the blob store. Recipients do not get a copy in memory: their writers follow
+# the file on disk as it grows, so peak memory per transfer is one chunk
+# buffer per reader/writer whatever the file size.
+#
+# Fan-out uses sendfile() where the OS has it, so the bytes go from the page
+# cache to the recipient sockets without passing through Python at all.
+
+import asyncio
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+from typing import BinaryIO
+
+CHUNK_SIZE = 64 * 1024
+# zero-copy fan-out; turned off with server_tcp.py --no-sendfile, or where
+# os.sendfile is missing the read()+send() path below is used instead
+USE_SENDFILE = hasattr(os, 'sendfile')
+SENDFILE_SPAN = 1024 * 1024    # max bytes per loop.sendfile() call (asyncio engine)
+
+class UploadStream:
+    """A file being written to disk that recipients can stream while it grows.
+
+    Queued as the payload part of a 'file' frame. If the upload is cut short
+    the recipients' copies are padded with zeros so their framing stays
+    intact, and the server follows up with a system notice.
+    """
+
+    def __init__(self, path: Path, size: int):
+        self.path = path
+        self.size = size
+        self.written = 0
+        self.failed = False
+        self.cond = threading.Condition()
+        self._waiters = []    # futures of asyncio writers waiting for data
+        self._listeners = []  # callables run on every advance()/fail() (chunked writers)
+
+    @classmethod
+    def complete(cls, path: Path, size: int) -> 'UploadStream':
+        """A stream over a file that is already fully on disk."""
+        stream = cls(path, size)
+        stream.written = size
+        return stream
+
+    def advance(self, n: int):
+        with self.cond:
+            self.written += n
+            self.cond.notify_all()
+        self._wake()
+
+    def fail(self):
+        with self.cond:
+            self.failed = True
+            self.cond.notify_all()
+        self._wake()
+
+    def add_listener(self, fn):
+        with self.cond:
+            self._listeners.append(fn)
+
+    def remove_listener(self, fn):
+        with self.cond:
+            if fn in self._listeners:
+                self._listeners.remove(fn)
+
+    def wait_for(self, offset: int) -> int:
+        """Block until data past offset is on disk (or the upload failed)."""
+        with self.cond:
+            while self.written <= offset and not self.failed:
+                self.cond.wait()
+            return self.written
+
+    async def wait_for_async(self, offset: int) -> int:
+        while self.written <= offset and not self.failed:
+            fut = asyncio.get_running_loop().create_future()
+            self._waiters.append(fut)
+            await fut
+        return self.written
+
+    def _wake(self):
+        # asyncio engine only: advance()/fail() are called on the loop thread
+        waiters, self._waiters = self._waiters, []
+        for fut in waiters:
+            if not fut.done():
+                fut.set_result(None)
+        with self.cond:
+            listeners = list(self._listeners)
+        for fn in listeners:
+            fn()
+
+    def chunks(self, offset: int, end: int, f):
+        """Yield the on-disk bytes in [offset, end) in CHUNK_SIZE pieces."""
+        f.seek(offset)
+        while offset < end:
+            data = f.read(min(CHUNK_SIZE, end - offset))
+            if not data:
+                return
+            offset += len(data)
+            yield data
+
+    def open(self):
+        # path may be swapped to the final blob when the upload completes
+        with self.cond:
+            try:
+                return open(self.path, 'rb')
+            except FileNotFoundError:
+                # removed after a failed upload before we got to it
+                return None
+
+class FileSlice:
+    """Frame part: count bytes of an open file starting at offset (sent with sendfile)."""
+    __slots__ = ('f', 'offset', 'count')
+
+    def __init__(self, f, offset: int, count: int):
+        self.f = f
+        self.offset = offset
+        self.count = count
+
+def send_slice(sock: socket.socket, part: FileSlice):
+    if USE_SENDFILE:
+        sent = sock.sendfile(part.f, part.offset, part.count)
+        if sent < part.count:
+            raise ConnectionError('file shrank under sendfile')
+        return
+    part.f.seek(part.offset)
+    sock.sendall(part.f.read(part.count))
+
+async def send_slice_async(writer: asyncio.StreamWriter, part: FileSlice):
+    # copied rather than loop.sendfile(): that pauses reading from the client
+    # for every call, and back-to-back chunk calls would starve its chat frames
+    part.f.seek(part.offset)
+    writer.write(part.f.read(part.count))
+
+def _padding(remaining: int):
+    zeros = bytes(min(CHUNK_SIZE, remaining))
+    while remaining > 0:
+        n = min(CHUNK_SIZE, remaining)
+        yield zeros[:n]
+        remaining -= n
+
+def send_stream(sock: socket.socket, stream: UploadStream):
+    """Write the payload of stream to sock as the upload progresses."""
+    sent = 0
+    f = None
+    try:
+        while sent < stream.size:
+            avail = stream.wait_for(sent)
+            if f is None and avail > sent:
+                f = stream.open()
+            if avail <= sent or f is None:
+                for pad in _padding(stream.size - sent):
+                    sock.sendall(pad)
+                return
+            if USE_SENDFILE:
+                # socket.sendfile() itself falls back to send() for odd sockets/files
+                sent += sock.sendfile(f, sent, avail - sent)
+                continue
+            for data in stream.chunks(sent, avail, f):
+                sock.sendall(data)
+                sent += len(data)
+    finally:
+        if f:
+            f.close()
+
+async def send_stream_async(writer: asyncio.StreamWriter, stream: UploadStream):
+    sent = 0
+    f = None
+    try:
+        while sent < stream.size:
+            avail = await stream.wait_for_async(sent)
+            if f is None and avail > sent:
+                f = stream.open()
+            if avail <= sent or f is None:
+                for pad in _padding(stream.size - sent):
+                    writer.write(pad)
+                    await writer.drain()
+                return
+            if USE_SENDFILE:
+                await writer.drain()
+                loop = asyncio.get_running_loop()
+                # loop.sendfile() pauses reading from this client until it returns,
+                # so go in bounded pieces to keep its chat frames flowing
+                count = min(avail - sent, SENDFILE_SPAN)
+                sent += await loop.sendfile(writer.transport, f, sent, count, fallback=True)
+                # two loop turns: one for the selector to see pending reads, one
+                # for their callbacks to run before the next call pauses reading
+                await asyncio.sleep(0)
+                await asyncio.sleep(0)
+                continue
+            for data in stream.chunks(sent, avail, f):
+                writer.write(data)
+                await writer.drain()
+                sent += len(data)
+    finally:
+        if f:
+            f.close()
+
+def recv_to_file(sock: socket.socket, f: BinaryIO, stream: UploadStream, hasher=None, bucket=None) -> bool:
+    """Read stream.size bytes from sock (or its framing.FrameReader) into f in CHUNK_SIZE pieces.
+
+    Uses one reusable buffer and feeds hasher as it goes; returns False if
+    the sender went away early. bucket (a lanes.TokenBucket) paces the reads.
+    """
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    remaining = stream.size
+    while remaining > 0:
+        want = min(CHUNK_SIZE, remaining)
+        got = 0
+        while got < want:
+            n = sock.recv_into(view[got:want])
+            if not n:
+                # keep what did arrive so recipients get the real prefix
+                f.write(view[:got])
+                stream.advance(got)
+                return False
+            got += n
+        f.write(view[:got])
+        if hasher:
+            hasher.update(view[:got])
+        stream.advance(got)
+        remaining -= got
+        if bucket:
+            pause = bucket.take(got)
+            if pause:
+                time.sleep(pause)
+    return True
+
+async def recv_to_file_async(reader: asyncio.StreamReader, f: BinaryIO, stream: UploadStream,
+                             hasher=None, bucket=None) -> bool:
+    remaining = stream.size
+    while remaining > 0:
+        try:
+            chunk = await reader.readexactly(min(CHUNK_SIZE, remaining))
+        except asyncio.IncompleteReadError as e:
+            f.write(e.partial)
+            stream.advance(len(e.partial))
+            return False
+        # small sequential write to the page cache; not worth an executor hop
+        f.write(chunk)
+        if hasher:
+            hasher.update(chunk)
+        stream.advance(len(chunk))
+        remaining -= len(chunk)
+        # readexactly() does not yield while data is buffered; without this a
+        # fast upload would starve every other connection on the loop
+        await asyncio.sleep(bucket.take(len(chunk)) if bucket else 0)
+    return True
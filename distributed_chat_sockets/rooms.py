@@ -0,0 +1,107 @@
+# rooms.py
+# Room membership and username lookup, shared by both server engines
+#
+# Every joined client is in DEFAULT_ROOM and may join more with join_room.
+# A broadcast only looks at the members of its room, so it costs
+# O(room members) rather than O(connections). Each room has its own lock;
+# the registry lock is only taken to create or drop a room, so joins and
+# leaves in different rooms never wait for each other. Direct messages find
+# their recipient through the username index.
+
+import threading
+from typing import Dict, List, Optional
+
+DEFAULT_ROOM = 'lobby'
+MAX_ROOM_NAME = 64
+
+def valid_room(name) -> bool:
+    # '.' and '..' would name the history directory itself or its parent (msglog.py)
+    return isinstance(name, str) and 0 < len(name) <= MAX_ROOM_NAME and name.isprintable() and \
+        name not in ('.', '..')
+
+class Room:
+    def __init__(self, name: str):
+        self.name = name
+        self.members = set()
+        self.lock = threading.Lock()
+        self.closed = False     # dropped from the registry; join a fresh one instead
+
+class Rooms:
+    """room name -> member set. Members are the engines' Client objects."""
+
+    def __init__(self):
+        self.rooms: Dict[str, Room] = {}
+        self.lock = threading.Lock()    # guards the dict, not the members
+
+    def join(self, name: str, client) -> bool:
+        """Add client to room name (created on first join). False if already a member."""
+        while True:
+            room = self.rooms.get(name)
+            if room is None:
+                with self.lock:
+                    room = self.rooms.setdefault(name, Room(name))
+            with room.lock:
+                if room.closed:
+                    continue
+                if client in room.members:
+                    return False
+                room.members.add(client)
+                return True
+
+    def leave(self, name: str, client) -> bool:
+        """Remove client from room name; the room goes away with its last member."""
+        room = self.rooms.get(name)
+        if room is None:
+            return False
+        with room.lock:
+            if client not in room.members:
+                return False
+            room.members.discard(client)
+            if not room.members:
+                with self.lock:
+                    if self.rooms.get(name) is room:
+                        del self.rooms[name]
+                room.closed = True
+        return True
+
+    def members(self, name: str) -> List:
+        """Snapshot of a room's members (empty if there is no such room)."""
+        room = self.rooms.get(name)
+        if room is None:
+            return []
+        with room.lock:
+            return list(room.members)
+
+    def count(self, name: str) -> int:
+        room = self.rooms.get(name)
+        return len(room.members) if room else 0
+
+class Users:
+    """username -> client, for direct messages. The latest join of a name wins."""
+
+    def __init__(self):
+        self.by_name: Dict[str, object] = {}
+        self.lock = threading.Lock()
+
+    def add(self, name: str, client):
+        with self.lock:
+            self.by_name[name] = client
+
+    def remove(self, name: str, client):
+        with self.lock:
+            if self.by_name.get(name) is client:
+                del self.by_name[name]
+
+    def get(self, name: str) -> Optional[object]:
+        return self.by_name.get(name)
+
+def tag_room(header: Dict, room: Optional[str]) -> Dict:
+    """Mark an outgoing header with its room; DEFAULT_ROOM frames stay unmarked for older clients."""
+    if room and room != DEFAULT_ROOM:
+        header['room'] = room
+    return header
+
+def target_room(client, header: Dict) -> Optional[str]:
+    """The room a client's frame is addressed to, or None if the client is not in it."""
+    room = header.get('room') or DEFAULT_ROOM
+    return room if isinstance(room, str) and room in client.rooms else None
@@ -0,0 +1,463 @@
+# search.py
+# Full-text search over the room history (msglog.py)
+#
+# Every chat message gets a doc id, and an inverted index maps each word to
+# the ids (and in-message counts) of the messages containing it. New
+# messages go to an in-memory tail; every FLUSH_DOCS messages a flusher
+# thread writes the tail out as an immutable segment file, which is then
+# read through mmap. Segments are merged into one once there are more than
+# MERGE_AT of them. A doc table (docs.bin) holds room, user, seq, time and
+# length per doc id; the text itself stays in the message log.
+#
+# state.json records what the files cover (docs and last seq per room) and
+# is replaced only after they are synced. On startup the index opens the
+# files as they are and re-reads from the message log only what came after
+# state.json: a restart does not tokenize the whole history again.
+#
+# Results are the messages containing every query word, ranked by BM25 and
+# then by recency, filtered by room, username and time. A search walks the
+# postings of the query's rarest word, newest first, and looks each doc up in
+# the other words' postings by bisection; the longer lists are never read
+# whole. It stops after SCAN_MAX docs, so for a query made only of very
+# common words the results (and 'total') come from the recent messages.
+
+import bisect
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from array import array
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from msglog import PAGE_MAX, MessageLog
+
+FLUSH_DOCS = 50_000       # messages kept in memory before the tail becomes a segment
+MERGE_AT = 8              # segments before they are merged into one
+MAX_TERMS = 8             # query words used, at most
+RESULTS_MAX = 100         # results per search, at most
+SCAN_MAX = 20_000         # docs of the rarest query word looked at per search, newest first
+K1, B = 1.2, 0.75         # BM25 parameters
+
+TOKEN = re.compile(r'\w+')
+HEAD = struct.Struct('<4sIIIII')    # magic, terms, term bytes, postings, first doc, docs
+TERM = struct.Struct('<IHII')       # offset and length in the term bytes, first posting, postings
+DOC = struct.Struct('<IIQdH')       # room id, user id, seq, unix time, words
+MAGIC = b'CSI1'
+NATIVE_LE = struct.pack('=I', 1) == struct.pack('<I', 1)
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in TOKEN.findall(text.lower()) if len(t) <= 40][:500]
+
+class Tail:
+    """Postings of the newest docs, in memory."""
+
+    def __init__(self, first: int):
+        self.first = first
+        self.docs: List[tuple] = []
+        self.texts: List[str] = []              # not durable yet in the message log, maybe
+        self.postings: Dict[str, tuple] = {}    # term -> (array of doc ids, array of counts)
+        self.rooms: Dict[str, int] = {}         # room -> last seq in this tail
+        self.words = 0
+
+    def add(self, doc: int, terms: Dict[str, int], entry: tuple, text: str, room: str, seq: int):
+        self.texts.append(text)
+        for term, count in terms.items():
+            ids, tfs = self.postings.setdefault(term, (array('I'), array('B')))
+            ids.append(doc)
+            tfs.append(min(count, 255))
+        # appended last: searches only look at docs below first + len(docs)
+        self.docs.append(entry)
+        self.rooms[room] = seq
+        self.words += entry[4]
+
+    def lookup(self, term: str):
+        return self.postings.get(term)
+
+class Segment:
+    """An immutable, mmapped index file for docs first .. first + count - 1."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.terms, blob, self.npostings, self.first, self.count = HEAD.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path.name} is not an index segment')
+        self.table = HEAD.size
+        self.blob = self.table + self.terms * TERM.size
+        self.ids = self.blob + blob
+        self.tfs = self.ids + 4 * self.npostings
+
+    def term(self, i: int):
+        off, length, start, count = TERM.unpack_from(self.mm, self.table + i * TERM.size)
+        return self.mm[self.blob + off:self.blob + off + length], start, count
+
+    def lookup(self, term: str):
+        key = term.encode('utf-8')
+        lo, hi = 0, self.terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            t, start, count = self.term(mid)
+            if t < key:
+                lo = mid + 1
+            elif t > key:
+                hi = mid
+            else:
+                return self._postings(start, count)
+        return None
+
+    def _postings(self, start: int, count: int):
+        # views into the map, not copies: a search only reads the few ids it bisects to
+        view = memoryview(self.mm)
+        ids = view[self.ids + 4 * start:self.ids + 4 * (start + count)]
+        ids = ids.cast('I') if NATIVE_LE else struct.unpack(f'<{count}I', ids)
+        return ids, view[self.tfs + start:self.tfs + start + count]
+
+    def items(self):
+        for i in range(self.terms):
+            t, start, count = self.term(i)
+            yield (t.decode('utf-8'), struct.unpack_from(f'<{count}I', self.mm, self.ids + 4 * start),
+                   self.mm[self.tfs + start:self.tfs + start + count])
+
+def write_segment(path: Path, first: int, count: int, postings):
+    """postings: (term, doc ids, counts) sorted by term."""
+    table, blob, ids, tfs = bytearray(), bytearray(), array('I'), bytearray()
+    for term, term_ids, term_tfs in postings:
+        key = term.encode('utf-8')
+        table += TERM.pack(len(blob), len(key), len(ids), len(term_ids))
+        blob += key
+        ids.extend(term_ids)
+        tfs += bytes(term_tfs)
+    if struct.pack('=I', 1) != struct.pack('<I', 1):
+        ids.byteswap()
+    tmp = path.with_suffix('.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(HEAD.pack(MAGIC, len(table) // TERM.size, len(blob), len(ids), first, count))
+        f.write(table)
+        f.write(blob)
+        f.write(ids.tobytes())
+        f.write(tfs)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+class SearchIndex:
+    def __init__(self, root: Path, msglog: MessageLog):
+        self.root = root
+        self.msglog = msglog
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()            # guards the tails, segments and names
+        self.cond = threading.Condition(self.lock)
+        self.closed = False
+        state = self._read_state()
+        self.flushed = state.get('docs', 0)
+        self.flushed_words = state.get('words', 0)
+        self.total_words = self.flushed_words
+        self.room_seq: Dict[str, int] = state.get('rooms', {})  # last seq in the files, per room
+        self.room_names: List[str] = state.get('room_names', [])
+        self.user_names: List[str] = state.get('user_names', [])
+        self.room_ids = {n: i for i, n in enumerate(self.room_names)}
+        self.user_ids = {n: i for i, n in enumerate(self.user_names)}
+        self.segments = self._open_segments()
+        self.docs_path = self.root / 'docs.bin'
+        with open(self.docs_path, 'ab') as f:
+            f.truncate(self.flushed * DOC.size)     # docs of a flush that never finished
+        self.docs_mm = self._map_docs()
+        self.tail = Tail(self.flushed)
+        self.flushing: Optional[Tail] = None
+        self.flusher = threading.Thread(target=self._run, daemon=True)
+        self.flusher.start()
+        self._catch_up()
+
+    # ------------------------------------------------------------ files
+
+    def _read_state(self) -> Dict:
+        try:
+            return json.loads((self.root / 'state.json').read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _write_state(self, docs: int, words: int, rooms: Dict[str, int]):
+        state = {'docs': docs, 'words': words, 'rooms': rooms,
+                 'room_names': self.room_names, 'user_names': self.user_names}
+        tmp = self.root / 'state.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.root / 'state.json')
+
+    def _open_segments(self) -> List[Segment]:
+        """Segments within the recorded docs; a merged one replaces those it covers."""
+        found = []
+        for path in sorted(self.root.glob('*.seg')):
+            try:
+                seg = Segment(path)
+            except (OSError, ValueError):
+                path.unlink()
+                continue
+            if seg.first + seg.count > self.flushed:
+                path.unlink()       # written, but state.json never said so
+                continue
+            found.append(seg)
+        found.sort(key=lambda s: (s.first, -s.count))
+        segments, end = [], 0
+        for seg in found:
+            if seg.first < end:
+                seg.path.unlink()   # covered by a merged segment
+            else:
+                segments.append(seg)
+                end = seg.first + seg.count
+        return segments
+
+    def _map_docs(self):
+        if self.flushed == 0:
+            return None
+        with open(self.docs_path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _catch_up(self):
+        """Index what the message log has beyond the index files."""
+        started, n = time.monotonic(), 0
+        for room in self.msglog.room_names():
+            after = self.room_seq.get(room, 0)
+            while True:
+                records, _, last = self.msglog.history(room, after=after, limit=PAGE_MAX)
+                for rec in records:
+                    if rec.get('type') == 'message':
+                        self.add(room, rec, rec.get('ts'))
+                        n += 1
+                if not records or records[-1]['seq'] >= last:
+                    break
+                after = records[-1]['seq']
+        if n:
+            print(f"[search] indexed {n} messages from the history in {time.monotonic() - started:.1f}s")
+
+    # ------------------------------------------------------------ indexing
+
+    def add(self, room: str, header: Dict, ts: float = None):
+        """Index a room message (header carries its seq)."""
+        if header.get('type') != 'message' or header.get('seq') is None:
+            return
+        words = tokenize(header.get('text', ''))
+        terms: Dict[str, int] = {}
+        for w in words:
+            terms[w] = terms.get(w, 0) + 1
+        with self.lock:
+            room_id = self._name_id(room, self.room_names, self.room_ids)
+            user_id = self._name_id(header.get('username') or '', self.user_names, self.user_ids)
+            doc = self.tail.first + len(self.tail.docs)
+            entry = (room_id, user_id, header['seq'], ts or time.time(), min(len(words), 65535))
+            self.tail.add(doc, terms, entry, header.get('text', ''), room, header['seq'])
+            self.total_words += entry[4]
+            if len(self.tail.docs) >= FLUSH_DOCS and self.flushing is None:
+                self.flushing, self.tail = self.tail, Tail(doc + 1)
+                self.cond.notify()
+
+    @staticmethod
+    def _name_id(name: str, names: List[str], ids: Dict[str, int]) -> int:
+        i = ids.get(name)
+        if i is None:
+            i = ids[name] = len(names)
+            names.append(name)
+        return i
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while self.flushing is None and not self.closed:
+                    self.cond.wait()
+                tail = self.flushing
+            if tail is not None:
+                try:
+                    self._flush(tail)
+                except OSError as e:
+                    # stays searchable in memory, and is indexed again after a restart
+                    print(f"[search] cannot write the index, no longer flushing: {e}")
+                    return
+            with self.lock:
+                if self.closed:
+                    return
+                if len(self.segments) > MERGE_AT:
+                    segments = list(self.segments)
+                else:
+                    continue
+            self._merge(segments)
+
+    def _flush(self, tail: Tail):
+        with open(self.docs_path, 'ab') as f:
+            f.write(b''.join(DOC.pack(*d) for d in tail.docs))
+            f.flush()
+            os.fsync(f.fileno())
+        path = self.root / f'{tail.first:012d}.seg'
+        write_segment(path, tail.first, len(tail.docs),
+                      ((t, ids, tfs) for t, (ids, tfs) in sorted(tail.postings.items())))
+        seg = Segment(path)
+        with self.lock:
+            rooms = dict(self.room_seq)
+            rooms.update(tail.rooms)
+            self._write_state(tail.first + len(tail.docs), self.flushed_words + tail.words, rooms)
+            self.flushed_words += tail.words
+            self.room_seq = rooms
+            self.flushed = tail.first + len(tail.docs)
+            self.segments = self.segments + [seg]
+            self.docs_mm = self._map_docs()
+            # searches now find these docs in the segment (in the same step, or they would count twice)
+            if self.flushing is tail:
+                self.flushing = None
+            elif self.tail is tail:
+                self.tail = Tail(self.flushed)
+
+    def _merge(self, segments: List[Segment]):
+        """Rewrite segments as one (off the chat path; searches keep using the old ones meanwhile)."""
+        merged: Dict[str, tuple] = {}
+        for seg in segments:
+            for term, ids, tfs in seg.items():
+                entry = merged.setdefault(term, (array('I'), bytearray()))
+                entry[0].extend(ids)
+                entry[1].extend(tfs)
+        first = segments[0].first
+        count = segments[-1].first + segments[-1].count - first
+        path = self.root / f'{first:012d}-{count}.seg'
+        try:
+            write_segment(path, first, count, ((t, ids, tfs) for t, (ids, tfs) in sorted(merged.items())))
+            seg = Segment(path)
+        except OSError as e:
+            print(f"[search] cannot merge segments: {e}")
+            return
+        with self.lock:
+            self.segments = [seg] + self.segments[len(segments):]
+        for old in segments:
+            old.path.unlink()
+
+    def close(self):
+        """Write out the tail, so the next start has nothing to re-index."""
+        with self.lock:
+            self.closed = True
+            self.cond.notify()
+        self.flusher.join(30)
+        with self.lock:
+            tail = self.tail if self.flushing is None else None
+        if tail is not None and tail.docs:
+            try:
+                self._flush(tail)
+            except OSError as e:
+                print(f"[search] cannot write the index: {e}")
+
+    # ------------------------------------------------------------ searching
+
+    def search(self, query: str, rooms, room: str = None, username: str = None, since: float = None,
+               until: float = None, limit: int = 20) -> Dict:
+        """Messages in rooms (or just room) containing every word of query, best first.
+        Returns {'results': [{'room', 'seq', 'ts', 'username', 'text', 'score'}], 'total'};
+        both only cover the newest SCAN_MAX docs holding the query's rarest word."""
+        terms = list(dict.fromkeys(tokenize(query)))[:MAX_TERMS]
+        limit = max(1, min(int(limit), RESULTS_MAX))
+        with self.lock:
+            sources = list(self.segments) + [t for t in (self.flushing, self.tail) if t is not None]
+            end = self.tail.first + len(self.tail.docs)
+            docs_mm, flushed = self.docs_mm, self.flushed
+            tails = [t for t in (self.flushing, self.tail) if t is not None]
+            room_ids = {self.room_ids[r] for r in ([room] if room else rooms) if r in self.room_ids}
+            user_id = self.user_ids.get(username) if username else None
+            total_words = self.total_words
+        if not terms or not room_ids or (username and user_id is None):
+            return {'results': [], 'total': 0}
+
+        def doc_entry(doc):
+            if doc < flushed:
+                return DOC.unpack_from(docs_mm, doc * DOC.size)
+            for t in tails:
+                if t.first <= doc < t.first + len(t.docs):
+                    return t.docs[doc - t.first]
+
+        def doc_text(doc, room, seq):
+            for t in tails:
+                if t.first <= doc < t.first + len(t.texts):
+                    return t.texts[doc - t.first]
+            rec = self.msglog.get(room, seq)
+            return rec and rec.get('text')
+
+        # per term, its (doc ids, counts) in each source; sources cover ascending, disjoint doc ranges
+        postings = []
+        for term in terms:
+            parts = [hit for hit in (src.lookup(term) for src in sources) if hit and len(hit[0])]
+            if not parts:
+                return {'results': [], 'total': 0}
+            postings.append((sum(len(ids) for ids, _ in parts), parts))
+        postings.sort(key=lambda p: p[0])
+
+        def tf_of(parts, doc):
+            for ids, tfs in parts:
+                if ids[0] <= doc <= ids[-1]:
+                    i = bisect.bisect_left(ids, doc)
+                    return tfs[i] if ids[i] == doc else 0
+            return 0
+
+        # walk the rarest term's docs newest first; a doc matches if every other term has it
+        matches, tf = {}, {}
+        scanned = 0
+        for ids, tfs in reversed(postings[0][1]):
+            for i in range(len(ids) - 1, -1, -1):
+                doc = ids[i]
+                if doc >= end:
+                    continue
+                scanned += 1
+                if scanned > SCAN_MAX:
+                    break
+                counts = [tfs[i]]
+                for _, parts in postings[1:]:
+                    counts.append(tf_of(parts, doc))
+                    if not counts[-1]:
+                        break
+                else:
+                    e = doc_entry(doc)
+                    if e is None or e[0] not in room_ids or (user_id is not None and e[1] != user_id):
+                        continue
+                    if (since is not None and e[3] < since) or (until is not None and e[3] > until):
+                        continue
+                    matches[doc] = e
+                    tf[doc] = counts
+            if scanned > SCAN_MAX:
+                break
+        n = max(end, 1)
+        avg = total_words / n or 1
+        idfs = [math.log(1 + (n - df + 0.5) / (df + 0.5)) for df, _ in postings]
+        scores = {}
+        for doc, counts in tf.items():
+            norm = K1 * (1 - B + B * matches[doc][4] / avg)
+            scores[doc] = sum(idf * c * (K1 + 1) / (c + norm) for idf, c in zip(idfs, counts))
+        best = heapq.nlargest(limit, scores, key=lambda d: (scores[d], d))
+        results = []
+        for doc in best:
+            room_id, uid, seq, ts, _ = matches[doc]
+            name = self.room_names[room_id]
+            results.append({'room': name, 'seq': seq, 'ts': round(ts, 3), 'username': self.user_names[uid],
+                            'text': doc_text(doc, name, seq), 'score': round(scores[doc], 3)})
+        return {'results': results, 'total': len(matches)}
+
+def open_search(msglog: MessageLog) -> SearchIndex:
+    # '@' is always quoted in room directory names, so this cannot be a room's
+    return SearchIndex(msglog.root / '@search', msglog)
+
+def search_reply(index: Optional[SearchIndex], header: Dict, rooms) -> Dict:
+    """The answer to a "search" frame from a member of rooms."""
+    if index is None:
+        return {'type':'system', 'text': 'Search is not enabled on this server'}
+    room = header.get('room')
+    if room and room not in rooms:
+        return {'type':'system', 'text': f'You are not in #{room}'}
+    started = time.perf_counter()
+    try:
+        found = index.search(str(header.get('q', '')), set(rooms), room, header.get('username'),
+                             header.get('since'), header.get('until'), header.get('limit', 20))
+    except (TypeError, ValueError) as e:
+        return {'type':'system', 'text': f'Bad search: {e}'}
+    return {'type':'search', 'q': header.get('q', ''), 'results': found['results'], 'total': found['total'],
+            'ms': round((time.perf_counter() - started) * 1000, 1)}
@@ -0,0 +1,294 @@
+# server_async.py
+# asyncio engine for the TCP chat server (same framing as server_tcp.py, same frame handling: hub.py)
+# Usage: python3 server_tcp.py --engine asyncio [--workers N]
+# Requirements: Python 3.8+
+#
+# One coroutine per connection instead of one OS thread, so idle clients only
+# cost a StreamReader/StreamWriter pair. For 10k+ connections raise the open
+# file limit first (e.g. `ulimit -n 65536`).
+
+import asyncio
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+from outbound import FrameQueue, DEFAULT_QUEUE_SIZE, DEFAULT_POLICY, frame_size
+from relay import FileSlice, UploadStream, recv_to_file_async, send_slice_async, send_stream_async
+from lanes import Bulk, BulkLane
+from framing import HDR, MAX_HEADER, decode_header
+import workers
+from presence import FLUSH_INTERVAL
+from hub import Client, Hub, MUX_QUEUE_FACTOR, PAYLOAD_FRAMES, VirtualClient, open_hub
+import metrics
+from metrics import BYTES_IN, BYTES_OUT, CONNECTIONS, FRAMES_IN
+
+LISTEN_BACKLOG = 1024
+QUEUE_SIZE = DEFAULT_QUEUE_SIZE
+QUEUE_POLICY = DEFAULT_POLICY
+BULK_RATE = 0
+hub: Hub = None             # chat state and what frames do to it (see hub.py)
+
+class AsyncOutbound:
+    """FrameQueue drained by a writer task; put() never awaits the network.
+
+    Control frames go first, bulk chunk frames (lanes.py) in between.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.queue = FrameQueue(QUEUE_SIZE, QUEUE_POLICY)
+        self.bulk = BulkLane(FrameQueue(QUEUE_SIZE, QUEUE_POLICY), BULK_RATE)
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.task = asyncio.ensure_future(self._run())
+
+    @property
+    def depth(self) -> int:
+        return len(self.queue) + len(self.bulk)
+
+    @property
+    def dropped(self) -> int:
+        return self.queue.dropped + self.bulk.pending.dropped
+
+    def put(self, *parts: bytes) -> bool:
+        if self.closed:
+            return False
+        if not self.queue.push(parts):
+            self.close()
+            return False
+        self.ready.set()
+        return True
+
+    def put_bulk(self, bulk: Bulk) -> bool:
+        if self.closed:
+            bulk.close()
+            return False
+        if not self.bulk.pending.push((bulk,)):
+            bulk.close()
+            self.close()
+            return False
+        self.ready.set()
+        return True
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.close()
+        self.bulk.pending.close()
+        self.ready.set()
+        # abort rather than close: close() would wait to flush to a stuck peer
+        self.writer.transport.abort()
+
+    async def _run(self):
+        try:
+            while not self.closed:
+                frame = self.queue.pop()
+                if frame is None:
+                    # live uploads in the bulk lane set ready when more data lands
+                    self.bulk.activate(self.ready.set)
+                    frame, wait = self.bulk.next_frame()
+                if frame is None:
+                    self.ready.clear()
+                    try:
+                        await asyncio.wait_for(self.ready.wait(), wait or None)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                for part in frame:
+                    if isinstance(part, UploadStream):
+                        await send_stream_async(self.writer, part)
+                    elif isinstance(part, FileSlice):
+                        await send_slice_async(self.writer, part)
+                    elif part:
+                        self.writer.write(part)
+                await self.writer.drain()
+                BYTES_OUT.inc(frame_size(frame))
+                # drain() returns at once while the socket keeps up; let other tasks in
+                await asyncio.sleep(0)
+        except (ConnectionError, OSError):
+            self.close()
+        finally:
+            self.bulk.close()
+
+async def read_header(reader: asyncio.StreamReader) -> Dict:
+    # StreamReader is already buffered; only the framing constants are shared
+    (hdr_len,) = HDR.unpack(await reader.readexactly(4))
+    if hdr_len > MAX_HEADER:
+        raise ValueError(f"header of {hdr_len} bytes")
+    hdr_bytes = await reader.readexactly(hdr_len)
+    BYTES_IN.inc(HDR.size + hdr_len)
+    return decode_header(hdr_bytes)
+
+async def off_loop(fn: Callable, args: tuple, then: Callable):
+    then(await asyncio.get_running_loop().run_in_executor(None, fn, *args))
+
+def blocking(client: Client, fn: Callable, args: tuple, then: Callable):
+    # the client's next frame is handled once this is done (see handle_frame)
+    client.pending = asyncio.ensure_future(off_loop(fn, args, then))
+
+def background(fn: Callable, args: tuple, then: Callable):
+    asyncio.ensure_future(off_loop(fn, args, then))
+
+async def expire_sessions():
+    """Users whose dropped session was not resumed in time leave for good."""
+    while True:
+        await asyncio.sleep(1)
+        hub.expire_sessions()
+
+async def flush_presence():
+    """Tell clients who came and went, at most once per FLUSH_INTERVAL."""
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        hub.flush_presence()
+
+async def serve_peer(reader: asyncio.StreamReader, hello: Dict):
+    """Read events from an inbound peer link until it closes."""
+    node = hello.get('node')
+    print(f"[cluster] link from node {node}")
+    try:
+        while True:
+            header = await read_header(reader)
+            if header.get('type') == 'cluster':
+                hub.cluster.receive(header)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        hub.cluster.peer_lost(node)
+
+async def next_header(reader: asyncio.StreamReader) -> Optional[Dict]:
+    """The next frame's header, None once the peer closed; counted in the metrics."""
+    try:
+        header = await read_header(reader)
+    except asyncio.IncompleteReadError:
+        return None
+    FRAMES_IN.inc(1, (header.get('type'),))
+    return header
+
+async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, bus: bool = False):
+    addr = writer.get_extra_info('peername')
+    print(f"New connection from {addr}")
+    client = Client(addr, AsyncOutbound(writer), BULK_RATE, bus)
+    CONNECTIONS.inc()
+    try:
+        while True:
+            header = await next_header(reader)
+            if header is None:
+                print(f"Client {addr} disconnected")
+                break
+            if header.get('type') == 'mux_hello' and client.username is None:
+                await serve_mux(client, reader)
+                break
+            if not await handle_frame(client, reader, header):
+                break
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    except Exception as e:
+        print(f"Exception handling client {addr}: {e}")
+    finally:
+        hub.drop_client(client)
+
+async def serve_mux(link: Client, reader: asyncio.StreamReader):
+    """A web bridge's link (after mux_hello): many users on one connection. Their frames carry
+    the 'vid' the bridge gave them; room frames go to the link once, with the 'vids' to hand
+    them to (see Hub.send_to), instead of once per user."""
+    print(f"Mux link from {link.addr}")
+    link.outq.queue.maxsize = QUEUE_SIZE * MUX_QUEUE_FACTOR
+    users: Dict[object, VirtualClient] = {}
+    try:
+        while True:
+            header = await next_header(reader)
+            if header is None:
+                print(f"Mux link from {link.addr} closed")
+                break
+            client = hub.mux_client(link, users, header)
+            if client is None:
+                continue
+            typ = header.get('type')
+            try:
+                ok = await handle_frame(client, reader, header)
+            except (asyncio.IncompleteReadError, OSError):
+                raise
+            except Exception as e:
+                if typ in PAYLOAD_FRAMES:
+                    raise       # its payload may be half read: the link is out of step
+                # one browser's bad frame ends that user, not the link everyone shares
+                print(f"Exception handling mux user {client.vid} on {link.addr}: {e}")
+                ok = False
+            if not ok:
+                hub.drop_client(users.pop(client.vid))
+                if typ in PAYLOAD_FRAMES:
+                    break       # its payload was not read
+    finally:
+        # the users' sessions are kept; the bridge resumes them when it reconnects
+        for client in users.values():
+            hub.drop_client(client)
+
+async def handle_frame(client: Client, reader: asyncio.StreamReader, header: Dict) -> bool:
+    """Act on one frame from client: frames with a payload are read here, the rest are
+    the hub's. False once the client is done."""
+    typ = header.get('type')
+    if typ == 'file':
+        up = hub.begin_file(client, header)
+        if up is None:
+            return True
+        ok = False
+        try:
+            ok = await recv_to_file_async(reader, up.f, up.stream, up.hasher, client.ingest)
+        finally:
+            hub.end_file(up, ok)
+        if ok:
+            BYTES_IN.inc(up.filesize)
+        return ok
+    elif typ == 'upload_chunk':
+        size = hub.chunk_size(client, header)
+        if size is None:
+            return False
+        data = await reader.readexactly(size)
+        BYTES_IN.inc(size)
+        pause = client.ingest.take(size)
+        if pause:
+            await asyncio.sleep(pause)
+        hub.write_chunk(client, header, data)
+    elif typ == 'peer_hello':
+        # another node's link: from here on this connection only carries cluster events
+        if hub.admit_peer(client, header):
+            await serve_peer(reader, header)
+        return False
+    elif not hub.handle(client, header):
+        return False
+    if client.pending:
+        # hashing, history or search pages off the loop; their reply comes before the next frame's
+        pending, client.pending = client.pending, None
+        await pending
+    return True
+
+async def serve(host: str, port: int, args, worker: int = None, bus_dir: str = None):
+    loop = asyncio.get_running_loop()
+    # peer links run on their own threads; hand their events to the loop
+    hub.start_cluster(args, port, worker, bus_dir,
+                      lambda event: loop.call_soon_threadsafe(hub.on_cluster_event, event))
+    if worker is not None:
+        # the other workers' links; peer_hello is only accepted here (see Hub.admit_peer)
+        await asyncio.start_unix_server(lambda r, w: handle_client(r, w, bus=True),
+                                        sock=workers.bus_socket(bus_dir, worker))
+    server = await asyncio.start_server(
+        handle_client, sock=workers.listen_socket(host, port, worker is not None, LISTEN_BACKLOG))
+    asyncio.ensure_future(expire_sessions())
+    asyncio.ensure_future(flush_presence())
+    metrics.watch_server(lambda: len(hub.clients), hub.queue_depths)
+    async with server:
+        await server.serve_forever()
+
+def main(host: str, port: int, upload_dir: Path, args, worker: int = None, bus_dir: str = None):
+    global QUEUE_SIZE, QUEUE_POLICY, BULK_RATE, hub
+    QUEUE_SIZE, QUEUE_POLICY = args.queue_size, args.queue_policy
+    BULK_RATE = args.bulk_rate * 1024 * 1024
+    hub = open_hub(args, upload_dir, worker, blocking=blocking, background=background)
+    name = f", worker {worker}" if worker is not None else ''
+    print(f"Starting TCP Chat Server (asyncio{name}) on {host}:{port}")
+    try:
+        asyncio.run(serve(host, port, args, worker, bus_dir))
+    except KeyboardInterrupt:
+        print("Shutting down server...")
+    finally:
+        hub.close()
@@ -1,147 +1,249 @@
 # server_tcp.py
 # TCP multi-client chat server with file broadcasting
-# Usage: python3 server_tcp.py
+# Usage: python3 server_tcp.py [--engine threaded|asyncio] [--workers N] [--port N]
+#        [--cluster-key KEY --peer HOST:PORT ...]
+#        [--metrics PORT]
 # Requirements: Python 3.8+
 
+import argparse
 import socket
 import threading
-import struct
-import json
-import os
+import time
 from pathlib import Path
 from typing import Dict, Tuple
 
+from outbound import OutboundQueue, POLICIES, DEFAULT_QUEUE_SIZE, DEFAULT_POLICY
+import relay
+from relay import recv_to_file
+from framing import FrameReader
+import workers
+from sessions import SESSION_TTL
+from presence import FLUSH_INTERVAL
+from hub import Client, Hub, MUX_QUEUE_FACTOR, PAYLOAD_FRAMES, VirtualClient, open_hub
+import metrics
+from metrics import BYTES_IN, CONNECTIONS, FRAMES_IN
+
 HOST = '0.0.0.0'   # change here if you want server bind to specific interface
 PORT = 9009        # change here to use different port
 UPLOAD_DIR = Path('uploads')
 UPLOAD_DIR.mkdir(exist_ok=True)
+QUEUE_SIZE = DEFAULT_QUEUE_SIZE      # max frames buffered per client (--queue-size)
+QUEUE_POLICY = DEFAULT_POLICY        # what to do when it is full (--queue-policy)
+BULK_RATE = 0                        # per-client file bytes/s each way, 0 = unlimited (--bulk-rate)
+# Chat state and what frames do to it (see hub.py); this module only reads and writes sockets
+HUB: Hub = None
 
-# Global list of connected clients: list of tuples (socket, address, username)
-clients = []
-clients_lock = threading.Lock()
-
-def recvall(sock: socket.socket, n: int) -> bytes:
-    data = bytearray()
-    while len(data) < n:
-        packet = sock.recv(n - len(data))
-        if not packet:
-            return None
-        data.extend(packet)
-    return bytes(data)
+def flush_presence():
+    """Tell clients who came and went, at most once per FLUSH_INTERVAL."""
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        HUB.flush_presence()
 
-def send_framed(sock: socket.socket, header: Dict, payload: bytes = None):
-    """
-    Send: [4-byte header_len][header_json][optional payload bytes]
-    """
-    header_bytes = json.dumps(header).encode('utf-8')
-    sock.sendall(struct.pack('>I', len(header_bytes)))
-    sock.sendall(header_bytes)
-    if payload:
-        sock.sendall(payload)
+def expire_sessions():
+    """Users whose dropped session was not resumed in time leave for good."""
+    while True:
+        time.sleep(1)
+        HUB.expire_sessions()
 
-def broadcast_except(sender_sock: socket.socket, header: Dict, payload: bytes = None):
-    with clients_lock:
-        to_remove = []
-        for c_sock, addr, username in clients:
-            if c_sock is sender_sock:
-                continue
-            try:
-                send_framed(c_sock, header, payload)
-            except Exception as e:
-                print(f"Error sending to {addr}: {e}")
-                to_remove.append((c_sock, addr, username))
-        for r in to_remove:
-            clients.remove(r)
-
-def handle_client(client_sock: socket.socket, addr: Tuple[str,int]):
-    username = None
+def read_frames(reader: FrameReader):
+    """Headers from reader until the peer closes, counted in the metrics."""
+    counted = 0     # of reader.received, in BYTES_IN
     try:
         while True:
-            # read 4 bytes => header length
-            raw = recvall(client_sock, 4)
-            if not raw:
-                print(f"Client {addr} disconnected")
+            header = reader.read_header()
+            BYTES_IN.inc(reader.received - counted)
+            counted = reader.received
+            if header is None:
+                return
+            FRAMES_IN.inc(1, (header.get('type'),))
+            yield header
+    finally:
+        BYTES_IN.inc(reader.received - counted)
+
+def handle_client(client_sock: socket.socket, addr: Tuple[str,int], bus: bool = False):
+    client = Client(addr, OutboundQueue(client_sock, QUEUE_SIZE, QUEUE_POLICY, BULK_RATE), BULK_RATE, bus)
+    CONNECTIONS.inc()
+    # all reads from this client go through its buffered reader
+    reader = FrameReader(client_sock)
+    frames = read_frames(reader)
+    try:
+        for header in frames:
+            if header.get('type') == 'mux_hello' and client.username is None:
+                serve_mux(client, reader, frames)
                 break
-            hdr_len = struct.unpack('>I', raw)[0]
-            hdr_bytes = recvall(client_sock, hdr_len)
-            if hdr_bytes is None:
+            if not handle_frame(client, reader, header):
                 break
-            header = json.loads(hdr_bytes.decode('utf-8'))
-            typ = header.get('type')
-            if typ == 'join':
-                username = header.get('username', f'{addr[0]}:{addr[1]}')
-                with clients_lock:
-                    clients.append((client_sock, addr, username))
-                print(f"{username} joined from {addr}")
-                sys_hdr = {'type':'system', 'text': f'{username} joined'}
-                broadcast_except(client_sock, sys_hdr, None)
-            elif typ == 'message':
-                text = header.get('text', '')
-                print(f"[{username}] {text}")
-                out_hdr = {'type':'message', 'username': username, 'text': text}
-                broadcast_except(client_sock, out_hdr, None)
-            elif typ == 'file':
-                filename = header.get('filename', 'file.bin')
-                filesize = int(header.get('filesize', 0))
-                # read exactly filesize bytes
-                file_bytes = recvall(client_sock, filesize)
-                if file_bytes is None:
-                    break
-                # save file with collision avoidance
-                safe = os.path.basename(filename)
-                save_path = UPLOAD_DIR / safe
-                i = 1
-                stem = save_path.stem
-                suf = save_path.suffix
-                while save_path.exists():
-                    save_path = UPLOAD_DIR / f"{stem}_{i}{suf}"
-                    i += 1
-                with open(save_path, 'wb') as f:
-                    f.write(file_bytes)
-                print(f"Received file from {username}: {save_path} ({filesize} bytes)")
-                # broadcast file to others (header will contain original filename + saved name + filesize)
-                out_hdr = {
-                    'type':'file',
-                    'username': username,
-                    'filename': save_path.name,
-                    'orig_filename': filename,
-                    'filesize': filesize
-                }
-                broadcast_except(client_sock, out_hdr, file_bytes)
-            else:
-                # unknown type - ignore or send error
-                err = {'type':'system', 'text':'Unknown message type'}
-                send_framed(client_sock, err)
+        else:
+            print(f"Client {addr} disconnected")
     except Exception as e:
         print(f"Exception handling client {addr}: {e}")
     finally:
-        # remove from clients
-        with clients_lock:
-            clients[:] = [c for c in clients if c[0] is not client_sock]
-        if username:
-            print(f"{username} disconnected")
-            broadcast_except(client_sock, {'type':'system','text':f'{username} left'}, None)
+        HUB.drop_client(client)
         try:
             client_sock.close()
         except:
             pass
 
-def main():
-    print(f"Starting TCP Chat Server on {HOST}:{PORT}")
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.bind((HOST, PORT))
-    server.listen(100)
+def serve_mux(link: Client, reader: FrameReader, frames):
+    """A web bridge's link (after mux_hello): many users on one connection. Their frames carry
+    the 'vid' the bridge gave them; room frames go to the link once, with the 'vids' to hand
+    them to (see Hub.send_to), instead of once per user."""
+    print(f"Mux link from {link.addr}")
+    link.outq.queue.maxsize = QUEUE_SIZE * MUX_QUEUE_FACTOR
+    users: Dict[object, VirtualClient] = {}
     try:
-        while True:
-            client_sock, addr = server.accept()
-            print(f"New connection from {addr}")
-            t = threading.Thread(target=handle_client, args=(client_sock, addr), daemon=True)
-            t.start()
+        for header in frames:
+            client = HUB.mux_client(link, users, header)
+            if client is None:
+                continue
+            typ = header.get('type')
+            try:
+                ok = handle_frame(client, reader, header)
+            except OSError:
+                raise
+            except Exception as e:
+                if typ in PAYLOAD_FRAMES:
+                    raise       # its payload may be half read: the link is out of step
+                # one browser's bad frame ends that user, not the link everyone shares
+                print(f"Exception handling mux user {client.vid} on {link.addr}: {e}")
+                ok = False
+            if not ok:
+                HUB.drop_client(users.pop(client.vid))
+                if typ in PAYLOAD_FRAMES:
+                    break       # its payload was not read
+        print(f"Mux link from {link.addr} closed")
+    finally:
+        # the users' sessions are kept; the bridge resumes them when it reconnects
+        for client in users.values():
+            HUB.drop_client(client)
+
+def handle_frame(client: Client, reader: FrameReader, header: Dict) -> bool:
+    """Act on one frame from client: frames with a payload are read here, the rest are
+    the hub's. False once the client is done."""
+    typ = header.get('type')
+    if typ == 'file':
+        up = HUB.begin_file(client, header)
+        if up is None:
+            return True
+        ok = False
+        try:
+            ok = recv_to_file(reader, up.f, up.stream, up.hasher, client.ingest)
+        finally:
+            HUB.end_file(up, ok)
+        return ok
+    elif typ == 'upload_chunk':
+        size = HUB.chunk_size(client, header)
+        if size is None:
+            return False
+        data = reader.read_exact(size)
+        if data is None:
+            return False
+        time.sleep(client.ingest.take(size))
+        HUB.write_chunk(client, header, data)
+        return True
+    elif typ == 'peer_hello':
+        # another node's link: from here on this connection only carries cluster events
+        if HUB.admit_peer(client, header):
+            HUB.cluster.serve_peer(reader, header)
+        return False
+    return HUB.handle(client, header)
+
+def accept_loop(server: socket.socket, bus: bool = False):
+    while True:
+        client_sock, addr = server.accept()
+        print(f"New connection from {addr}")
+        t = threading.Thread(target=handle_client, args=(client_sock, addr, bus), daemon=True)
+        t.start()
+
+def serve_threaded(worker: int = None, bus_dir: str = None):
+    """Serve the chat port; as one of --workers, also this worker's end of the bus."""
+    name = f" (worker {worker})" if worker is not None else ''
+    print(f"Starting TCP Chat Server on {HOST}:{PORT}{name}")
+    server = workers.listen_socket(HOST, PORT, reuse_port=worker is not None)
+    threading.Thread(target=expire_sessions, daemon=True).start()
+    threading.Thread(target=flush_presence, daemon=True).start()
+    metrics.watch_server(lambda: len(HUB.clients), HUB.queue_depths)
+    if worker is not None:
+        # the other workers' links; peer_hello is only accepted here (see Hub.admit_peer)
+        bus = workers.bus_socket(bus_dir, worker)
+        threading.Thread(target=accept_loop, args=(bus, True), daemon=True).start()
+    try:
+        accept_loop(server)
     except KeyboardInterrupt:
         print("Shutting down server...")
     finally:
         server.close()
+        HUB.close()
+
+def serve(args, worker: int = None, bus_dir: str = None):
+    """Run this process's server (the only one, or one of --workers)."""
+    global HUB
+    if args.metrics:
+        metrics.serve_http(args.metrics, worker)
+    if args.engine == 'asyncio':
+        import server_async
+        server_async.main(HOST, PORT, UPLOAD_DIR, args, worker, bus_dir)
+        return
+    HUB = open_hub(args, UPLOAD_DIR, worker)
+    HUB.start_cluster(args, PORT, worker, bus_dir)
+    serve_threaded(worker, bus_dir)
+
+def main():
+    global QUEUE_SIZE, QUEUE_POLICY, BULK_RATE, PORT, UPLOAD_DIR
+    parser = argparse.ArgumentParser(description='TCP chat server')
+    parser.add_argument('--engine', choices=['threaded', 'asyncio'], default='threaded',
+                        help='threaded: one OS thread per client; asyncio: single event loop')
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help='max frames buffered per client before the policy applies')
+    parser.add_argument('--queue-policy', choices=POLICIES, default=DEFAULT_POLICY,
+                        help='what to do with a client whose outbound queue is full')
+    parser.add_argument('--no-sendfile', action='store_true',
+                        help='fan files out with read()+send() instead of zero-copy sendfile()')
+    parser.add_argument('--file-delivery', choices=['push', 'announce'], default='push',
+                        help="announce: clients that support it get a file_announce and fetch the bytes on demand")
+    parser.add_argument('--bulk-rate', type=float, default=0, metavar='MB_PER_S',
+                        help='cap file transfer speed per client and direction (0 = unlimited)')
+    parser.add_argument('--history-dir', type=Path,
+                        help='where room history is logged (default: UPLOAD_DIR/history)')
+    parser.add_argument('--no-history', action='store_true', help='keep no room history')
+    parser.add_argument('--no-search', action='store_true', help='keep no full-text index of the history')
+    parser.add_argument('--session-ttl', type=float, default=SESSION_TTL, metavar='SECONDS',
+                        help='how long a dropped client can resume its session (not with --workers)')
+    parser.add_argument('--metrics', metavar='PORT|HOST:PORT|PATH',
+                        help='serve Prometheus metrics and a sampling profiler here (see metrics.py); '
+                             'a port binds to 127.0.0.1')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='server processes sharing the port via SO_REUSEPORT, to use more cores')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--upload-dir', type=Path, default=UPLOAD_DIR,
+                        help='where files are stored (give each node on one machine its own)')
+    parser.add_argument('--peer', action='append', default=[], metavar='HOST:PORT',
+                        help='another node of the cluster to send our events to (repeatable)')
+    parser.add_argument('--advertise', metavar='HOST:PORT',
+                        help='address other nodes reach this one at (default 127.0.0.1:PORT)')
+    parser.add_argument('--node-id', help='name of this node in the cluster (default: --advertise)')
+    parser.add_argument('--cluster-key', default='', help='shared secret peer links must present (required with --peer)')
+    args = parser.parse_args()
+    if args.workers > 1 and args.peer:
+        parser.error('--workers and --peer cannot be combined')
+    if args.peer and not args.cluster_key:
+        parser.error('--peer needs a --cluster-key (the same on every node)')
+    PORT = args.port
+    if args.upload_dir != UPLOAD_DIR:
+        UPLOAD_DIR = args.upload_dir
+        UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    if args.peer:
+        advertise = args.advertise or f'127.0.0.1:{PORT}'
+        args.advertise = advertise
+        args.node_id = args.node_id or advertise
+    QUEUE_SIZE, QUEUE_POLICY = args.queue_size, args.queue_policy
+    BULK_RATE = args.bulk_rate * 1024 * 1024
+    if args.no_sendfile:
+        relay.USE_SENDFILE = False
+    if args.workers > 1:
+        workers.prefork(args.workers, lambda worker, bus_dir: serve(args, worker, bus_dir))
+    else:
+        serve(args)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,168 @@
+# sessions.py
+# Sequence numbers and session resume, shared by both server engines
+#
+# Every frame a room hears (message, system notice, file_announce) is
+# numbered by RoomFeed: seqs count up per room and frames are handed to the
+# room in seq order. The last RING_SIZE frames of each room stay in memory;
+# older ones come from the room's history log (msglog.py) if it is on.
+#
+# A client that joins with the "resume" feature gets a session token. When
+# its connection drops, its session is kept for SESSION_TTL seconds: the
+# others are not told it left, and direct messages to it are held. If it
+# joins again with the token and the last seq it saw per room, it gets
+# exactly the frames it missed, then the held messages. Sessions not
+# resumed in time expire, and only then does the user leave.
+
+import collections
+import secrets
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+RING_SIZE = 1024          # recent frames kept in memory per room
+REPLAY_MAX = 5000         # frames replayed to one room on resume, at most
+SESSION_TTL = 60.0        # seconds a dropped client's session is kept
+HOLD_MAX = 256            # direct messages held for one offline user
+ACKED_MAX = 256           # message ids remembered per session (resent messages are not posted twice)
+
+class Ring:
+    def __init__(self):
+        self.lock = threading.RLock()   # held while a frame is numbered and sent
+        self.seq = 0
+        self.frames = collections.deque(maxlen=RING_SIZE)
+
+class RoomFeed:
+    """Per-room sequence numbers plus the recent frames of each room."""
+
+    def __init__(self, msglog=None):
+        self.msglog = msglog
+        self.rings: Dict[str, Ring] = {}
+        self.lock = threading.Lock()    # guards the dict only
+
+    def ring(self, room: str) -> Ring:
+        ring = self.rings.get(room)
+        if ring is None:
+            with self.lock:
+                ring = self.rings.setdefault(room, Ring())
+        return ring
+
+    def post(self, room: str, header: Dict, deliver: Callable = None) -> int:
+        """Number header (sets header['seq']), keep it, and call deliver(header) before the next
+        frame of the room gets its number, so every member sees the room in seq order."""
+        ring = self.ring(room)
+        with ring.lock:
+            if self.msglog:
+                # the log owns the numbering, so history and live seqs agree across restarts
+                ring.seq = self.msglog.append(room, header)
+            else:
+                ring.seq += 1
+                header['seq'] = ring.seq
+            ring.frames.append(header)
+            if deliver:
+                deliver(header)
+            return ring.seq
+
+    def last_seq(self, room: str) -> int:
+        ring = self.ring(room)
+        if not ring.frames and self.msglog:
+            return self.msglog.last_seq(room)
+        return ring.seq
+
+    def since(self, room: str, after: int) -> Tuple[List[Dict], bool]:
+        """Frames of room after seq after that are still in memory, oldest first, and whether they
+        follow straight on from it. Call with the room's ring lock held, so nothing is posted in
+        between; what is older comes from older()."""
+        ring = self.ring(room)
+        frames = [h for h in ring.frames if h['seq'] > after]
+        first = frames[0]['seq'] if frames else self.last_seq(room) + 1
+        return frames, first <= after + 1
+
+    def older(self, after: Dict[str, int]) -> Dict[str, Optional[List[Dict]]]:
+        """For each room, the frames after seq after[room] that are no longer in memory, read from
+        the history log (oldest first); None where there are more than REPLAY_MAX or there is no
+        log. Reads the disk and may wait for it: call it without any ring lock."""
+        out = {}
+        for room, seq in after.items():
+            ring = self.ring(room)
+            with ring.lock:
+                first = ring.frames[0]['seq'] if ring.frames else self.last_seq(room) + 1
+            if first <= seq + 1:
+                out[room] = []
+                continue
+            if not self.msglog or first - seq - 1 > REPLAY_MAX:
+                out[room] = None
+                continue
+            frames = []
+            while seq + 1 < first:
+                page, _, _ = self.msglog.history(room, after=seq, limit=first - seq - 1)
+                page = [h for h in page if h['seq'] < first]
+                if not page:
+                    break
+                frames.extend(page)
+                seq = page[-1]['seq']
+            out[room] = frames
+        return out
+
+class Session:
+    def __init__(self, username: str):
+        self.token = secrets.token_hex(16)
+        self.username = username
+        self.rooms: List[str] = []
+        self.held = collections.deque(maxlen=HOLD_MAX)  # direct messages while offline
+        self.acked = collections.OrderedDict()          # message id -> seq it was posted as
+        self.expires = None                             # set while detached
+
+    def ack(self, msg_id, seq):
+        self.acked[msg_id] = seq
+        if len(self.acked) > ACKED_MAX:
+            self.acked.popitem(last=False)
+
+class Sessions:
+    def __init__(self, ttl: float = SESSION_TTL):
+        self.ttl = ttl
+        self.detached: Dict[str, Session] = {}      # token -> session of a dropped client
+        self.offline: Dict[str, Session] = {}       # username -> the same sessions
+        self.lock = threading.Lock()
+
+    def new(self, username: str) -> Session:
+        return Session(username)
+
+    def detach(self, session: Session, rooms):
+        """The session's connection dropped; keep it for ttl seconds."""
+        with self.lock:
+            session.rooms = sorted(rooms)
+            session.expires = time.monotonic() + self.ttl
+            self.detached[session.token] = session
+            self.offline[session.username] = session
+
+    def resume(self, token: str) -> Optional[Session]:
+        with self.lock:
+            session = self.detached.pop(token or '', None)
+            if session:
+                if self.offline.get(session.username) is session:
+                    del self.offline[session.username]
+                session.expires = None
+            return session
+
+    def hold(self, username: str, header: Dict) -> bool:
+        """Keep a direct message for an offline user; False if there is no such session."""
+        with self.lock:
+            session = self.offline.get(username)
+            if session is None:
+                return False
+            session.held.append(header)
+            return True
+
+    def is_offline(self, username: str) -> bool:
+        return username in self.offline
+
+    def expired(self) -> List[Session]:
+        """Drop and return the sessions whose ttl ran out."""
+        now = time.monotonic()
+        with self.lock:
+            gone = [s for s in self.detached.values() if s.expires <= now]
+            for s in gone:
+                del self.detached[s.token]
+                if self.offline.get(s.username) is s:
+                    del self.offline[s.username]
+            return gone
@@ -0,0 +1,5 @@
+# The server modules are flat files next to this directory, imported as top-level modules.
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,52 @@
+import json
+import socket
+import subprocess
+import sys
+from pathlib import Path
+
+from bench import bench_load
+from bench.bench_load import Conn, compare, percentile
+from framing import encode_header
+
+def frame(header: dict, payload: bytes = b'') -> bytes:
+    return encode_header(header) + payload
+
+def test_frames_are_parsed_across_reads_and_payloads_skipped():
+    data = (frame({'type': 'message', 'text': 'a'}) + frame({'type': 'file_chunk', 'size': 5}, b'12345')
+            + frame({'type': 'message', 'text': 'b'}))
+    a, b = socket.socketpair()
+    try:
+        conn, stats, seen = Conn(a, 'chat'), {'file_bytes': 0}, []
+        for i in range(len(data)):
+            seen += [h.get('text') or h['type'] for h in conn.frames(data[i:i + 1], stats)]
+    finally:
+        a.close()
+        b.close()
+    assert seen == ['a', 'file_chunk', 'b'] and stats['file_bytes'] == 5
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 51 and percentile(values, 99.9) == 100
+    assert percentile([], 50) is None
+
+def result(commit: str, rate: float) -> dict:
+    return {'scenario': 'chat', 'engine': 'threaded', 'workers': 1, 'commit': commit,
+            'msgs_per_s': rate, 'deliveries_per_s': rate * 3,
+            'latency_ms': {'p50': 1.0, 'p99': 2.0, 'p999': None},
+            'file_mb_s': {'delivered': 0.0}, 'server': {'rss_mb_peak': 20.0, 'cpu_s': None}}
+
+def test_compare_takes_the_last_run_per_scenario(tmp_path, capsys):
+    old, new = tmp_path / 'old.jsonl', tmp_path / 'new.jsonl'
+    old.write_text(json.dumps(result('a', 50)) + '\n' + json.dumps(result('b', 100)) + '\n')
+    new.write_text(json.dumps(result('c', 150)) + '\n')
+    compare(str(old), str(new))
+    out = capsys.readouterr().out
+    assert 'b -> c' in out and '+50.0%' in out and 'p999' not in out
+
+def test_chat_scenario_runs_end_to_end():
+    script = Path(bench_load.__file__)
+    out = subprocess.run([sys.executable, str(script), '--duration', '1', '--clients', '3', '--rate', '30',
+                          '--json'], capture_output=True, text=True, timeout=60)
+    report = json.loads(out.stdout.splitlines()[-1])
+    assert report['scenario'] == 'chat' and report['messages_sent'] > 0
+    assert report['deliveries'] > 0 and report['disconnects'] == 0
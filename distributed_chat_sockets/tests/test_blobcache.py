@@ -0,0 +1,41 @@
+import hashlib
+
+from web_bridge.blobcache import BlobCache
+
+def put(cache, name: str, data: bytes) -> str:
+    sha256 = hashlib.sha256(data).hexdigest()
+    tmp, f = cache.begin()
+    with f:
+        f.write(data)
+    cache.commit(name, tmp, sha256, len(data))
+    return sha256
+
+def test_names_survive_a_restart(tmp_path):
+    cache = BlobCache(tmp_path, 1 << 20)
+    sha256 = put(cache, 'a.txt', b'abc')
+    cache.learn('b.txt', 'ff' * 32, 10)
+    cache.learn('c.txt', None, 5)       # hash not known yet: nothing to serve it by later
+    again = BlobCache(tmp_path, 1 << 20)
+    assert again.lookup('a.txt') == (tmp_path / 'blobs' / sha256, sha256)
+    assert again.known('b.txt') == {'sha256': 'ff' * 32, 'filesize': 10}
+    assert again.known('c.txt') is None
+
+def test_same_bytes_are_kept_once(tmp_path):
+    cache = BlobCache(tmp_path, 1 << 20)
+    assert put(cache, 'a.txt', b'abc') == put(cache, 'copy.txt', b'abc')
+    assert [p.name for p in (tmp_path / 'blobs').iterdir() if p.is_file()] == [hashlib.sha256(b'abc').hexdigest()]
+    assert cache.lookup('copy.txt') == cache.lookup('a.txt')
+
+def test_evicted_files_stay_known(tmp_path):
+    cache = BlobCache(tmp_path, 5)
+    put(cache, 'a.txt', b'abcd')
+    put(cache, 'b.txt', b'efgh')
+    assert cache.lookup('a.txt') is None and cache.known('a.txt')['filesize'] == 4
+    assert BlobCache(tmp_path, 5).lookup('b.txt') is not None
+
+def test_torn_index_line_is_skipped(tmp_path):
+    cache = BlobCache(tmp_path, 1 << 20)
+    put(cache, 'a.txt', b'abc')
+    with open(cache.index_path, 'a') as f:
+        f.write('{"name": "b.tx')
+    assert BlobCache(tmp_path, 1 << 20).lookup('a.txt') is not None
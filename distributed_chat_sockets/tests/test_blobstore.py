@@ -0,0 +1,53 @@
+import hashlib
+import json
+
+from blobstore import BlobStore
+
+def put(store: BlobStore, name: str, data: bytes, room: str = None) -> str:
+    sha256 = hashlib.sha256(data).hexdigest()
+    tmp, f = store.begin()
+    with f:
+        f.write(data)
+    name = store.reserve_name(name, sha256)
+    store.commit(name, tmp, sha256, len(data), room=room)
+    return name
+
+def test_same_content_keeps_its_name(tmp_path):
+    store = BlobStore(tmp_path)
+    assert put(store, 'a.txt', b'one') == 'a.txt'
+    assert put(store, 'a.txt', b'one') == 'a.txt'
+    assert put(store, 'a.txt', b'two') == 'a_1.txt'
+    assert (tmp_path / 'a_1.txt').read_bytes() == b'two'
+
+def test_rooms_a_name_was_shared_to_survive_a_restart(tmp_path):
+    store = BlobStore(tmp_path)
+    put(store, 'a.txt', b'one', 'dev')
+    put(store, 'a.txt', b'one', 'ops')
+    put(store, 'b.txt', b'two')             # stored, never shared
+    store = BlobStore(tmp_path)
+    assert store.rooms_of('a.txt') == {'dev', 'ops'}
+    assert store.rooms_of('b.txt') == set() and store.resolve('b.txt') is not None
+
+def test_entries_from_before_rooms_belong_to_the_lobby(tmp_path):
+    with open(tmp_path / 'index.jsonl', 'w') as f:
+        f.write(json.dumps({'name': 'old.txt', 'sha256': 'ab' * 32, 'size': 3}) + '\n')
+    assert BlobStore(tmp_path).rooms_of('old.txt') == {'lobby'}
+
+def test_stores_sharing_a_directory_never_hand_out_one_name(tmp_path):
+    one, two = BlobStore(tmp_path), BlobStore(tmp_path)
+    assert one.reserve_name('a.txt') == 'a.txt'
+    assert two.reserve_name('a.txt') == 'a_1.txt'
+    tmp, f = one.begin()
+    f.close()
+    one.abort('a.txt', tmp)
+    assert not (tmp_path / 'a.txt').exists()
+    assert two.reserve_name('a.txt') == 'a.txt'
+
+def test_a_name_is_not_pointed_at_other_content(tmp_path):
+    store = BlobStore(tmp_path)
+    put(store, 'a.txt', b'one')
+    other = hashlib.sha256(b'two').hexdigest()
+    assert not store.record('a.txt', other, 3)
+    assert not store.remember('a.txt', other, 3)
+    assert store.resolve('a.txt') == (hashlib.sha256(b'one').hexdigest(), 3)
+    assert BlobStore(tmp_path).resolve('a.txt') == store.resolve('a.txt')
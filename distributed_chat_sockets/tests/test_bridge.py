@@ -0,0 +1,121 @@
+import hashlib
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip('flask_socketio')
+
+REPO = Path(__file__).resolve().parent.parent
+# the bridge is a script next to its own modules
+sys.path.insert(0, str(REPO / 'web_bridge'))
+import bridge
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+class Emitted:
+    """What the bridge emitted to each browser. The test client's own queue is not safe
+    against the link reader thread emitting, so the events are taken on the way out."""
+
+    def __init__(self, emit):
+        self.emit = emit
+        self.events = []
+        self.lock = threading.Lock()
+
+    def __call__(self, event, data=None, room=None, **kw):
+        with self.lock:
+            self.events.append((room, event, data))
+        return self.emit(event, data, room=room, **kw)
+
+    def wait_for(self, sid: str, event: str, match=lambda data: True, timeout: float = 5) -> dict:
+        end = time.monotonic() + timeout
+        while time.monotonic() < end:
+            with self.lock:
+                for room, name, data in self.events:
+                    if room == sid and name == event and match(data):
+                        return data
+            time.sleep(0.01)
+        raise AssertionError(f'no {event} for {sid} in {self.events}')
+
+@pytest.fixture
+def emitted(monkeypatch):
+    spy = Emitted(bridge.socketio.emit)
+    monkeypatch.setattr(bridge.socketio, 'emit', spy)
+    return spy
+
+@pytest.fixture
+def browsers(tmp_path, monkeypatch):
+    """Test browsers, on a bridge linked to a chat server of their own."""
+    port = free_port()
+    server = subprocess.Popen([sys.executable, str(REPO / 'server_tcp.py'), '--port', str(port),
+                               '--upload-dir', str(tmp_path / 'server')],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    monkeypatch.setattr(bridge, 'TCP_SERVER_PORT', port)
+    monkeypatch.setattr(bridge, 'UPLOAD_DIR', tmp_path / 'bridge')
+    monkeypatch.setattr(bridge, 'CACHE', bridge.BlobCache(tmp_path / 'bridge', 1 << 20))
+    opened = []
+    yield opened
+    for b in opened:
+        b.disconnect()
+    for link in list(bridge.links):
+        link['sock'].close()
+    bridge.links.clear()
+    server.terminate()
+    server.wait()
+
+def browser(browsers, emitted, name: str):
+    """A browser joined as name, and its sid."""
+    b = bridge.socketio.test_client(bridge.app)
+    browsers.append(b)
+    sid = bridge.socketio.server.manager.sid_from_eio_sid(b.eio_sid, '/')
+    b.emit('join', {'username': name})
+    emitted.wait_for(sid, 'history')
+    return b, sid
+
+def test_upload_streams_to_the_chat_server_and_is_shared(browsers, emitted):
+    _, ann = browser(browsers, emitted, 'ann')
+    _, bob = browser(browsers, emitted, 'bob')
+    data = bytes(range(256)) * 1000
+    reply = bridge.app.test_client().post(f'/upload?sid={ann}&filename=notes.bin', data=data)
+    assert reply.status_code == 200
+    assert reply.get_json() == {'filename': 'notes.bin', 'filesize': len(data),
+                                'sha256': hashlib.sha256(data).hexdigest()}
+    assert emitted.wait_for(bob, 'file')['url'] == '/uploads/notes.bin'
+    # pulled from the chat server on the first request, then served from the cache
+    got = bridge.app.test_client().get('/uploads/notes.bin')
+    assert got.status_code == 200 and got.data == data
+    assert bridge.CACHE.lookup('notes.bin')
+
+def test_upload_needs_a_joined_browser(browsers):
+    reply = bridge.app.test_client().post('/upload?sid=nobody&filename=a.txt', data=b'abc')
+    assert reply.status_code == 403
+
+def test_malformed_events_are_not_forwarded(browsers, emitted):
+    client, ann = browser(browsers, emitted, 'ann')
+    _, bob = browser(browsers, emitted, 'bob')
+    client.emit('message', {'text': ['not', 'text']})
+    emitted.wait_for(ann, 'system', lambda data: data['text'] == 'Malformed request')
+    client.emit('message', {'text': 'fine'})
+    emitted.wait_for(bob, 'message', lambda data: data.get('username') == 'ann')
+    assert [data['text'] for room, name, data in emitted.events if room == bob and name == 'message'] == ['fine']
+
+def test_green_threads_when_gevent_is_there():
+    try:
+        import gevent  # noqa: F401
+        expected = 'gevent'
+    except ImportError:
+        expected = 'threading'
+    assert bridge.ASYNC_MODE == expected == bridge.socketio.async_mode
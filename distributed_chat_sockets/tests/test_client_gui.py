@@ -0,0 +1,72 @@
+import importlib
+import queue
+import threading
+
+import pytest
+
+tk = pytest.importorskip('tkinter')
+
+@pytest.fixture
+def gui_module(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)     # the client makes its download folder on import
+    return importlib.import_module('client_gui')
+
+class Root:
+    """Stands in for the Tk root where only after() is used."""
+
+    def __init__(self):
+        self.scheduled = []
+
+    def after(self, ms, fn):
+        self.scheduled.append((ms, fn))
+
+@pytest.fixture
+def unbuilt(gui_module):
+    """A GUI object with its line queue but no widgets; _draw records the batches."""
+    gui = gui_module.ChatClientGUI.__new__(gui_module.ChatClientGUI)
+    gui.root = Root()
+    gui._lines = queue.SimpleQueue()
+    gui.drawn = []
+    gui._draw = gui.drawn.append
+    return gui
+
+def test_lines_from_other_threads_wait_for_the_tk_loop(unbuilt):
+    t = threading.Thread(target=unbuilt.append, args=('hi', 'system'))
+    t.start()
+    t.join()
+    assert unbuilt.drawn == []
+    unbuilt._render()
+    [[(segments, on_click, _)]] = unbuilt.drawn
+    assert segments == [('hi\n', 'system')] and on_click is None
+
+def test_a_flood_is_drawn_in_bounded_batches(gui_module, unbuilt):
+    for i in range(gui_module.RENDER_BATCH_MAX + 10):
+        unbuilt.append(f'm{i}', include_time=False)
+    unbuilt._render()
+    unbuilt._render()
+    unbuilt._render()
+    assert [len(b) for b in unbuilt.drawn] == [gui_module.RENDER_BATCH_MAX, 10]
+    # it keeps coming back, drawn or not
+    assert [ms for ms, _ in unbuilt.root.scheduled] == [gui_module.RENDER_INTERVAL] * 3
+
+@pytest.fixture
+def window(gui_module):
+    try:
+        root = tk.Tk()
+    except tk.TclError:
+        pytest.skip('no display')
+    root.withdraw()
+    yield gui_module.ChatClientGUI(root)
+    root.destroy()
+
+def test_scrollback_is_bounded_and_old_links_go_with_it(gui_module, window, monkeypatch):
+    monkeypatch.setattr(gui_module, 'SCROLLBACK_LINES', 5)
+    window._insert_link('old.txt', lambda: None)
+    for i in range(10):
+        window.append(f'm{i}', include_time=False)
+    window._insert_link('new.txt', lambda: None)
+    window._render()
+    lines = window.chat_text.get('1.0', 'end-1c').splitlines()
+    assert len(lines) == 5 and lines[-1].endswith('new.txt')
+    assert list(window._link_tags) == ['filelink_1']
+    assert 'filelink_0' not in window.chat_text.tag_names()
@@ -0,0 +1,34 @@
+import pytest
+
+from blobstore import BlobStore
+from cluster import Cluster, PeerBroker
+
+@pytest.fixture
+def node(tmp_path):
+    events = []
+    broker = PeerBroker([('127.0.0.1', 9010)], 'k')
+    cluster = Cluster('127.0.0.1:9009', '127.0.0.1:9009', broker, BlobStore(tmp_path), events.append, 'k')
+    return cluster, events
+
+def file_event(addr: str, seq: int = 1):
+    return {'kind': 'file', 'origin': 'a', 'id': f'a:{seq}', 'addr': addr, 'username': 'ann',
+            'filename': 'x.bin', 'orig_filename': 'x.bin', 'filesize': 3, 'sha256': '0' * 64, 'room': 'lobby'}
+
+def test_files_from_a_peer_are_announced(node):
+    cluster, events = node
+    cluster.receive(file_event('127.0.0.1:9010'))
+    [event] = events
+    assert cluster.has_file(event['name'])
+
+@pytest.mark.parametrize('addr', ['10.0.0.1:9010', '127.0.0.1:22', 'nonsense', 9010])
+def test_files_elsewhere_are_never_pulled(node, addr):
+    cluster, events = node
+    cluster.receive(file_event(addr))
+    assert events == []
+    assert cluster.files == {}
+
+def test_forwarded_files_point_at_this_node(node):
+    cluster, events = node
+    cluster.receive(file_event('127.0.0.1:9010'))
+    [link] = cluster.broker.links
+    assert b'127.0.0.1:9009' in link.queue[0] and b'127.0.0.1:9010' not in link.queue[0]
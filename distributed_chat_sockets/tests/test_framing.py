@@ -0,0 +1,99 @@
+import socket
+
+import pytest
+
+from framing import SCHEMAS, FrameReader, decode_header, encode_header, send_frame
+
+@pytest.fixture
+def pair():
+    a, b = socket.socketpair()
+    yield a, b
+    a.close()
+    b.close()
+
+def test_reader_gets_header_and_payload(pair):
+    a, b = pair
+    send_frame(a, {'type': 'file', 'filename': 'x.bin', 'filesize': 5}, b'hello')
+    reader = FrameReader(b)
+    assert reader.read_header() == {'type': 'file', 'filename': 'x.bin', 'filesize': 5}
+    assert bytes(reader.read_exact(5)) == b'hello'
+
+def test_read_exact_larger_than_buffer(pair):
+    a, b = pair
+    payload = bytes(range(256)) * 40
+    reader = FrameReader(b, bufsize=1024)
+    send_frame(a, {'type': 'file', 'filesize': len(payload)}, payload)
+    a.close()
+    assert reader.read_header()['filesize'] == len(payload)
+    assert bytes(reader.read_exact(len(payload))) == payload
+    assert reader.read_header() is None
+
+def test_read_exact_negative_is_a_protocol_error(pair):
+    a, b = pair
+    send_frame(a, {'type': 'upload_chunk', 'size': -88})
+    send_frame(a, {'type': 'message', 'text': 'next'})
+    reader = FrameReader(b)
+    header = reader.read_header()
+    with pytest.raises(ValueError):
+        reader.read_exact(header['size'])
+    # the cursor did not move backwards into the header just read
+    assert reader.read_header() == {'type': 'message', 'text': 'next'}
+
+def test_read_exact_zero(pair):
+    a, b = pair
+    assert FrameReader(b).read_exact(0) == b''
+
+def test_oversized_header_is_a_protocol_error(pair):
+    a, b = pair
+    a.sendall(b'\x7f\xff\xff\xff')
+    with pytest.raises(ValueError):
+        FrameReader(b).read_header()
+
+def test_closed_mid_payload(pair):
+    a, b = pair
+    send_frame(a, {'type': 'file', 'filesize': 10}, b'abc')
+    a.close()
+    reader = FrameReader(b)
+    reader.read_header()
+    assert reader.read_exact(10) is None
+
+def decoded(header, compact=True):
+    data = encode_header(header, compact)
+    return data[4], decode_header(data[4:])
+
+@pytest.mark.parametrize('schema', SCHEMAS, ids=lambda s: f'{s.tag}-{s.type}')
+def test_compact_round_trip(schema):
+    header = {'type': schema.type}
+    header.update((k, -(i + 1) * 2 ** 40) for i, k in enumerate(schema.ints))
+    header.update((k, f'{k} \u00e9\u2603') for k in schema.strs)
+    assert decoded(header) == (schema.tag, header)
+
+@pytest.mark.parametrize('header', [
+    {'type': 'message', 'username': 'ann', 'text': 'hi', 'seq': 12},
+    {'type': 'message', 'username': 'ann', 'text': 'hi', 'room': 'dev', 'seq': 3},
+    {'type': 'message', 'text': 'hi', 'id': 4},
+    {'type': 'system', 'text': 'bob joined', 'seq': 13},
+    {'type': 'ack', 'id': 4, 'seq': 12},
+    {'type': 'file_announce', 'id': 'ab' * 32, 'username': 'ann', 'filename': 'a.bin',
+     'orig_filename': 'a.bin', 'filesize': 5, 'sha256': 'ab' * 32, 'seq': 14},
+])
+def test_room_and_session_frames_are_compact(header):
+    tag, back = decoded(header)
+    assert tag < 0x20 and back == header
+
+@pytest.mark.parametrize('header', [
+    {'type': 'message', 'username': 'ann', 'text': 'hi', 'seq': 12, 'vid': 3},   # extra field
+    {'type': 'ack', 'id': 4, 'seq': None},          # direct messages have no seq
+    {'type': 'message', 'text': 'hi', 'id': '4'},   # not an int
+    {'type': 'message', 'text': 'hi', 'id': True},
+    {'type': 'join', 'username': 'ann'},            # no schema
+])
+def test_other_headers_fall_back_to_json(header):
+    assert decoded(header) == (ord('{'), header)
+
+def test_json_unless_asked():
+    assert decoded({'type': 'message', 'text': 'hi'}, compact=False) == (ord('{'), {'type': 'message', 'text': 'hi'})
+
+def test_unknown_tag_is_a_protocol_error():
+    with pytest.raises(ValueError):
+        decode_header(bytes([0x1f]))
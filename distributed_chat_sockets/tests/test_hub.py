@@ -0,0 +1,332 @@
+import hashlib
+
+import pytest
+
+from blobstore import BlobStore
+from cluster import Cluster, PeerBroker
+from framing import COMPACT, decode_header
+from hub import Client, Hub
+from msglog import MessageLog
+from transfers import PROOF_SIZE, Staging, range_proof
+import sessions
+import workers
+
+class Outbound:
+    """Stand-in for an engine's outbound queue that keeps the headers put on it."""
+
+    def __init__(self):
+        self.headers = []
+        self.frames = []        # as encoded, length prefix and all
+        self.closed = False
+        self.depth = self.dropped = 0
+
+    def put(self, frame: bytes, payload: bytes = None) -> bool:
+        self.frames.append(frame)
+        self.headers.append(decode_header(frame[4:]))
+        return True
+
+    def put_bulk(self, bulk) -> bool:
+        self.headers.append('bulk')
+        return True
+
+    def close(self):
+        self.closed = True
+
+    def of_type(self, typ: str):
+        return [h for h in self.headers if h != 'bulk' and h.get('type') == typ]
+
+@pytest.fixture
+def hub(tmp_path):
+    return Hub(BlobStore(tmp_path), Staging(tmp_path / 'staging'))
+
+def join(hub, username: str, features=(), **fields) -> Client:
+    client = Client(('127.0.0.1', len(hub.clients) + 5000), Outbound())
+    assert hub.handle(client, dict(fields, type='join', username=username, features=list(features)))
+    return client
+
+def test_worker_takes_peer_links_from_its_bus_only(hub, tmp_path):
+    hub.cluster = workers.worker_cluster(str(tmp_path), 0, 2, '127.0.0.1:9009', hub.store, None)
+    hello = {'type': 'peer_hello', 'node': 'worker-1', 'key': ''}
+    assert hub.admit_peer(Client('', None, bus=True), hello)
+    assert not hub.admit_peer(Client(('127.0.0.1', 5000), None), hello)
+
+def test_no_peer_links_without_a_cluster(hub):
+    assert not hub.admit_peer(Client(('127.0.0.1', 5000), None), {'type': 'peer_hello', 'key': ''})
+
+@pytest.mark.parametrize('key, ok', [('k3y', True), ('k3x', False), ('', False), (None, False), (7, False)])
+def test_peer_links_need_the_cluster_key(hub, key, ok):
+    hub.cluster = Cluster('a', '127.0.0.1:9009', PeerBroker([('127.0.0.1', 9010)], 'k3y'), hub.store, None, 'k3y')
+    assert hub.admit_peer(Client(('127.0.0.1', 5000), None), {'type': 'peer_hello', 'key': key}) == ok
+    assert not hub.admit_peer(Client('', None, bus=True), {'type': 'peer_hello', 'key': key})
+
+def test_peer_cluster_without_a_key_takes_no_links(hub):
+    hub.cluster = Cluster('a', '127.0.0.1:9009', PeerBroker([('127.0.0.1', 9010)]), hub.store, None)
+    assert not hub.admit_peer(Client(('127.0.0.1', 5000), None), {'type': 'peer_hello', 'key': ''})
+
+def test_mux_users_pull_files_whatever_the_delivery(hub):
+    assert hub.file_delivery == 'push'
+    link = Client(('127.0.0.1', 4000), Outbound())
+    users = {}
+    header = {'type': 'join', 'vid': 1, 'username': 'web', 'features': ['pull']}
+    user = hub.mux_client(link, users, header)
+    assert hub.handle(user, header)
+    assert user.pull and not user.chunks
+    tcp = join(hub, 'tcp', ['pull', 'chunks'])
+    assert not tcp.pull and tcp.chunks
+    blob = hub.store.blob_dir / 'x'
+    blob.write_bytes(b'abc')
+    hub.share_file(None, 'ann', 'a.txt', 'a.txt', 3, 'ab' * 32, blob)
+    # the link gets an announce for its user, never the payload
+    [ann] = link.outq.of_type('file_announce')
+    assert ann['vids'] == [1] and 'bulk' not in link.outq.headers and not link.outq.of_type('file')
+
+@pytest.fixture
+def stored(hub, tmp_path):
+    """A file the server already has, and the uploader's own copy of it."""
+    data = bytes(range(256)) * (PROOF_SIZE // 64)
+    sha256 = hashlib.sha256(data).hexdigest()
+    tmp, f = hub.store.begin()
+    with f:
+        f.write(data)
+    hub.store.commit(hub.store.reserve_name('orig.bin', sha256), tmp, sha256, len(data))
+    copy = tmp_path / 'copy.bin'
+    copy.write_bytes(data)
+    return copy, sha256, len(data)
+
+def offer(hub, client, sha256, size):
+    hub.handle(client, {'type': 'file_offer', 'filename': 'mine.bin', 'filesize': size, 'sha256': sha256})
+    return client.outq.of_type('file_offer_reply')[-1]
+
+def test_offer_of_unknown_content_is_uploaded(hub, stored):
+    ann = join(hub, 'ann')
+    reply = offer(hub, ann, 'ab' * 32, 10)
+    assert reply == {'type': 'file_offer_reply', 'sha256': 'ab' * 32, 'have': False}
+
+def test_offer_is_shared_once_proven(hub, stored):
+    copy, sha256, size = stored
+    ann, bob = join(hub, 'ann'), join(hub, 'bob')
+    challenge = offer(hub, ann, sha256, size)['challenge']
+    assert not ann.outq.of_type('file_offer_reply')[-1]['have']
+    assert 0 <= challenge['offset'] <= size - challenge['length'] and challenge['length'] == PROOF_SIZE
+    hub.handle(ann, {'type': 'file_proof', 'sha256': sha256, 'proof': range_proof(copy, challenge)})
+    reply = ann.outq.of_type('file_offer_reply')[-1]
+    assert reply['have'] and reply['filename'] == 'mine.bin'
+    assert hub.store.resolve('mine.bin') == (sha256, size)
+    [pushed] = bob.outq.of_type('file')
+    assert pushed['filename'] == 'mine.bin' and pushed['sha256'] == sha256
+
+@pytest.mark.parametrize('proof', ['0' * 64, None, 7, 'wrong'])
+def test_hash_alone_gets_nothing_shared(hub, stored, proof):
+    copy, sha256, size = stored
+    ann = join(hub, 'ann')
+    offer(hub, ann, sha256, size)
+    hub.handle(ann, {'type': 'file_proof', 'sha256': sha256, 'proof': proof})
+    assert ann.outq.of_type('file_offer_reply')[-1] == {'type': 'file_offer_reply', 'sha256': sha256,
+                                                        'have': False}
+    assert hub.store.resolve('mine.bin') is None
+
+def test_proof_needs_an_offer_of_its_own(hub, stored):
+    copy, sha256, size = stored
+    ann, eve = join(hub, 'ann'), join(hub, 'eve')
+    challenge = offer(hub, ann, sha256, size)['challenge']
+    # a proof is good for one offer, by the client that made it
+    hub.handle(eve, {'type': 'file_proof', 'sha256': sha256, 'proof': range_proof(copy, challenge)})
+    assert not eve.outq.of_type('file_offer_reply')[-1]['have']
+    hub.handle(ann, {'type': 'file_proof', 'sha256': sha256, 'proof': range_proof(copy, challenge)})
+    assert ann.outq.of_type('file_offer_reply')[-1]['have']
+    hub.handle(ann, {'type': 'file_proof', 'sha256': sha256, 'proof': range_proof(copy, challenge)})
+    assert not ann.outq.of_type('file_offer_reply')[-1]['have']
+
+def texts(client, typ='message'):
+    return [(h.get('room'), h['text']) for h in client.outq.of_type(typ)]
+
+def test_room_messages_reach_its_members_only(hub):
+    ann, bob, cat = join(hub, 'ann'), join(hub, 'bob'), join(hub, 'cat')
+    hub.handle(ann, {'type': 'join_room', 'room': 'dev'})
+    hub.handle(bob, {'type': 'join_room', 'room': 'dev'})
+    hub.handle(ann, {'type': 'message', 'room': 'dev', 'text': 'hi dev'})
+    hub.handle(ann, {'type': 'message', 'text': 'hi all'})
+    assert texts(bob) == [('dev', 'hi dev'), (None, 'hi all')]
+    assert texts(cat) == [(None, 'hi all')]
+    assert texts(ann) == []
+    assert ('dev', 'bob joined #dev') in texts(ann, 'system') and ('dev', 'bob joined #dev') not in texts(cat, 'system')
+
+def test_join_room_reply_carries_the_rooms_seq(hub):
+    ann, bob = join(hub, 'ann'), join(hub, 'bob')
+    hub.handle(ann, {'type': 'join_room', 'room': 'dev'})
+    hub.handle(ann, {'type': 'message', 'room': 'dev', 'text': 'one'})
+    hub.handle(bob, {'type': 'join_room', 'room': 'dev'})
+    reply = bob.outq.of_type('system')[-1]
+    assert reply['last_seq'] == 2 and reply['text'] == 'Joined #dev (2 members)'
+    hub.handle(ann, {'type': 'message', 'room': 'dev', 'text': 'two'})
+    assert bob.outq.of_type('message')[-1]['seq'] == 4      # bob's own join notice was 3
+
+@pytest.mark.parametrize('room', ['', 'x' * 65, None, 'a\nb'])
+def test_bad_room_names_are_refused(hub, room):
+    ann = join(hub, 'ann')
+    hub.handle(ann, {'type': 'join_room', 'room': room})
+    assert ann.outq.of_type('system')[-1]['text'] == 'Cannot join that room'
+    assert ann.rooms == {'lobby'}
+
+def test_no_posting_to_a_room_you_left(hub):
+    ann, bob = join(hub, 'ann'), join(hub, 'bob')
+    for c in (ann, bob):
+        hub.handle(c, {'type': 'join_room', 'room': 'dev'})
+    hub.handle(ann, {'type': 'leave_room', 'room': 'dev'})
+    assert ann.outq.of_type('system')[-1] == {'type': 'system', 'room': 'dev', 'text': 'Left #dev'}
+    assert hub.rooms.members('dev') == [bob]
+    hub.handle(ann, {'type': 'message', 'room': 'dev', 'text': 'still here?'})
+    assert ann.outq.of_type('system')[-1]['text'] == 'You are not in #dev'
+    assert ('dev', 'still here?') not in texts(bob)
+
+def test_dropped_client_leaves_its_rooms(hub):
+    ann, bob = join(hub, 'ann'), join(hub, 'bob')
+    hub.handle(ann, {'type': 'join_room', 'room': 'dev'})
+    hub.drop_client(ann)
+    assert hub.rooms.members('dev') == [] and hub.rooms.members('lobby') == [bob]
+    assert hub.users.get('ann') is None
+
+def test_direct_messages_go_to_the_named_user(hub):
+    ann, bob, cat = join(hub, 'ann'), join(hub, 'bob'), join(hub, 'cat')
+    hub.handle(ann, {'type': 'message', 'to': 'bob', 'text': 'psst'})
+    assert bob.outq.of_type('message') == [{'type': 'message', 'username': 'ann', 'text': 'psst', 'to': 'bob'}]
+    assert texts(cat) == []
+    hub.handle(ann, {'type': 'message', 'to': 'dan', 'text': 'anyone?'})
+    assert ann.outq.of_type('system')[-1]['text'] == 'No user named dan'
+
+def test_resent_message_is_acked_not_posted_again(hub):
+    ann, bob = join(hub, 'ann', ['resume']), join(hub, 'bob')
+    hub.handle(ann, {'type': 'message', 'id': 1, 'text': 'once'})
+    hub.handle(ann, {'type': 'message', 'id': 1, 'text': 'once'})
+    first, again = ann.outq.of_type('ack')
+    assert first == again == {'type': 'ack', 'id': 1, 'seq': first['seq']}
+    assert texts(bob) == [(None, 'once')]
+
+def test_resumed_session_gets_what_it_missed(hub):
+    ann, bob = join(hub, 'ann', ['resume']), join(hub, 'bob')
+    token = ann.outq.of_type('session')[0]['token']
+    hub.handle(ann, {'type': 'join_room', 'room': 'dev'})
+    hub.handle(bob, {'type': 'join_room', 'room': 'dev'})
+    seen = {'lobby': hub.feed.last_seq('lobby'), 'dev': hub.feed.last_seq('dev')}
+    hub.drop_client(ann)
+    # the others hear nothing of the drop; direct messages wait
+    assert not [t for _, t in texts(bob, 'system') if 'left' in t]
+    hub.handle(bob, {'type': 'message', 'text': 'lobby news'})
+    hub.handle(bob, {'type': 'message', 'room': 'dev', 'text': 'dev news'})
+    hub.handle(bob, {'type': 'message', 'to': 'ann', 'text': 'psst'})
+    assert bob.outq.of_type('system')[-1]['text'] == 'ann is away; they get it when back'
+    back = join(hub, 'whoever', ['resume'], resume=token, seqs=seen)
+    assert back.username == 'ann' and back.rooms == {'lobby', 'dev'}
+    assert back.outq.of_type('session') == [{'type': 'session', 'token': token, 'resumed': True}]
+    # room by room, then the held direct messages
+    assert texts(back) == [('dev', 'dev news'), (None, 'lobby news'), (None, 'psst')]
+
+def test_replay_from_the_log_waits_off_the_loop(tmp_path, monkeypatch):
+    monkeypatch.setattr(sessions, 'RING_SIZE', 2)
+    pending = []
+    log = MessageLog(tmp_path / 'history')
+    hub = Hub(BlobStore(tmp_path), Staging(tmp_path / 'staging'), msglog=log,
+              blocking=lambda client, fn, args, then: pending.append((fn, args, then)))
+    try:
+        ann, bob = join(hub, 'ann', ['resume']), join(hub, 'bob')
+        token = ann.outq.of_type('session')[0]['token']
+        seen = {'lobby': hub.feed.last_seq('lobby')}
+        hub.drop_client(ann)
+        for i in range(4):
+            hub.handle(bob, {'type': 'message', 'text': f'm{i}'})
+        back = join(hub, 'ann', ['resume'], resume=token, seqs=seen)
+        [(fn, args, then)] = pending
+        # posted while the log is read: sent once, after what came before it
+        hub.handle(bob, {'type': 'message', 'text': 'meanwhile'})
+        assert texts(back) == []
+        then(fn(*args))
+        assert texts(back) == [(None, f'm{i}') for i in range(4)] + [(None, 'meanwhile')]
+    finally:
+        log.close()
+
+def test_workers_hand_out_no_sessions(tmp_path):
+    hub = Hub(BlobStore(tmp_path), Staging(tmp_path / 'staging'), resumable=False)
+    ann = join(hub, 'ann', ['resume'])
+    assert ann.outq.of_type('session') == [] and ann.session is None
+
+def test_expired_session_leaves_its_rooms(hub):
+    hub.sessions.ttl = 0
+    ann, bob = join(hub, 'ann', ['resume']), join(hub, 'bob')
+    hub.drop_client(ann)
+    hub.expire_sessions()
+    assert (None, 'ann left') in texts(bob, 'system')
+
+def test_compact_is_confirmed_in_json_then_used(hub):
+    ann, bob, cat = join(hub, 'ann', [COMPACT]), join(hub, 'bob', [COMPACT]), join(hub, 'cat')
+    assert ann.compact and not cat.compact
+    assert ann.outq.headers[0] == {'type': 'features', 'features': [COMPACT]}
+    assert ann.outq.frames[0][4:5] == b'{'
+    hub.handle(cat, {'type': 'message', 'text': 'hi'})
+    assert ann.outq.frames[-1][4] < 0x20 and ann.outq.headers[-1]['text'] == 'hi'
+    # encoded once for both compact clients
+    assert ann.outq.frames[-1] is bob.outq.frames[-1]
+    hub.handle(ann, {'type': 'message', 'text': 'hey'})
+    assert cat.outq.frames[-1][4:5] == b'{' and cat.outq.headers[-1]['text'] == 'hey'
+
+def test_compact_is_not_offered_unasked(hub):
+    cat = join(hub, 'cat', ['pull'])
+    assert not cat.compact and not cat.outq.of_type('features')
+
+@pytest.mark.parametrize('frame', [
+    {'type': 'message', 'text': 7},
+    {'type': 'message', 'text': 'hi', 'room': ['dev']},
+    {'type': 'message', 'text': 'hi', 'id': [1]},
+    {'type': 'history', 'before': 'x'},
+    {'type': 'history', 'limit': 2.5},
+    {'type': 'fetch', 'filename': 'a.txt', 'offset': '0'},
+    {'type': 'leave_room', 'room': {}},
+    {'type': 'upload_begin', 'transfer_id': 'f00d' * 8, 'filesize': True},
+])
+def test_frames_with_wrong_types_get_an_error(hub, frame):
+    ann, bob = join(hub, 'ann'), join(hub, 'bob')
+    assert hub.handle(ann, frame)
+    assert 'has the wrong type' in ann.outq.of_type('system')[-1]['text']
+    assert texts(bob) == []
+
+@pytest.fixture
+def shared(hub):
+    """dev.txt, shared to #dev."""
+    hub.store.record('dev.txt', 'cd' * 32, 8, 'dev')
+    return 'dev.txt'
+
+def test_files_go_to_members_of_their_room(hub, shared):
+    ann, bob = join(hub, 'ann'), join(hub, 'bob')
+    hub.handle(ann, {'type': 'join_room', 'room': 'dev'})
+    hub.handle(ann, {'type': 'fetch', 'filename': shared})
+    assert ann.outq.headers[-1] == 'bulk'
+    hub.handle(bob, {'type': 'fetch', 'filename': shared})
+    assert bob.outq.of_type('fetch_done')[-1] == {'type': 'fetch_done', 'filename': shared, 'error': 'not found'}
+
+def test_fetch_needs_a_join(hub, shared):
+    anon = Client(('127.0.0.1', 4000), Outbound())
+    anon.rooms.add('dev')
+    assert hub.handle(anon, {'type': 'fetch', 'filename': shared})
+    assert anon.outq.of_type('fetch_done')[-1]['error'] == 'not found'
+
+def test_peers_fetch_with_the_cluster_key(hub, shared):
+    hub.cluster = Cluster('a', '127.0.0.1:9009', PeerBroker([('127.0.0.1', 9010)], 'k3y'), hub.store, None, 'k3y')
+    node = Client(('127.0.0.1', 4000), Outbound())
+    assert hub.handle(node, {'type': 'peer_fetch', 'filename': shared, 'key': 'k3y'})
+    assert node.outq.headers == ['bulk']
+    assert not hub.handle(Client(('127.0.0.1', 4001), Outbound()),
+                          {'type': 'peer_fetch', 'filename': shared, 'key': 'nope'})
+
+def test_client_joining_during_a_presence_flush_gets_the_change(hub):
+    ann = join(hub, 'ann', ['presence'])
+    hub.flush_presence()
+    late = Client(('127.0.0.1', 4000), Outbound())
+    late.presence = True
+    def remote():
+        # a join that has added itself to the clients, its snapshot waiting for the roster lock
+        with hub.clients_lock:
+            hub.clients.add(late)
+        return ['zed']
+    hub.presence.remote = remote
+    hub.flush_presence()
+    assert late.outq.of_type('presence') == [{'type': 'presence', 'online': ['zed'], 'offline': []}]
+    assert ann.outq.of_type('presence')[-1] == late.outq.of_type('presence')[-1]
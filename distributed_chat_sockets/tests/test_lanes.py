@@ -0,0 +1,92 @@
+import hashlib
+import socket
+import threading
+
+import lanes
+from framing import decode_header
+from lanes import MAX_ACTIVE, Bulk, BulkLane, TokenBucket, stream_frames
+from outbound import FrameQueue, OutboundQueue
+from relay import FileSlice, UploadStream
+
+def test_unlimited_bucket_never_waits():
+    bucket = TokenBucket(0)
+    assert bucket.take(10**9) == 0 and bucket.wait_time() == 0
+
+def test_bucket_paces_past_its_burst():
+    bucket = TokenBucket(1000, burst=1000)
+    assert bucket.take(1000) == 0
+    assert 0.9 < bucket.take(1000) <= 1.0
+    assert bucket.wait_time() > 0.9
+
+def bulk(name: str, n: int) -> Bulk:
+    return Bulk((f'{name}{i}'.encode(),) for i in range(n))
+
+def test_transfers_take_turns_chunk_by_chunk():
+    lane = BulkLane(FrameQueue())
+    lane.pending.push((bulk('a', 3),))
+    lane.pending.push((bulk('b', 1),))
+    lane.activate(None)
+    sent = []
+    while True:
+        frame, _ = lane.next_frame()
+        if frame is None:
+            break
+        sent.append(frame[0])
+    assert sent == [b'a0', b'b0', b'a1', b'a2']
+    assert not lane.active
+
+def test_only_a_few_transfers_are_active_at_once():
+    lane = BulkLane(FrameQueue())
+    for i in range(MAX_ACTIVE + 2):
+        lane.pending.push((bulk(str(i), 1),))
+    lane.activate(None)
+    assert len(lane.active) == MAX_ACTIVE and len(lane.pending) == 2
+    assert len(lane) == MAX_ACTIVE + 2
+
+def chunk_frames(stream, **header):
+    frames = list(stream_frames(stream, dict(header, type='file', filename='f'), '7'))
+    return [decode_header(f[0][4:]) for f in frames], frames
+
+def test_pushed_file_goes_out_as_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(lanes, 'BULK_CHUNK', 4)
+    (tmp_path / 'f').write_bytes(b'0123456789')
+    digest = hashlib.sha256(b'0123456789').hexdigest()
+    headers, frames = chunk_frames(UploadStream.complete(tmp_path / 'f', 10), sha256=digest)
+    assert [h['type'] for h in headers] == ['file_start'] + ['file_chunk'] * 3 + ['file_end']
+    assert [(h['offset'], h['size']) for h in headers[1:-1]] == [(0, 4), (4, 4), (8, 2)]
+    assert all(isinstance(f[1], FileSlice) for f in frames[1:-1])
+    assert headers[-1] == {'type': 'file_end', 'id': '7', 'filesize': 10, 'sha256': digest}
+
+def test_failed_upload_ends_the_transfer_with_an_error(tmp_path):
+    stream = UploadStream(tmp_path / 'f', 10)
+    (tmp_path / 'f').write_bytes(b'abc')
+    stream.advance(3)
+    stream.fail()
+    headers, _ = chunk_frames(stream)
+    assert headers[-1]['error'] == 'interrupted'
+    assert [h['type'] for h in headers] == ['file_start', 'file_chunk', 'file_end']
+
+def test_chat_goes_out_ahead_of_a_file():
+    a, b = socket.socketpair()
+    chunk = b'.' * 65536
+    try:
+        out = OutboundQueue(a)
+        out.put_bulk(Bulk((chunk,) for _ in range(200)))
+        out.put(b'!')
+        got = bytearray()
+        def read():
+            while len(got) < 200 * len(chunk) + 1:
+                data = b.recv(1 << 20)
+                if not data:
+                    break
+                got.extend(data)
+        t = threading.Thread(target=read, daemon=True)
+        t.start()
+        t.join(10)
+        assert len(got) == 200 * len(chunk) + 1
+        # at most the chunks already on their way were sent before the message
+        assert got.index(b'!') < len(got) // 2
+        out.close()
+    finally:
+        a.close()
+        b.close()
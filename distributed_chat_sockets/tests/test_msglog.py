@@ -0,0 +1,119 @@
+import pytest
+
+import msglog
+from msglog import MessageLog, PAGE_MAX
+
+@pytest.fixture
+def log(tmp_path):
+    log = MessageLog(tmp_path / 'history')
+    yield log
+    log.close()
+
+def post(log, room: str, n: int):
+    for i in range(n):
+        log.append(room, {'type': 'message', 'username': 'ann', 'text': f'm{i + 1}'})
+
+def seqs(records):
+    return [h['seq'] for h in records]
+
+def test_seqs_count_up_per_room(log):
+    assert log.append('lobby', {'type': 'message', 'text': 'a'}) == 1
+    assert log.append('dev', {'type': 'message', 'text': 'b'}) == 1
+    assert log.append('lobby', {'type': 'message', 'text': 'c'}) == 2
+    assert log.last_seq('lobby') == 2 and log.last_seq('nowhere') == 0
+
+def test_newest_page_by_default(log):
+    post(log, 'lobby', 120)
+    records, first, last = log.history('lobby', limit=50)
+    assert (first, last) == (1, 120)
+    assert seqs(records) == list(range(71, 121))
+    assert records[-1]['text'] == 'm120' and 'ts' in records[-1]
+
+def test_paging_backwards_sees_every_record_once(log):
+    post(log, 'lobby', 120)
+    seen, before = [], None
+    while True:
+        records, _, _ = log.history('lobby', before=before, limit=50)
+        if not records:
+            break
+        seen = seqs(records) + seen
+        before = records[0]['seq']
+    assert seen == list(range(1, 121))
+
+def test_paging_forwards_after_a_seq(log):
+    post(log, 'lobby', 30)
+    records, _, _ = log.history('lobby', after=10, limit=5)
+    assert seqs(records) == [11, 12, 13, 14, 15]
+    assert seqs(log.history('lobby', after=28, limit=5)[0]) == [29, 30]
+    assert log.history('lobby', after=30)[0] == []
+
+def test_limit_is_clamped(log):
+    post(log, 'lobby', PAGE_MAX + 10)
+    assert len(log.history('lobby', limit=10_000)[0]) == PAGE_MAX
+    assert len(log.history('lobby', limit=0)[0]) == 1
+
+def test_empty_room(log):
+    assert log.history('nowhere') == ([], 1, 0)
+    assert log.get('nowhere', 1) is None
+
+def test_get_one_record(log):
+    post(log, 'lobby', 3)
+    log.history('lobby')        # waits until the writer has them on disk
+    assert log.get('lobby', 2)['text'] == 'm2'
+    assert log.get('lobby', 4) is None
+
+def test_reopened_log_keeps_its_seqs(tmp_path):
+    log = MessageLog(tmp_path / 'history')
+    post(log, 'lobby', 5)
+    post(log, 'a room/with#odd name', 2)
+    log.close()
+    log = MessageLog(tmp_path / 'history')
+    try:
+        assert log.room_names() == ['a room/with#odd name', 'lobby']
+        assert log.append('lobby', {'type': 'message', 'text': 'again'}) == 6
+        records, first, last = log.history('lobby')
+        assert seqs(records) == [1, 2, 3, 4, 5, 6] and (first, last) == (1, 6)
+    finally:
+        log.close()
+
+def test_torn_tail_is_cut_off(tmp_path):
+    log = MessageLog(tmp_path / 'history')
+    post(log, 'lobby', 3)
+    log.close()
+    [seg] = (tmp_path / 'history' / 'lobby').glob('*.log')
+    with open(seg, 'ab') as f:
+        f.write(b'\x00\x00\x01')        # the start of a record the server died writing
+    log = MessageLog(tmp_path / 'history')
+    try:
+        assert seqs(log.history('lobby')[0]) == [1, 2, 3]
+        assert log.append('lobby', {'type': 'message', 'text': 'm4'}) == 4
+    finally:
+        log.close()
+
+def test_pages_across_segments(tmp_path, monkeypatch):
+    monkeypatch.setattr(msglog, 'SEGMENT_BYTES', 2048)
+    monkeypatch.setattr(msglog, 'INDEX_EVERY', 256)
+    log = MessageLog(tmp_path / 'history')
+    try:
+        post(log, 'lobby', 300)
+        log.history('lobby')
+        assert len(list((tmp_path / 'history' / 'lobby').glob('*.log'))) > 1
+        for after in (0, 57, 123, 250):
+            assert seqs(log.history('lobby', after=after, limit=40)[0]) == \
+                list(range(after + 1, min(after + 40, 300) + 1))
+        assert seqs(log.history('lobby', before=200, limit=40)[0]) == list(range(160, 200))
+    finally:
+        log.close()
+
+@pytest.mark.parametrize('room', ['..', '.', '.hidden'])
+def test_dot_rooms_stay_inside_the_root(tmp_path, room):
+    root = tmp_path / 'history'
+    log = MessageLog(root)
+    try:
+        post(log, room, 2)
+        assert seqs(log.history(room)[0]) == [1, 2]
+        assert room in log.room_names()
+    finally:
+        log.close()
+    assert not list(tmp_path.glob('*.log')) and not list(root.glob('*.log'))
+    assert [p.name for p in root.iterdir()] == ['%2E' + room[1:]]
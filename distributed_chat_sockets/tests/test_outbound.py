@@ -0,0 +1,107 @@
+import socket
+
+import pytest
+
+from lanes import Bulk
+from outbound import FrameQueue, OutboundQueue
+from relay import UploadStream
+
+def test_drop_oldest_keeps_the_newest_frames():
+    q = FrameQueue(maxsize=2, policy='drop_oldest')
+    for i in range(5):
+        assert q.push((b'%d' % i,))
+    assert [q.pop(), q.pop(), q.pop()] == [(b'3',), (b'4',), None]
+    assert q.dropped == 3
+
+def test_disconnect_refuses_a_frame_past_the_limit():
+    q = FrameQueue(maxsize=2, policy='disconnect')
+    assert q.push((b'a',)) and q.push((b'b',))
+    assert not q.push((b'c',))
+    assert len(q) == 2 and q.dropped == 0
+
+def test_spill_keeps_every_frame_in_order(tmp_path):
+    stream = UploadStream(tmp_path / 'f', 3)
+    q = FrameQueue(maxsize=2, policy='spill')
+    frames = [(b'h%d' % i, b'payload') for i in range(6)] + [(b'hdr', stream)]
+    for frame in frames:
+        assert q.push(frame)
+    assert len(q) == 7
+    # a frame queued after the spill starts goes behind what was spilled
+    q.pop()
+    q.push((b'last',))
+    got = [q.pop() for _ in range(7)]
+    assert got == frames[1:] + [(b'last',)]
+    assert got[-2][1] is stream and q.pop() is None
+
+def transfer(closed: list) -> Bulk:
+    def frames():
+        try:
+            yield (b'chunk',)
+        finally:
+            closed.append(True)
+    bulk = Bulk(frames())
+    next(bulk.frames)       # started, as its file would be open by now
+    return bulk
+
+def test_dropped_transfers_are_closed():
+    closed = []
+    q = FrameQueue(maxsize=1, policy='drop_oldest')
+    bulks = [transfer(closed), transfer(closed)]    # held here too, so only close() ends them
+    q.push((bulks[0],))
+    q.push((bulks[1],))
+    assert closed == [True]
+    q.close()
+    assert closed == [True, True]
+
+def test_spilled_transfers_are_closed_with_the_queue():
+    closed = []
+    q = FrameQueue(maxsize=1, policy='spill')
+    bulks = [transfer(closed) for _ in range(3)]
+    for bulk in bulks:
+        q.push((bulk,))
+    q.close()
+    assert closed == [True] * 3
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        FrameQueue(policy='shrug')
+
+def test_plain_frames_are_batched():
+    q = FrameQueue()
+    q.push((b'a', b'b'))
+    q.push((b'c',))
+    q.push((b'd', UploadStream.complete('x', 1)))
+    q.push((b'e',))
+    assert q.pop_batch() == (b'a', b'b', b'c')
+    assert q.pop_batch()[0] == b'd'
+    assert q.pop_batch() == (b'e',)
+
+def read_all(sock, n: int) -> bytes:
+    data = b''
+    while len(data) < n:
+        data += sock.recv(n - len(data))
+    return data
+
+def test_writer_sends_frames_in_order_and_stops_when_closed():
+    a, b = socket.socketpair()
+    try:
+        out = OutboundQueue(a)
+        for i in range(100):
+            assert out.put(b'%03d' % i)
+        assert read_all(b, 300) == b''.join(b'%03d' % i for i in range(100))
+        out.close()
+        assert not out.put(b'late')
+    finally:
+        a.close()
+        b.close()
+
+def test_full_queue_with_disconnect_closes_the_client():
+    a, b = socket.socketpair()
+    try:
+        out = OutboundQueue(a, maxsize=1, policy='disconnect')
+        with out.cond:      # hold the writer back
+            out.queue.push((b'x',))
+            assert not out.put(b'y') and out.closed
+    finally:
+        a.close()
+        b.close()
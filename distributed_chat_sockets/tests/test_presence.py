@@ -0,0 +1,39 @@
+from presence import Presence
+
+def frames(presence: Presence, how='flush'):
+    out = []
+    getattr(presence, how)(out.append)
+    return out
+
+def test_changes_go_out_as_one_delta():
+    p = Presence()
+    p.online('ann')
+    p.online('bob')
+    assert frames(p) == [{'type': 'presence', 'online': ['ann', 'bob'], 'offline': []}]
+    assert frames(p) == []
+    p.offline('bob')
+    p.online('cat')
+    assert frames(p) == [{'type': 'presence', 'online': ['cat'], 'offline': ['bob']}]
+
+def test_coming_and_going_between_flushes_is_not_mentioned():
+    p = Presence()
+    p.online('ann')
+    p.offline('ann')
+    assert frames(p) == []
+
+def test_a_name_stays_online_while_anyone_holds_it():
+    p = Presence()
+    p.online('ann')
+    p.online('ann')         # a second connection, or a kept session
+    frames(p)
+    p.offline('ann')
+    assert frames(p) == []
+    p.offline('ann')
+    assert frames(p) == [{'type': 'presence', 'online': [], 'offline': ['ann']}]
+
+def test_snapshot_is_what_was_last_flushed():
+    p = Presence(remote=lambda: ['zed'])
+    p.online('ann')
+    assert frames(p, 'snapshot') == [{'type': 'presence', 'snapshot': True, 'users': []}]
+    frames(p)
+    assert frames(p, 'snapshot') == [{'type': 'presence', 'snapshot': True, 'users': ['ann', 'zed']}]
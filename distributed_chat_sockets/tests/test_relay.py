@@ -0,0 +1,75 @@
+import os
+import socket
+import threading
+
+import pytest
+
+import relay
+from relay import FileSlice, UploadStream, recv_to_file, send_slice, send_stream
+
+@pytest.fixture(params=[True, False], ids=['sendfile', 'copy'])
+def sendfile(request, monkeypatch):
+    if request.param and not hasattr(os, 'sendfile'):
+        pytest.skip('no os.sendfile here')
+    monkeypatch.setattr(relay, 'USE_SENDFILE', request.param)
+
+@pytest.fixture
+def pair():
+    a, b = socket.socketpair()
+    yield a, b
+    a.close()
+    b.close()
+
+def read_all(sock, n: int) -> bytes:
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+def in_thread(fn, *args) -> threading.Thread:
+    t = threading.Thread(target=fn, args=args, daemon=True)
+    t.start()
+    return t
+
+def test_stored_file_goes_out_whole(tmp_path, pair, sendfile):
+    data = os.urandom(300_000)
+    (tmp_path / 'f').write_bytes(data)
+    t = in_thread(send_stream, pair[0], UploadStream.complete(tmp_path / 'f', len(data)))
+    assert read_all(pair[1], len(data)) == data
+    t.join()
+
+def test_upload_is_relayed_while_it_arrives(tmp_path, pair, sendfile):
+    stream = UploadStream(tmp_path / 'f', 2 * relay.CHUNK_SIZE)
+    t = in_thread(send_stream, pair[0], stream)
+    with open(tmp_path / 'f', 'wb', buffering=0) as f:
+        for part in (b'a' * relay.CHUNK_SIZE, b'b' * relay.CHUNK_SIZE):
+            f.write(part)
+            stream.advance(len(part))
+            assert read_all(pair[1], len(part)) == part
+    t.join()
+
+def test_failed_upload_is_padded_to_its_size(tmp_path, pair, sendfile):
+    stream = UploadStream(tmp_path / 'f', 10)
+    (tmp_path / 'f').write_bytes(b'abc')
+    stream.advance(3)
+    stream.fail()
+    t = in_thread(send_stream, pair[0], stream)
+    assert read_all(pair[1], 10) == b'abc' + bytes(7)
+    t.join()
+
+def test_slice_of_a_file(tmp_path, pair, sendfile):
+    (tmp_path / 'f').write_bytes(b'0123456789')
+    with open(tmp_path / 'f', 'rb') as f:
+        send_slice(pair[0], FileSlice(f, 3, 4))
+    assert read_all(pair[1], 4) == b'3456'
+
+def test_cut_off_upload_keeps_what_arrived(tmp_path, pair):
+    pair[1].sendall(b'xyz')
+    pair[1].close()
+    stream = UploadStream(tmp_path / 'f', 10)
+    with open(tmp_path / 'f', 'wb') as f:
+        assert not recv_to_file(pair[0], f, stream)
+    assert stream.written == 3 and (tmp_path / 'f').read_bytes() == b'xyz'
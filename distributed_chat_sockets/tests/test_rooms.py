@@ -0,0 +1,70 @@
+import threading
+
+import pytest
+
+from rooms import DEFAULT_ROOM, Rooms, Users, tag_room, target_room, valid_room
+
+class Member:
+    def __init__(self, *rooms):
+        self.rooms = set(rooms)
+
+def test_join_and_leave():
+    rooms, a, b = Rooms(), Member(), Member()
+    assert rooms.join('dev', a) and rooms.join('dev', b)
+    assert not rooms.join('dev', a)
+    assert set(rooms.members('dev')) == {a, b} and rooms.count('dev') == 2
+    assert rooms.leave('dev', a) and not rooms.leave('dev', a)
+    assert rooms.members('dev') == [b]
+
+def test_room_goes_with_its_last_member():
+    rooms, a = Rooms(), Member()
+    rooms.join('dev', a)
+    old = rooms.rooms['dev']
+    rooms.leave('dev', a)
+    assert 'dev' not in rooms.rooms and old.closed
+    assert rooms.members('dev') == [] and rooms.count('dev') == 0
+    assert not rooms.leave('dev', a)
+    # joining again makes a fresh room rather than reviving the closed one
+    rooms.join('dev', a)
+    assert rooms.rooms['dev'] is not old and rooms.members('dev') == [a]
+
+def test_concurrent_joins_and_leaves_lose_no_member():
+    rooms, stay = Rooms(), Member()
+    rooms.join('dev', stay)
+    def churn():
+        for _ in range(500):
+            m = Member()
+            rooms.join('dev', m)
+            rooms.leave('dev', m)
+    threads = [threading.Thread(target=churn) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert rooms.members('dev') == [stay]
+
+def test_latest_join_of_a_name_wins():
+    users, old, new = Users(), Member(), Member()
+    users.add('ann', old)
+    users.add('ann', new)
+    users.remove('ann', old)        # the old connection going away leaves the new one
+    assert users.get('ann') is new
+    users.remove('ann', new)
+    assert users.get('ann') is None
+
+@pytest.mark.parametrize('name, ok', [('dev', True), ('x' * 64, True), ('', False), ('x' * 65, False),
+                                      ('a\nb', False), (None, False), (7, False), ('.', False),
+                                      ('..', False), ('.x', True)])
+def test_valid_room(name, ok):
+    assert valid_room(name) == ok
+
+def test_lobby_frames_stay_unmarked():
+    assert tag_room({'type': 'message'}, DEFAULT_ROOM) == {'type': 'message'}
+    assert tag_room({'type': 'message'}, None) == {'type': 'message'}
+    assert tag_room({'type': 'message'}, 'dev') == {'type': 'message', 'room': 'dev'}
+
+def test_target_room_needs_membership():
+    client = Member(DEFAULT_ROOM, 'dev')
+    assert target_room(client, {}) == DEFAULT_ROOM
+    assert target_room(client, {'room': 'dev'}) == 'dev'
+    assert target_room(client, {'room': 'ops'}) is None
@@ -0,0 +1,104 @@
+import time
+
+import pytest
+
+import search
+from msglog import MessageLog
+from search import SearchIndex
+
+@pytest.fixture
+def index(tmp_path):
+    log = MessageLog(tmp_path / 'history')
+    idx = SearchIndex(tmp_path / 'search', log)
+    yield idx
+    idx.close()
+    log.close()
+
+def post(idx, room, username, text, ts=None):
+    header = {'type': 'message', 'username': username, 'text': text}
+    idx.msglog.append(room, header)
+    idx.add(room, header, ts)
+    return header['seq']
+
+def found(result):
+    return [(r['room'], r['seq']) for r in result['results']]
+
+def test_every_word_must_match(index):
+    post(index, 'lobby', 'ann', 'deploy failed on staging')
+    post(index, 'lobby', 'bob', 'deploy went fine')
+    post(index, 'lobby', 'ann', 'Failed: DEPLOY')
+    assert found(index.search('deploy failed', {'lobby'})) == [('lobby', 3), ('lobby', 1)]
+    assert index.search('deploy missing', {'lobby'}) == {'results': [], 'total': 0}
+
+def test_ranked_by_relevance_then_recency(index):
+    post(index, 'lobby', 'ann', 'cache cache cache')
+    post(index, 'lobby', 'ann', 'the cache is cold and the disk is slow today')
+    post(index, 'lobby', 'ann', 'cache')
+    post(index, 'lobby', 'ann', 'cache')
+    result = index.search('cache', {'lobby'})
+    # more occurrences first, then shorter messages, then the newer of two equal ones
+    assert found(result) == [('lobby', 1), ('lobby', 4), ('lobby', 3), ('lobby', 2)]
+    scores = [r['score'] for r in result['results']]
+    assert scores == sorted(scores, reverse=True) and scores[1] == scores[2]
+
+def test_rare_words_weigh_more(index):
+    for i in range(20):
+        post(index, 'lobby', 'ann', f'common filler {i}')
+    post(index, 'lobby', 'ann', 'common common common outage')
+    post(index, 'lobby', 'ann', 'outage outage common')
+    assert found(index.search('common outage', {'lobby'})) == [('lobby', 22), ('lobby', 21)]
+
+def test_filters(index):
+    post(index, 'lobby', 'ann', 'release notes', ts=1000)
+    post(index, 'dev', 'bob', 'release branch', ts=2000)
+    post(index, 'secret', 'bob', 'release plan', ts=3000)
+    assert found(index.search('release', {'lobby', 'dev'})) == [('dev', 1), ('lobby', 1)]
+    assert found(index.search('release', {'lobby', 'dev'}, room='lobby')) == [('lobby', 1)]
+    assert found(index.search('release', {'lobby', 'dev', 'secret'}, username='bob')) == [('secret', 1), ('dev', 1)]
+    assert found(index.search('release', {'lobby', 'dev'}, since=1500)) == [('dev', 1)]
+    assert found(index.search('release', {'lobby', 'dev'}, until=1500)) == [('lobby', 1)]
+    assert index.search('release', {'lobby'}, username='nobody')['total'] == 0
+
+def test_limit_and_total(index):
+    for i in range(30):
+        post(index, 'lobby', 'ann', f'ping {i}')
+    result = index.search('ping', {'lobby'}, limit=5)
+    assert result['total'] == 30
+    assert [r['seq'] for r in result['results']] == [30, 29, 28, 27, 26]
+
+def test_across_segments_and_tail(index, monkeypatch):
+    monkeypatch.setattr(search, 'FLUSH_DOCS', 4)
+    for i in range(10):
+        post(index, 'lobby', 'ann', f'word{i % 2} shared')
+        deadline = time.time() + 5
+        while index.flushing is not None and time.time() < deadline:
+            time.sleep(0.01)
+    assert len(index.segments) == 2 and len(index.tail.docs) == 2
+    result = index.search('shared word1', {'lobby'})
+    assert result['total'] == 5
+    assert sorted(r['seq'] for r in result['results']) == [2, 4, 6, 8, 10]
+
+def test_scan_is_bounded_to_the_newest_docs(index, monkeypatch):
+    monkeypatch.setattr(search, 'SCAN_MAX', 10)
+    for i in range(40):
+        post(index, 'lobby', 'ann', f'common {"rare" if i % 4 == 0 else "word"}')
+    result = index.search('common', {'lobby'}, limit=100)
+    assert result['total'] == 10
+    assert min(r['seq'] for r in result['results']) == 31
+    # the rarest word drives the scan, so all of its 10 docs are still found
+    assert index.search('common rare', {'lobby'}, limit=100)['total'] == 10
+
+def test_reopened_index_finds_the_same(tmp_path, index):
+    for i in range(5):
+        post(index, 'lobby', 'ann', f'persisted message {i}')
+    index.close()
+    index.msglog.close()
+    log = MessageLog(tmp_path / 'history')
+    again = SearchIndex(tmp_path / 'search', log)
+    try:
+        result = again.search('persisted', {'lobby'})
+        assert result['total'] == 5
+        assert result['results'][0]['text'] == 'persisted message 4'
+    finally:
+        again.close()
+        log.close()
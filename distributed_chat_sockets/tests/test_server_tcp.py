@@ -0,0 +1,53 @@
+import socket
+import threading
+
+import pytest
+
+from blobstore import BlobStore
+from framing import FrameReader, send_frame
+from hub import Hub
+import server_tcp
+from transfers import Staging
+
+@pytest.fixture
+def link(tmp_path, monkeypatch):
+    """A mux link into the threaded engine, as the web bridge opens it."""
+    monkeypatch.setattr(server_tcp, 'HUB', Hub(BlobStore(tmp_path), Staging(tmp_path / 'staging')))
+    ours, theirs = socket.socketpair()
+    server = threading.Thread(target=server_tcp.handle_client, args=(theirs, ('bridge', 1)), daemon=True)
+    server.start()
+    ours.settimeout(5)
+    send_frame(ours, {'type': 'mux_hello'})
+    yield ours
+    ours.close()
+    server.join(5)      # done with the HUB before it is put back
+
+def replies(sock, vid, typ):
+    reader = FrameReader(sock)
+    while True:
+        header = reader.read_header()
+        assert header is not None
+        if header.get('type') == typ and vid in (header.get('vids') or [header.get('vid')]):
+            return header
+
+def test_bad_frame_ends_only_its_user(link, monkeypatch):
+    for vid, name in ((1, 'ann'), (2, 'bob')):
+        send_frame(link, {'type': 'join', 'vid': vid, 'username': name})
+    handle = server_tcp.HUB.handle
+    def boom(client, header):
+        if header.get('type') == 'boom':
+            raise AttributeError('boom')
+        return handle(client, header)
+    monkeypatch.setattr(server_tcp.HUB, 'handle', boom)
+    send_frame(link, {'type': 'boom', 'vid': 1})
+    send_frame(link, {'type': 'stats', 'vid': 2})
+    stats = replies(link, 2, 'stats')
+    assert [q['username'] for q in stats['queues']] == ['bob']
+
+def test_refused_chunk_ends_the_link(link):
+    send_frame(link, {'type': 'join', 'vid': 1, 'username': 'ann'})
+    # its payload is not read, so nothing after it can be trusted
+    send_frame(link, {'type': 'upload_chunk', 'vid': 1, 'transfer_id': 'f00d' * 8, 'offset': 0, 'size': -5})
+    reader = FrameReader(link)
+    while reader.read_header() is not None:
+        pass
@@ -0,0 +1,82 @@
+import pytest
+
+from msglog import MessageLog
+import sessions
+from sessions import ACKED_MAX, RoomFeed, Session, Sessions
+
+def post(feed, room: str, n: int):
+    for i in range(n):
+        feed.post(room, {'type': 'message', 'text': f'm{i}'})
+
+def seqs(frames):
+    return [h['seq'] for h in frames]
+
+def test_seqs_count_up_per_room():
+    feed, seen = RoomFeed(), []
+    assert feed.post('lobby', {'type': 'message'}, seen.append) == 1
+    assert feed.post('dev', {'type': 'message'}) == 1
+    assert feed.post('lobby', {'type': 'message'}, seen.append) == 2
+    assert seqs(seen) == [1, 2] and feed.last_seq('lobby') == 2
+
+def test_since_returns_what_was_missed():
+    feed = RoomFeed()
+    post(feed, 'lobby', 10)
+    frames, complete = feed.since('lobby', 6)
+    assert seqs(frames) == [7, 8, 9, 10] and complete
+    assert feed.since('lobby', 10) == ([], True)
+
+def test_since_past_the_ring_without_history(monkeypatch):
+    monkeypatch.setattr(sessions, 'RING_SIZE', 4)
+    feed = RoomFeed()
+    post(feed, 'lobby', 10)
+    frames, complete = feed.since('lobby', 2)
+    assert seqs(frames) == [7, 8, 9, 10] and not complete
+    assert feed.older({'lobby': 2}) == {'lobby': None}
+
+def test_since_past_the_ring_reads_the_history(tmp_path, monkeypatch):
+    monkeypatch.setattr(sessions, 'RING_SIZE', 4)
+    log = MessageLog(tmp_path / 'history')
+    try:
+        feed = RoomFeed(log)
+        post(feed, 'lobby', 10)
+        older = feed.older({'lobby': 2})['lobby']
+        assert seqs(older) == [3, 4, 5, 6]
+        frames, complete = feed.since('lobby', older[-1]['seq'])
+        assert seqs(frames) == [7, 8, 9, 10] and complete
+        assert feed.older({'lobby': 8}) == {'lobby': []}
+        # a restarted server numbers on from the log
+        assert RoomFeed(log).last_seq('lobby') == 10
+    finally:
+        log.close()
+
+def test_acked_ids_are_bounded():
+    session = Session('ann')
+    for i in range(ACKED_MAX + 5):
+        session.ack(f'id{i}', i + 1)
+    assert len(session.acked) == ACKED_MAX
+    assert 'id0' not in session.acked and session.acked[f'id{ACKED_MAX + 4}'] == ACKED_MAX + 5
+
+def test_detached_session_resumes_once():
+    store = Sessions()
+    session = store.new('ann')
+    store.detach(session, {'lobby', 'dev'})
+    assert store.is_offline('ann') and session.rooms == ['dev', 'lobby']
+    assert store.hold('ann', {'type': 'message', 'text': 'later'})
+    assert not store.hold('bob', {'type': 'message', 'text': 'later'})
+    assert store.resume('wrong') is None
+    assert store.resume(session.token) is session
+    assert session.expires is None and not store.is_offline('ann')
+    assert list(session.held) == [{'type': 'message', 'text': 'later'}]
+    assert store.resume(session.token) is None
+
+@pytest.mark.parametrize('token', [None, ''])
+def test_resume_without_a_token(token):
+    assert Sessions().resume(token) is None
+
+def test_sessions_expire_after_their_ttl():
+    store = Sessions(ttl=0)
+    session = store.new('ann')
+    store.detach(session, ['lobby'])
+    assert store.expired() == [session]
+    assert store.resume(session.token) is None and not store.is_offline('ann')
+    assert store.expired() == []
@@ -0,0 +1,104 @@
+import hashlib
+import socket
+import threading
+
+import pytest
+
+from blobstore import BlobStore
+from hub import Client, Hub
+from transfers import MAX_CHUNK_SIZE, PROGRESS_STEPS, PartialDownload, Staging
+
+TID = 'f00d' * 8
+
+def sha(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+@pytest.fixture
+def staging(tmp_path):
+    return Staging(tmp_path / 'staging')
+
+@pytest.fixture
+def hub(tmp_path):
+    return Hub(BlobStore(tmp_path), Staging(tmp_path / 'staging'))
+
+def test_chunks_must_continue_the_file(staging):
+    t = staging.begin(TID, 'a.bin', 10)
+    assert t.offset == 0
+    assert staging.write_chunk(t, 0, b'hello', sha(b'hello'))
+    assert not staging.write_chunk(t, 0, b'hello', sha(b'hello'))       # already have it
+    assert not staging.write_chunk(t, 7, b'abc', sha(b'abc'))           # leaves a gap
+    assert not staging.write_chunk(t, 5, b'world', sha(b'other'))       # bad hash
+    assert not staging.write_chunk(t, 5, b'world!', sha(b'world!'))     # past filesize
+    assert t.offset == 5
+
+def test_resume_offset_survives_a_restart(tmp_path, staging):
+    t = staging.begin(TID, 'a.bin', 10)
+    staging.write_chunk(t, 0, b'hello', sha(b'hello'))
+    # bytes written but never logged (the server died mid-chunk) are not trusted
+    with open(t.part_path, 'ab') as f:
+        f.write(b'wor')
+    t = Staging(tmp_path / 'staging').begin(TID, 'a.bin', 10)
+    assert t.offset == 5
+    assert t.part_path.stat().st_size == 5
+
+def test_resume_with_other_size_starts_over(tmp_path, staging):
+    t = staging.begin(TID, 'a.bin', 10)
+    staging.write_chunk(t, 0, b'hello', sha(b'hello'))
+    assert Staging(tmp_path / 'staging').begin(TID, 'a.bin', 12).offset == 0
+
+def test_begin_rejects_bad_transfers(staging):
+    assert staging.begin(TID, 'a.bin', -1) is None
+    assert staging.begin('../' + TID, 'a.bin', 10) is None
+
+def test_partial_download_resumes_from_its_prefix(tmp_path):
+    data = b'0123456789'
+    d = PartialDownload.start(tmp_path, 'a.bin', len(data), sha(data))
+    assert d.append_chunk(0, data[:4])
+    assert not d.append_chunk(6, data[6:])
+    [d] = PartialDownload.pending(tmp_path)
+    assert d.offset == 4
+    assert d.append_chunk(4, data[4:], sha(data[4:]))
+    assert d.finish().read_bytes() == data
+
+@pytest.mark.parametrize('size', [-88, 0, MAX_CHUNK_SIZE + 1, '5', 5.0, None])
+def test_chunk_size_rejects_bad_sizes(hub, size):
+    header = {'type': 'upload_chunk', 'transfer_id': TID, 'offset': 0, 'size': size}
+    assert hub.chunk_size(Client(('test', 1), None), header) is None
+
+@pytest.mark.parametrize('offset', [-1, 11, '0', None])
+def test_chunk_size_rejects_bad_offsets(hub, offset):
+    hub.staging.begin(TID, 'a.bin', 10)
+    header = {'type': 'upload_chunk', 'transfer_id': TID, 'offset': offset, 'size': 5}
+    assert hub.chunk_size(Client(('test', 1), None), header) is None
+
+def test_chunk_size_accepts_a_chunk(hub):
+    hub.staging.begin(TID, 'a.bin', 10)
+    header = {'type': 'upload_chunk', 'transfer_id': TID, 'offset': 10, 'size': MAX_CHUNK_SIZE}
+    # in range: the payload is read, and Staging.write_chunk turns down what does not fit
+    assert hub.chunk_size(Client(('test', 1), None), header) == MAX_CHUNK_SIZE
+
+def test_download_with_the_wrong_hash_is_not_saved(tmp_path):
+    d = PartialDownload.start(tmp_path, 'a.bin', 3, sha(b'abc'))
+    assert d.append_chunk(0, b'abd')
+    assert d.finish() is None
+    assert not (tmp_path / 'a.bin').exists() and PartialDownload.pending(tmp_path) == []
+
+def test_short_download_is_not_saved(tmp_path):
+    d = PartialDownload.start(tmp_path, 'a.bin', 10)
+    d.append_chunk(0, b'abc')
+    assert d.finish() is None and not (tmp_path / 'a.bin').exists()
+
+def test_pushed_payload_is_verified_as_it_arrives(tmp_path):
+    data = bytes(range(256)) * 4000
+    a, b = socket.socketpair()
+    try:
+        threading.Thread(target=a.sendall, args=(data,), daemon=True).start()
+        d = PartialDownload.start(tmp_path, 'a.bin', len(data), sha(data))
+        seen = []
+        d.progress = lambda d: seen.append(d.fraction)
+        assert d.recv_payload(b)
+    finally:
+        a.close()
+        b.close()
+    assert d.finish().read_bytes() == data
+    assert len(seen) <= PROGRESS_STEPS + 1 and seen[-1] == 1.0
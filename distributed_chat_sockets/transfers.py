@@ -0,0 +1,353 @@
+# transfers.py
+# Resumable, chunked file transfers (see protocols.md: upload_* and fetch frames)
+#
+# Uploads: the client opens a transfer with a stable transfer_id and sends
+# upload_chunk frames, each with its offset and SHA-256. The server appends
+# verified chunks to UPLOAD_DIR/staging/<id>.part and logs them in <id>.chunks,
+# so after a reconnect (or a server restart) it can tell the client the last
+# verified offset. Only a complete file moves into the blob store and is shared.
+#
+# Downloads: a client writes incoming file payloads to DOWNLOAD_DIR/.partial/
+# as they arrive. If the connection drops it keeps the prefix and, after
+# reconnecting, asks for the rest with a fetch frame; the server answers with
+# hashed fetch_chunk frames starting at that offset. Bytes are hashed as they
+# are written, so a finished download is verified without reading it back, and
+# it only gets its real name once the hash matches.
+
+import hashlib
+import json
+import os
+import re
+import secrets
+import socket
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+from framing import encode_header, send_frame
+
+CHUNK_SIZE = 256 * 1024              # resumable upload / fetch chunk
+MAX_CHUNK_SIZE = 4 * 1024 * 1024     # larger upload_chunk payloads are rejected
+STAGING_TTL = 7 * 24 * 3600          # unfinished uploads older than this are swept
+RESUMABLE_MIN_SIZE = CHUNK_SIZE     # clients use the chunked path from this size up (smaller is one chunk anyway)
+PROGRESS_STEPS = 100                 # a download reports its progress at most this many times
+PROOF_SIZE = 64 * 1024               # bytes of a file a file_offer's proof of possession covers
+
+TRANSFER_ID_RE = re.compile(r'^[0-9a-f]{16,64}$')
+
+def sha256_file(path: Path, limit: int = None) -> str:
+    h = hashlib.sha256()
+    remaining = limit
+    with open(path, 'rb') as f:
+        while remaining is None or remaining > 0:
+            n = CHUNK_SIZE * 4 if remaining is None else min(CHUNK_SIZE * 4, remaining)
+            data = f.read(n)
+            if not data:
+                break
+            h.update(data)
+            if remaining is not None:
+                remaining -= len(data)
+    return h.hexdigest()
+
+def range_proof(path, challenge: Dict) -> str:
+    """Answer to a file_offer challenge: SHA-256 of its nonce, then of the file's bytes
+    offset .. offset + length. Only someone holding the bytes can compute it."""
+    h = hashlib.sha256(bytes.fromhex(challenge['nonce']))
+    with open(path, 'rb') as f:
+        f.seek(challenge['offset'])
+        h.update(f.read(challenge['length']))
+    return h.hexdigest()
+
+def make_transfer_id(path: str) -> str:
+    """Stable id for uploading this file, so sending it again resumes it."""
+    st = os.stat(path)
+    key = f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+# ---------------------------------------------------------------- server side
+
+def new_challenge(filesize: int) -> Dict:
+    """A random range (and nonce) of a file of filesize bytes for range_proof()."""
+    length = min(PROOF_SIZE, filesize)
+    return {'nonce': secrets.token_hex(16), 'offset': secrets.randbelow(filesize - length + 1), 'length': length}
+
+class Transfer:
+    def __init__(self, transfer_id: str, filename: str, filesize: int, part_path: Path):
+        self.id = transfer_id
+        self.filename = filename
+        self.filesize = filesize
+        self.part_path = part_path
+        self.offset = 0
+        self.lock = threading.Lock()
+
+    @property
+    def complete(self) -> bool:
+        return self.offset >= self.filesize
+
+class Staging:
+    """Unfinished uploads: <id>.json (what), <id>.part (bytes), <id>.chunks (verified log)."""
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.transfers: Dict[str, Transfer] = {}
+        self.sweep()
+
+    def _paths(self, transfer_id: str):
+        base = self.root / transfer_id
+        return base.with_suffix('.json'), base.with_suffix('.part'), base.with_suffix('.chunks')
+
+    def sweep(self, max_age: float = STAGING_TTL):
+        cutoff = time.time() - max_age
+        for p in self.root.glob('*.json'):
+            try:
+                if p.stat().st_mtime < cutoff:
+                    for q in self._paths(p.stem):
+                        q.unlink()
+            except OSError:
+                pass
+
+    def begin(self, transfer_id: str, filename: str, filesize: int) -> Optional[Transfer]:
+        """Open or resume a transfer; its .offset is the last verified byte."""
+        if not TRANSFER_ID_RE.match(transfer_id or '') or filesize < 0:
+            return None
+        with self.lock:
+            t = self.transfers.get(transfer_id)
+            if t and t.filesize == filesize:
+                return t
+            meta_path, part_path, log_path = self._paths(transfer_id)
+            t = Transfer(transfer_id, os.path.basename(filename) or 'file.bin', filesize, part_path)
+            try:
+                meta = json.loads(meta_path.read_text(encoding='utf-8'))
+                if meta.get('filesize') == filesize:
+                    t.offset = self._verified_offset(log_path, part_path)
+            except (OSError, ValueError):
+                pass
+            if t.offset == 0:
+                meta_path.write_text(json.dumps({'filename': t.filename, 'filesize': filesize}), encoding='utf-8')
+                open(part_path, 'wb').close()
+                open(log_path, 'w').close()
+            self.transfers[transfer_id] = t
+            return t
+
+    def _verified_offset(self, log_path: Path, part_path: Path) -> int:
+        # the .chunks log is written after the data, so it is the source of truth:
+        # anything in .part beyond the last logged chunk is cut off
+        offset = 0
+        with open(log_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    start, size, _ = line.split()
+                    if int(start) != offset:
+                        break
+                    offset += int(size)
+                except ValueError:
+                    break
+        with open(part_path, 'r+b') as f:
+            f.truncate(offset)
+        return offset
+
+    def get(self, transfer_id: str) -> Optional[Transfer]:
+        with self.lock:
+            return self.transfers.get(transfer_id)
+
+    def write_chunk(self, t: Transfer, offset: int, data: bytes, sha256: str) -> bool:
+        """Append a chunk if it continues the file and its hash matches."""
+        with t.lock:
+            if offset != t.offset or t.offset + len(data) > t.filesize:
+                return False
+            if hashlib.sha256(data).hexdigest() != sha256:
+                return False
+            with open(t.part_path, 'ab') as f:
+                f.write(data)
+            with open(self._paths(t.id)[2], 'a', encoding='utf-8') as f:
+                f.write(f"{offset} {len(data)} {sha256}\n")
+            t.offset += len(data)
+            return True
+
+    def finish(self, t: Transfer) -> Path:
+        """Forget a completed transfer; the caller moves t.part_path into the store."""
+        with self.lock:
+            self.transfers.pop(t.id, None)
+        meta_path, _, log_path = self._paths(t.id)
+        for p in (meta_path, log_path):
+            try:
+                p.unlink()
+            except OSError:
+                pass
+        return t.part_path
+
+class FetchReply:
+    """Answer to a fetch: fetch_chunk frames read lazily from disk, for the bulk lane."""
+
+    def __init__(self, path: Path, filename: str, offset: int, filesize: int, sha256: str):
+        self.path = path
+        self.filename = filename
+        self.offset = offset
+        self.filesize = filesize
+        self.sha256 = sha256
+
+    def frames(self, compact: bool = False) -> Iterator[tuple]:
+        offset = self.offset
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            while offset < self.filesize:
+                data = f.read(min(CHUNK_SIZE, self.filesize - offset))
+                if not data:
+                    break
+                yield (encode_header({'type': 'fetch_chunk', 'filename': self.filename, 'offset': offset,
+                                      'size': len(data), 'sha256': hashlib.sha256(data).hexdigest()},
+                                     compact), data)
+                offset += len(data)
+        yield (encode_header({'type': 'fetch_done', 'filename': self.filename,
+                              'filesize': self.filesize, 'sha256': self.sha256}, compact),)
+
+# ---------------------------------------------------------------- client side
+
+def send_upload_chunks(sock: socket.socket, path: str, transfer_id: str, offset: int,
+                       filesize: int, progress=None, lock: threading.Lock = None, compact: bool = False):
+    """Send upload_chunk frames for path from offset to the end.
+
+    lock, if given, is held per frame only, so chat frames sent from other
+    threads with the same lock go out between chunks. compact is set once
+    the server has accepted compact headers.
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while offset < filesize:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            send_frame(sock, {'type': 'upload_chunk', 'transfer_id': transfer_id, 'offset': offset,
+                              'size': len(data), 'sha256': hashlib.sha256(data).hexdigest()}, data, lock,
+                       compact)
+            offset += len(data)
+            if progress:
+                progress(offset)
+
+class PartialDownload:
+    """A download kept in DOWNLOAD_DIR/.partial/ until all bytes are in and verified.
+
+    progress, if set, is called with the download as bytes arrive, at most
+    PROGRESS_STEPS times over the whole file (from the receiving thread).
+    """
+
+    def __init__(self, download_dir: Path, filename: str, filesize: int, sha256: str = None):
+        self.download_dir = download_dir
+        self.filename = os.path.basename(filename) or 'file.bin'
+        self.filesize = filesize
+        self.sha256 = sha256
+        partial_dir = download_dir / '.partial'
+        partial_dir.mkdir(parents=True, exist_ok=True)
+        self.part_path = partial_dir / (self.filename + '.part')
+        self.meta_path = partial_dir / (self.filename + '.json')
+        self.offset = self.part_path.stat().st_size if self.part_path.exists() else 0
+        self._hash = None        # sha256 of the first offset bytes; built on first use when resuming
+        self.progress = None
+        self._next_report = 0
+
+    @classmethod
+    def start(cls, download_dir: Path, filename: str, filesize: int, sha256: str = None) -> 'PartialDownload':
+        d = cls(download_dir, filename, filesize, sha256)
+        d.meta_path.write_text(json.dumps({'filename': d.filename, 'filesize': filesize, 'sha256': sha256}),
+                               encoding='utf-8')
+        open(d.part_path, 'wb').close()
+        d.offset = 0
+        d._hash = hashlib.sha256()
+        return d
+
+    @classmethod
+    def pending(cls, download_dir: Path) -> List['PartialDownload']:
+        """Unfinished downloads left by an earlier connection."""
+        found = []
+        for meta_path in sorted((download_dir / '.partial').glob('*.json')):
+            try:
+                meta = json.loads(meta_path.read_text(encoding='utf-8'))
+                found.append(cls(download_dir, meta['filename'], int(meta['filesize']), meta.get('sha256')))
+            except (OSError, ValueError, KeyError):
+                continue
+        return found
+
+    @property
+    def complete(self) -> bool:
+        return self.offset >= self.filesize
+
+    @property
+    def fraction(self) -> float:
+        return self.offset / self.filesize if self.filesize else 1.0
+
+    def _hasher(self):
+        if self._hash is None:
+            # resumed from an earlier connection: hash what is already on disk, once
+            self._hash = hashlib.sha256()
+            with open(self.part_path, 'rb') as f:
+                remaining = self.offset
+                while remaining > 0:
+                    data = f.read(min(CHUNK_SIZE * 4, remaining))
+                    if not data:
+                        break
+                    self._hash.update(data)
+                    remaining -= len(data)
+        return self._hash
+
+    def _wrote(self, data):
+        self._hasher().update(data)
+        self.offset += len(data)
+        if self.progress and (self.offset >= self._next_report or self.complete):
+            self._next_report = self.offset + max(self.filesize // PROGRESS_STEPS, 1)
+            self.progress(self)
+
+    def recv_payload(self, sock: socket.socket) -> bool:
+        """Read the rest of a pushed file payload from sock (or its framing.FrameReader);
+        False if cut short."""
+        buf = bytearray(CHUNK_SIZE)
+        view = memoryview(buf)
+        with open(self.part_path, 'ab') as f:
+            while self.offset < self.filesize:
+                try:
+                    n = sock.recv_into(view[:min(CHUNK_SIZE, self.filesize - self.offset)])
+                except OSError:
+                    n = 0
+                if not n:
+                    return False
+                f.write(view[:n])
+                self._wrote(view[:n])
+        return True
+
+    def append_chunk(self, offset: int, data: bytes, sha256: str = None) -> bool:
+        """Append data if it continues the file (and matches sha256, when given)."""
+        if offset != self.offset or (sha256 is not None and hashlib.sha256(data).hexdigest() != sha256):
+            return False
+        with open(self.part_path, 'ab') as f:
+            f.write(data)
+        self._wrote(data)
+        return True
+
+    def finish(self, avoid_overwrite: bool = True) -> Optional[Path]:
+        """Move the finished file into download_dir; None (and nothing saved) if it is
+        short or its whole-file hash is wrong."""
+        if not self.complete or (self.sha256 and self._hasher().hexdigest() != self.sha256):
+            self.discard()
+            return None
+        save_path = self.download_dir / self.filename
+        if avoid_overwrite:
+            i = 1
+            base, suf = save_path.stem, save_path.suffix
+            while save_path.exists():
+                save_path = self.download_dir / f"{base}_{i}{suf}"
+                i += 1
+        os.replace(self.part_path, save_path)
+        try:
+            self.meta_path.unlink()
+        except OSError:
+            pass
+        return save_path
+
+    def discard(self):
+        for p in (self.part_path, self.meta_path):
+            try:
+                p.unlink()
+            except OSError:
+                pass
@@ -0,0 +1,120 @@
+# blobcache.py
+# Shared file cache of the web bridge
+#
+# Files reach the bridge fetched from the chat server on the first browser
+# request for an announced one (mux users always pull). The bytes are
+# written once per SHA-256 under blobs/, however many
+# names and browsers they are shared with, and a name -> hash index maps the
+# chat server's file names onto them. When the blobs add up to more than
+# max_bytes the least recently served are deleted; the names stay known, so a
+# later request fetches the file from the chat server again. The name index is
+# kept in index.jsonl (append-only, as the chat server's own), so cached files
+# are still served by name after the bridge restarts.
+
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+class BlobCache:
+    def __init__(self, root: Path, max_bytes: int):
+        self.blob_dir = root / 'blobs'
+        self.tmp_dir = self.blob_dir / 'tmp'
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = root / 'index.jsonl'
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.names: Dict[str, Dict] = {}        # name -> {'sha256', 'filesize'}; sha256 may be unknown
+        self.lru: 'OrderedDict[str, int]' = OrderedDict()   # sha256 -> size, least recently used first
+        self.total = 0
+        self._load()
+
+    def _load(self):
+        if self.index_path.exists():
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                        self.names[rec['name']] = {'sha256': rec['sha256'], 'filesize': int(rec['filesize'])}
+                    except (ValueError, KeyError, TypeError):
+                        continue    # torn last line after a crash
+        # blobs from an earlier run, oldest first; partial files are left-overs
+        for p in self.tmp_dir.iterdir():
+            p.unlink()
+        blobs = [p for p in self.blob_dir.iterdir() if p.is_file()]
+        for p in sorted(blobs, key=lambda p: p.stat().st_mtime):
+            size = p.stat().st_size
+            self.lru[p.name] = size
+            self.total += size
+        self._evict()
+
+    def learn(self, name: str, sha256: Optional[str], filesize: int) -> None:
+        """Remember that the chat server has a file by this name (announce, history)."""
+        with self.lock:
+            known = self.names.get(name)
+            if known is None or sha256:
+                self._set(name, sha256 or None, filesize)
+
+    def known(self, name: str) -> Optional[Dict]:
+        with self.lock:
+            return self.names.get(name)
+
+    def lookup(self, name: str) -> Optional[Tuple[Path, str]]:
+        """(blob path, sha256) if the named file is cached; counts as a use."""
+        with self.lock:
+            sha256 = (self.names.get(name) or {}).get('sha256')
+            if sha256 not in self.lru:
+                return None
+            self.lru.move_to_end(sha256)
+            return self.blob_dir / sha256, sha256
+
+    def has(self, sha256: Optional[str]) -> bool:
+        with self.lock:
+            return sha256 in self.lru
+
+    def begin(self):
+        """(temp path, open file) to write an incoming file to before commit()."""
+        fd, tmp = tempfile.mkstemp(dir=self.tmp_dir)
+        return Path(tmp), os.fdopen(fd, 'wb')
+
+    def commit(self, name: str, tmp_path: Path, sha256: str, filesize: int) -> None:
+        """Move a finished temp file into the cache, unless its blob is already there."""
+        with self.lock:
+            self._set(name, sha256, filesize)
+            if sha256 in self.lru:
+                os.remove(tmp_path)
+                self.lru.move_to_end(sha256)
+                return
+            os.replace(tmp_path, self.blob_dir / sha256)
+            self.lru[sha256] = filesize
+            self.total += filesize
+            self._evict()
+
+    def _set(self, name: str, sha256: Optional[str], filesize: int):
+        # under self.lock; only names with a known hash are worth keeping across restarts
+        entry = {'sha256': sha256, 'filesize': filesize}
+        if self.names.get(name) == entry:
+            return
+        self.names[name] = entry
+        if sha256:
+            with open(self.index_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(dict(entry, name=name)) + '\n')
+
+    def discard(self, tmp_path: Path) -> None:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        # the newest blob stays even if it alone is over the limit
+        while self.total > self.max_bytes and len(self.lru) > 1:
+            sha256, size = self.lru.popitem(last=False)
+            self.total -= size
+            try:
+                os.remove(self.blob_dir / sha256)
+            except OSError:
+                pass
@@ -1,84 +1,326 @@
-import os, socket, struct, json, base64, threading, traceback
+# With gevent installed every browser session, websocket, upload and link reader runs
+# in a green thread instead of an OS thread, so one bridge holds thousands of browsers.
+# The standard library has to be patched before anything below imports socket or threading.
+try:
+    from gevent import monkey
+    monkey.patch_all()
+    ASYNC_MODE = 'gevent'
+except ImportError:
+    ASYNC_MODE = 'threading'
+
+import os, sys, socket, hashlib, threading, time, traceback, collections, itertools, queue, secrets
 from pathlib import Path
-from flask import Flask, render_template, request as flask_request, send_from_directory
+from flask import Flask, jsonify, render_template, request as flask_request, send_file
 from flask_socketio import SocketIO
 
+# the frame codec is shared with the chat server and clients one directory up
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from framing import FrameReader, send_frame
+from transfers import CHUNK_SIZE
+from blobcache import BlobCache
+
 # Configuration
 TCP_SERVER_HOST = '127.0.0.1'
 TCP_SERVER_PORT = 9009
 FLASK_HOST = '0.0.0.0'
 FLASK_PORT = 5000
+FETCH_TIMEOUT = 120     # seconds an /uploads request waits for a lazy fetch
+HISTORY_PAGE = 20       # earlier messages shown after joining a room
+FEATURES = ['pull', 'resume', 'presence']     # no 'compact': frames on a mux link carry a vid, so they are JSON anyway
+MUX_LINKS = 4           # connections to the chat server, shared by all browsers
+RECONNECT_MIN = 1.0     # seconds before reconnecting to the chat server after a drop, doubling up to
+RECONNECT_MAX = 30.0
+UPLOAD_ACK_TIMEOUT = 120    # seconds to wait for the chat server to confirm an upload step
+CACHE_MAX_BYTES = 2 * 1024**3  # files kept for browsers; least recently served go first
+CACHE_MAX_AGE = 3600    # seconds browsers may reuse a file before revalidating it
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'replace-me'
-socketio = SocketIO(app, cors_allowed_origins='*', async_mode='threading')
+socketio = SocketIO(app, cors_allowed_origins='*', async_mode=ASYNC_MODE)
 
 BASE_DIR = Path(__file__).parent
 UPLOAD_DIR = BASE_DIR / 'uploads'
 UPLOAD_DIR.mkdir(exist_ok=True)
 
-clients = {}
+# Browsers do not get a chat server connection each. All of them share a few
+# mux links: each browser is a virtual user on one link, and its frames carry
+# the "vid" the bridge gave it. The server sends a room frame once per link
+# with the "vids" to hand it to, and the bridge fans it out to their sessions.
+clients = {}        # Socket.IO sid -> info
+by_vid = {}         # vid -> info
 clients_lock = threading.Lock()
+links = []          # open mux links: {'sock', 'lock', 'users'}
+vid_ids = itertools.count(1)
 
-def send_framed(sock, header, payload=None):
-    header_bytes = json.dumps(header).encode('utf-8')
-    sock.sendall(struct.pack('>I', len(header_bytes)))
-    sock.sendall(header_bytes)
-    if payload:
-        sock.sendall(payload)
+def send(info, header, payload=None):
+    """Send a frame for a browser on its link. Other browsers' frames and uploads share
+    the connection, so each frame is sent whole under the link's lock."""
+    link = info['link']
+    send_frame(link['sock'], dict(header, vid=info['vid']), payload, link['lock'])
 
-def recvall(sock, n):
-    data = bytearray()
-    while len(data) < n:
-        try:
-            packet = sock.recv(n - len(data))
-        except:
-            return None
-        if not packet:
-            return None
-        data.extend(packet)
-    return bytes(data)
-
-def tcp_reader(sid):
+def open_link():
+    sock = socket.create_connection((TCP_SERVER_HOST, TCP_SERVER_PORT))
+    send_frame(sock, {'type': 'mux_hello'})
+    return sock
+
+def pick_link():
+    """The link for a new browser: a new one while there are fewer than MUX_LINKS,
+    then the one with the fewest users. Connecting happens outside clients_lock, which
+    every browser event and server frame needs."""
     with clients_lock:
-        info = clients.get(sid)
-    if not info:
+        if len(links) >= MUX_LINKS:
+            link = min(links, key=lambda l: l['users'])
+            link['users'] += 1
+            return link
+    sock = open_link()
+    with clients_lock:
+        if len(links) < MUX_LINKS:
+            link = {'sock': sock, 'lock': threading.Lock(), 'users': 0}
+            links.append(link)
+            socketio.start_background_task(link_reader, link)
+            sock = None
+        else:
+            # other browsers opened the last links meanwhile
+            link = min(links, key=lambda l: l['users'])
+        link['users'] += 1
+    if sock:
+        sock.close()
+    return link
+
+# every file the bridge serves lives in one cache, once per content hash; files the
+# server only announced are pulled through a live session on first request
+CACHE = BlobCache(UPLOAD_DIR, CACHE_MAX_BYTES)
+fetches = {}        # name -> {'event', 'offset', 'ok', 'part', 'file', 'hash'} while a fetch is running
+fetch_lock = threading.Lock()
+told = {}           # name -> vid of the last browser told of the file; the server only lets its room fetch it
+
+def fetch_file(name):
+    """Pull a known file into the cache; True once it is there."""
+    with fetch_lock:
+        known = CACHE.known(name)
+        if known is None:
+            return False
+        job = fetches.get(name)
+        if job is None:
+            with clients_lock:
+                live = [info for info in clients.values() if info.get('alive')]
+                member = by_vid.get(told.get(name))
+            if member in live:
+                live.insert(0, member)
+            if not live:
+                return False
+            part, f = CACHE.begin()
+            job = {'event': threading.Event(), 'offset': 0, 'ok': False, 'link': live[0]['link'],
+                   'part': part, 'file': f, 'hash': hashlib.sha256(), 'sha256': known['sha256']}
+            fetches[name] = job
+            try:
+                send(live[0], {'type': 'fetch', 'filename': name, 'offset': 0})
+            except OSError:
+                fetches.pop(name, None)
+                f.close()
+                CACHE.discard(part)
+                return False
+    job['event'].wait(FETCH_TIMEOUT)
+    return job['ok']
+
+def on_fetch_chunk(header, data):
+    name = header.get('filename')
+    with fetch_lock:
+        job = fetches.get(name)
+    if not job or job['event'].is_set():
+        return
+    if int(header.get('offset', -1)) != job['offset'] or hashlib.sha256(data).hexdigest() != header.get('sha256'):
+        end_fetch(name, False)
+        return
+    job['file'].write(data)
+    job['hash'].update(data)
+    job['offset'] += len(data)
+
+def on_fetch_done(header):
+    name = header.get('filename')
+    with fetch_lock:
+        job = fetches.get(name)
+    if not job:
+        return
+    sha256 = job['hash'].hexdigest()
+    ok = (not header.get('error') and job['offset'] == int(header.get('filesize', -1))
+          and sha256 == (job['sha256'] or header.get('sha256') or sha256))
+    if ok:
+        job['file'].close()
+        CACHE.commit(name, job['part'], sha256, job['offset'])
+    end_fetch(name, ok)
+
+def end_fetch(name, ok):
+    with fetch_lock:
+        job = fetches.pop(name, None)
+    if not job:
         return
-    sock = info['sock']
-    print(f"[bridge] tcp_reader started for {sid}")
+    if not ok:
+        job['file'].close()
+        CACHE.discard(job['part'])
+    job['ok'] = ok
+    job['event'].set()
+
+def join_header(info):
+    header = {'type': 'join', 'username': info['username'], 'features': FEATURES}
+    if info['token']:
+        header['resume'] = info['token']
+        header['seqs'] = dict(info['last_seq'])
+    return header
+
+def first_time(info, header):
+    """False for a room frame this browser was sent already (replayed on resume)."""
+    seq = header.get('seq')
+    if seq is None:
+        return True
+    room = header.get('room') or 'lobby'
+    if seq <= info['last_seq'].get(room, 0):
+        return False
+    info['last_seq'][room] = seq
+    return True
+
+def on_session(sid, info, header):
+    if header.get('resumed') or header.get('token') == info['token']:
+        return
+    had_session = info['token'] is not None
+    info['token'] = header.get('token')
+    rooms = [r for r in info['last_seq'] if r != 'lobby']
+    info['last_seq'] = dict(header.get('seqs') or {})
+    if had_session:
+        # the old session expired on the server; join the rooms again
+        socketio.emit('system', {'text': 'Reconnected (some messages may be missing; see /history)'}, room=sid)
+        for room in rooms:
+            send(info, {'type': 'join_room', 'room': room})
+
+def link_users(link):
+    with clients_lock:
+        return [info for info in clients.values() if info['link'] is link]
+
+def reconnect(link):
+    """Connect the link again with backoff while it has users; True once it is back and
+    their sessions were asked to resume."""
+    users = [info for info in link_users(link) if info['token']]
+    for info in link_users(link):
+        if not info['token']:
+            # nothing to resume: this browser has to join again
+            drop_browser(info['sid'], 'Disconnected from TCP server')
+    for info in users:
+        socketio.emit('system', {'text': 'Connection to chat server lost; reconnecting...'}, room=info['sid'])
+    delay = RECONNECT_MIN
+    while link_users(link):
+        time.sleep(delay)
+        try:
+            sock = open_link()
+        except OSError:
+            delay = min(delay * 2, RECONNECT_MAX)
+            continue
+        link['sock'] = sock
+        for info in link_users(link):
+            try:
+                send(info, join_header(info))
+                for header in list(info['unacked'].values()):
+                    send(info, header)
+            except OSError:
+                break
+        return True
+    return False
+
+def drop_browser(sid, text):
+    with clients_lock:
+        info = clients.pop(sid, None)
+        if info:
+            by_vid.pop(info['vid'], None)
+            info['link']['users'] -= 1
+    socketio.emit('system', {'text': text}, room=sid)
+    socketio.disconnect(sid)
+
+def link_reader(link):
+    print("[bridge] mux link opened")
+    while True:
+        sock = link['sock']
+        read_frames(link, sock)
+        sock.close()
+        # a fetch riding on this connection will not finish; let the HTTP side give up
+        with fetch_lock:
+            stuck = [n for n, job in fetches.items() if job.get('link') is link]
+        for name in stuck:
+            end_fetch(name, False)
+        # as do uploads: fail them rather than leave their HTTP requests waiting
+        for info in link_users(link):
+            for replies in list(info['uploads'].values()):
+                replies.put(None)
+        if not reconnect(link):
+            break
+    print("[bridge] mux link closed")
+    with clients_lock:
+        if link in links:
+            links.remove(link)
+
+def read_frames(link, sock):
+    reader = FrameReader(sock)
     try:
-        while info.get('alive'):
-            raw = recvall(sock, 4)
-            if not raw: break
-            hdr_len = struct.unpack('>I', raw)[0]
-            header = json.loads(recvall(sock, hdr_len).decode())
+        while True:
+            header = reader.read_header()
+            if header is None: break
             typ = header.get('type')
-            if typ == 'file':
-                fname = header.get('filename', 'file.bin')
-                fsize = int(header.get('filesize', 0))
-                data = recvall(sock, fsize)
-                if not data: continue
-                save_path = UPLOAD_DIR / fname
-                with open(save_path, 'wb') as f: f.write(data)
-                url = f"/uploads/{fname}"
-                socketio.emit('file', {
-                    'username': header.get('username', 'Server'),
-                    'filename': fname,
-                    'filesize': fsize,
-                    'url': url
-                }, room=sid)
-                print(f"[bridge] File saved: {save_path}")
-            else:
-                socketio.emit('message', header, room=sid)
-    except Exception as e:
+            # a room frame comes once for all its recipients here, anything else for one
+            vids = header.pop('vids', None) or [header.pop('vid', None)]
+            if typ == 'fetch_chunk':
+                data = reader.read_exact(int(header.get('size', 0)))
+                if data is None: break
+                on_fetch_chunk(header, data)
+                continue
+            elif typ == 'fetch_done':
+                on_fetch_done(header)
+                continue
+            with clients_lock:
+                targets = [by_vid[v] for v in vids if v in by_vid]
+            for info in targets:
+                on_frame(info['sid'], info, header)
+    except Exception:
         traceback.print_exc()
-    finally:
-        print(f"[bridge] tcp_reader ended for {sid}")
-        sock.close()
-        with clients_lock:
-            clients.pop(sid, None)
-        socketio.emit('system', {'text': 'Disconnected from TCP server'}, room=sid)
-        socketio.disconnect(sid)
+
+def on_frame(sid, info, header):
+    """A frame from the chat server for one browser."""
+    typ = header.get('type')
+    if not first_time(info, header):
+        return
+    if 'last_seq' in header and typ == 'system':
+        # "Joined #room": the room's frames continue from here
+        info['last_seq'][header.get('room') or 'lobby'] = header['last_seq']
+    if typ == 'session':
+        on_session(sid, info, header)
+    elif typ == 'ack':
+        info['unacked'].pop(header.get('id'), None)
+    elif typ in ('upload_status', 'upload_done'):
+        replies = info['uploads'].get(header.get('transfer_id'))
+        if replies:
+            replies.put(header)
+    elif typ == 'file_announce':
+        # nothing is downloaded until a browser asks for /uploads/<name>
+        fname = os.path.basename(header.get('filename', '')) or 'file.bin'
+        CACHE.learn(fname, header.get('sha256'), int(header.get('filesize', 0)))
+        told[fname] = info['vid']
+        socketio.emit('file', {
+            'username': header.get('username', 'Server'),
+            'filename': fname,
+            'filesize': int(header.get('filesize', 0)),
+            'url': f"/uploads/{fname}"
+        }, room=sid)
+    elif typ == 'history':
+        # files in the history can be pulled like freshly announced ones
+        for rec in header.get('messages', []):
+            fname = os.path.basename(rec.get('filename', ''))
+            if rec.get('type') == 'file_announce' and fname:
+                CACHE.learn(fname, rec.get('sha256'), int(rec.get('filesize', 0)))
+                told[fname] = info['vid']
+        socketio.emit('history', header, room=sid)
+    elif typ == 'search':
+        socketio.emit('search', header, room=sid)
+    elif typ == 'presence':
+        socketio.emit('presence', header, room=sid)
+    else:
+        socketio.emit('message', header, room=sid)
 
 @app.route('/')
 def index():
@@ -86,7 +328,85 @@ def index():
 
 @app.route('/uploads/<path:filename>')
 def serve_upload(filename):
-    return send_from_directory(UPLOAD_DIR, filename, as_attachment=False)
+    # the blob's hash is its ETag; send_file answers If-None-Match / If-Modified-Since
+    # with 304 and Range requests (video seeking) with 206
+    name = os.path.basename(filename)
+    if name != filename:
+        return 'File not available', 404
+    blob = CACHE.lookup(name)
+    legacy = UPLOAD_DIR / name
+    if not blob and name != CACHE.index_path.name and legacy.is_file():
+        # saved by a bridge from before the cache, straight under uploads/
+        return send_file(legacy, download_name=name, conditional=True, max_age=CACHE_MAX_AGE)
+    blob = blob or (fetch_file(name) and CACHE.lookup(name))
+    if not blob:
+        return 'File not available', 404
+    path, sha256 = blob
+    return send_file(path, download_name=name, conditional=True, etag=sha256, max_age=CACHE_MAX_AGE)
+
+@app.route('/upload', methods=['POST'])
+def upload():
+    """Stream a browser's file (the raw request body) to the chat server as upload_chunk
+    frames. Chunks are only read from the request as fast as the chat server takes them,
+    and the reply comes once the server has stored the file with the hash we computed."""
+    with clients_lock:
+        info = clients.get(flask_request.args.get('sid', ''))
+    if not info:
+        return jsonify(error='not connected'), 403
+    size = flask_request.content_length
+    if size is None:
+        return jsonify(error='Content-Length required'), 411
+    filename = os.path.basename(flask_request.args.get('filename', '')) or 'file.bin'
+    tid = secrets.token_hex(16)
+    replies = info['uploads'][tid] = queue.Queue()
+    try:
+        header = {'type': 'upload_begin', 'transfer_id': tid, 'filename': filename, 'filesize': size}
+        if flask_request.args.get('room'):
+            header['room'] = flask_request.args['room']
+        send(info, header)
+        status = replies.get(timeout=UPLOAD_ACK_TIMEOUT)
+        if status is None or status.get('error'):
+            return jsonify(error=status.get('error') if status else 'chat server connection lost'), 502
+        h = hashlib.sha256()
+        offset = 0
+        while offset < size:
+            data = flask_request.stream.read(min(CHUNK_SIZE, size - offset))
+            if not data:
+                break
+            h.update(data)
+            send(info, {'type': 'upload_chunk', 'transfer_id': tid, 'offset': offset, 'size': len(data),
+                        'sha256': hashlib.sha256(data).hexdigest()}, data)
+            offset += len(data)
+            if not replies.empty():
+                # only a rejected chunk or a lost connection gets an answer before the end
+                reply = replies.get()
+                return jsonify(error=reply.get('error') if reply else 'chat server connection lost'), 502
+        if offset < size:
+            return jsonify(error=f'upload cut short at {offset}/{size} bytes'), 400
+        done = replies.get(timeout=UPLOAD_ACK_TIMEOUT)
+        if done is None or done.get('type') != 'upload_done':
+            return jsonify(error=done.get('error') if done else 'chat server connection lost'), 502
+        if done.get('sha256') != h.hexdigest():
+            return jsonify(error='chat server stored different content'), 502
+        print(f"[bridge] Uploaded {done.get('filename')} ({size} bytes) for {info['username']}")
+        return jsonify(filename=done.get('filename'), filesize=size, sha256=done.get('sha256'))
+    except queue.Empty:
+        return jsonify(error='chat server did not confirm the upload'), 504
+    except OSError as e:
+        return jsonify(error=f'chat server connection: {e}'), 502
+    finally:
+        info['uploads'].pop(tid, None)
+
+def well_formed(sid, data, strs=(), ints=()):
+    """Does a browser's event have the types the chat server expects in these fields
+    (when present)? Tells the browser if not; nothing of it is forwarded then."""
+    bad = not isinstance(data, dict)
+    if not bad:
+        bad = any(data.get(k) is not None and not isinstance(data[k], str) for k in strs) or \
+            any(data.get(k) is not None and type(data[k]) is not int for k in ints)
+    if bad:
+        socketio.emit('system', {'text': 'Malformed request'}, room=sid)
+    return not bad
 
 @socketio.on('connect')
 def on_connect():
@@ -97,14 +417,19 @@ def on_connect():
 @socketio.on('join')
 def handle_join(data):
     sid = flask_request.sid
-    username = data.get('username', 'WebUser')
+    if not well_formed(sid, data, strs=('username',)):
+        return
+    username = data.get('username') or 'WebUser'
+    leave(sid)      # joining again replaces the earlier user
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((TCP_SERVER_HOST, TCP_SERVER_PORT))
-        send_framed(sock, {'type': 'join', 'username': username})
+        info = {'sid': sid, 'vid': next(vid_ids), 'link': pick_link(), 'alive': True,
+                'username': username, 'token': None, 'last_seq': {},
+                'unacked': collections.OrderedDict(), 'ids': itertools.count(1), 'uploads': {}}
         with clients_lock:
-            clients[sid] = {'sock': sock, 'alive': True}
-        socketio.start_background_task(tcp_reader, sid)
+            clients[sid] = info
+            by_vid[info['vid']] = info
+        send(info, join_header(info))
+        send(info, {'type': 'history', 'limit': HISTORY_PAGE})
         socketio.emit('system', {'text': f'Joined as {username}'}, room=sid)
         print(f"[bridge] {sid} joined as {username}")
     except Exception as e:
@@ -113,61 +438,98 @@ def handle_join(data):
 @socketio.on('message')
 def handle_message(data):
     sid = flask_request.sid
-    text = data.get('text', '')
+    if not well_formed(sid, data, strs=('text', 'room', 'to')):
+        return
+    text = data.get('text') or ''
     with clients_lock:
         info = clients.get(sid)
     if not info:
         socketio.emit('system', {'text': 'Not connected'}, room=sid)
         return
+    header = {'type': 'message', 'text': text, 'username': data.get('username')}
+    # optional: a room the user joined, or a direct message recipient
+    for key in ('room', 'to'):
+        if data.get(key):
+            header[key] = data[key]
+    if info['token']:
+        # kept until the server acknowledges it, and sent again after a reconnect
+        header['id'] = next(info['ids'])
+        info['unacked'][header['id']] = header
     try:
-        send_framed(info['sock'], {'type': 'message', 'text': text, 'username': data.get('username')})
+        send(info, header)
     except Exception as e:
         socketio.emit('system', {'text': f'Error sending message: {e}'}, room=sid)
 
-@socketio.on('file-start')
-def handle_file_start(data):
-    sid = flask_request.sid
-    filename = data.get('filename')
-    filesize = int(data.get('filesize', 0))
-    username = data.get('username', 'WebUser')
+@socketio.on('join_room')
+def handle_join_room(data):
+    if well_formed(flask_request.sid, data, strs=('room',)):
+        forward_room(flask_request.sid, 'join_room', data)
+
+@socketio.on('leave_room')
+def handle_leave_room(data):
+    if not well_formed(flask_request.sid, data, strs=('room',)):
+        return
     with clients_lock:
-        info = clients.get(sid)
-    if not info: return
-    send_framed(info['sock'], {'type': 'file', 'filename': filename, 'filesize': filesize, 'username': username})
-    info['file'] = {'remaining': filesize}
-    socketio.emit('system', {'text': f"Uploading {filename}..."}, room=sid)
+        info = clients.get(flask_request.sid)
+    if info:
+        info['last_seq'].pop(data.get('room', ''), None)
+    forward_room(flask_request.sid, 'leave_room', data)
 
-@socketio.on('file-chunk')
-def handle_file_chunk(data):
-    sid = flask_request.sid
-    chunk = base64.b64decode(data.get('chunk_b64'))
+@socketio.on('history')
+def handle_history(data):
+    if not well_formed(flask_request.sid, data, strs=('room',), ints=('before',)):
+        return
+    header = {'type': 'history', 'limit': HISTORY_PAGE}
+    # room (absent: the lobby) and the seq to page back from (absent: the newest)
+    for key in ('room', 'before'):
+        if data.get(key):
+            header[key] = data[key]
+    forward(flask_request.sid, header)
+
+@socketio.on('search')
+def handle_search(data):
+    if not well_formed(flask_request.sid, data, strs=('q', 'room', 'username')):
+        return
+    header = {'type': 'search', 'q': data.get('q') or '', 'limit': HISTORY_PAGE}
+    for key in ('room', 'username', 'since', 'until'):
+        if data.get(key):
+            header[key] = data[key]
+    forward(flask_request.sid, header)
+
+def forward_room(sid, typ, data):
+    forward(sid, {'type': typ, 'room': data.get('room', '')})
+
+def forward(sid, header):
     with clients_lock:
         info = clients.get(sid)
-    if not info: return
+    if not info:
+        socketio.emit('system', {'text': 'Not connected'}, room=sid)
+        return
     try:
-        info['sock'].sendall(chunk)
-    except:
-        pass
-
-@socketio.on('file-end')
-def handle_file_end(data=None):
-    sid = flask_request.sid
-    socketio.emit('system', {'text': 'File upload complete!'}, room=sid)
-    print(f"[bridge] file-end from {sid}")
+        send(info, header)
+    except Exception as e:
+        socketio.emit('system', {'text': f'Error: {e}'}, room=sid)
 
 @socketio.on('disconnect')
 def handle_disconnect():
     sid = flask_request.sid
     print(f"[bridge] Disconnect {sid}")
+    leave(sid)
+
+def leave(sid):
+    """The browser is gone: end its user on the chat server (the link stays open)."""
     with clients_lock:
         info = clients.pop(sid, None)
+        if info:
+            by_vid.pop(info['vid'], None)
+            info['link']['users'] -= 1
     if info:
         info['alive'] = False
         try:
-            info['sock'].close()
-        except:
+            send(info, {'type': 'quit'})
+        except OSError:
             pass
 
 if __name__ == '__main__':
-    print(f"Running Web Bridge on http://{FLASK_HOST}:{FLASK_PORT}")
+    print(f"Running Web Bridge on http://{FLASK_HOST}:{FLASK_PORT} ({ASYNC_MODE})")
     socketio.run(app, host=FLASK_HOST, port=FLASK_PORT)
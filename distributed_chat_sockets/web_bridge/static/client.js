@@ -55,24 +55,59 @@ const fileNameLabel = document.getElementById('fileName');
 const sendFileBtn = document.getElementById('sendFile');
 const uploadProgress = document.getElementById('uploadProgress');
 const autoDownload = document.getElementById('autoDownload');
+const usersEl = document.getElementById('users');
 
 let myName = null;
+// files are pulled from the chat server the first time their URL is loaded,
+// so only preview inline what is cheap to fetch
+const INLINE_PREVIEW_MAX = 2*1024*1024;
 
 function escapeHtml(s){ return String(s).replace(/[&<>"]/g, c=>({'&':'&amp;','<':'&lt;','>':'&gt;','"':'&quot;'}[c])); }
 
-function appendMessage({ username, text, me=false, file=false, html=null }){
+function appendMessage({ username, text, me=false, file=false, html=null, when=null }){
   const li = document.createElement('li');
   li.className = 'msg' + (me ? ' me' : '') + (file ? ' file' : '');
-  let meta = `<div class="meta">${escapeHtml(username || 'System')} • ${new Date().toLocaleTimeString()}</div>`;
+  let meta = `<div class="meta">${escapeHtml(username || 'System')} • ${(when || new Date()).toLocaleTimeString()}</div>`;
   let body = html ? html : `<div class="text">${escapeHtml(text||'')}</div>`;
   li.innerHTML = meta + body;
   messagesEl.appendChild(li);
   messagesEl.scrollTop = messagesEl.scrollHeight;
 }
 
+// who is online: the server sends the whole roster once, then only who came and went;
+// onlineUsers mirrors the list items, both sorted
+let onlineUsers = [];
+function userIndex(name){
+  let lo = 0, hi = onlineUsers.length;
+  while(lo < hi){ const mid = (lo + hi) >> 1; if(onlineUsers[mid] < name) lo = mid + 1; else hi = mid; }
+  return lo;
+}
+socket.on('presence', d => {
+  if(d.snapshot){
+    onlineUsers = (d.users || []).slice().sort();
+    usersEl.innerHTML = onlineUsers.map(u => `<li>${escapeHtml(u)}</li>`).join('');
+    return;
+  }
+  (d.offline || []).forEach(u => {
+    const i = userIndex(u);
+    if(onlineUsers[i] === u){ onlineUsers.splice(i, 1); usersEl.children[i].remove(); }
+  });
+  (d.online || []).forEach(u => {
+    const i = userIndex(u);
+    if(onlineUsers[i] === u) return;
+    const li = document.createElement('li');
+    li.textContent = u;
+    usersEl.insertBefore(li, usersEl.children[i] || null);
+    onlineUsers.splice(i, 0, u);
+  });
+});
+
 // socket handlers
 socket.on('system', d => appendMessage({ username:'System', text:d.text }));
-socket.on('message', d => appendMessage({ username:d.username||'User', text:d.text }));
+socket.on('message', d => {
+  const where = d.to ? ' (direct)' : (d.room ? ` #${d.room}` : '');
+  appendMessage({ username:(d.username||'User') + where, text:d.text });
+});
 socket.on('file', d => {
   const user = d.username || 'User';
   const filename = d.filename || 'file';
@@ -80,12 +115,12 @@ socket.on('file', d => {
 
   const ext = filename.split('.').pop().toLowerCase();
   if(url && ['png','jpg','jpeg','gif','webp','bmp','svg'].includes(ext)){
-    const html = `<div class="file-preview"><img src="${url}" alt="${escapeHtml(filename)}"/></div>`;
+    const html = `<div class="file-preview"><img src="${url}" loading="lazy" alt="${escapeHtml(filename)}"/></div>`;
     appendMessage({ username:user, html:html, file:true });
   } else if(url && ['mp4','webm','ogg','m4v','mov'].includes(ext)){
-    const html = `<div class="file-preview"><video controls src="${url}" style="max-width:100%;border-radius:8px;"></video></div>`;
+    const html = `<div class="file-preview"><video controls preload="none" src="${url}" style="max-width:100%;border-radius:8px;"></video></div>`;
     appendMessage({ username:user, html:html, file:true });
-  } else if(url && ext === 'pdf'){
+  } else if(url && ext === 'pdf' && (d.filesize||0) <= INLINE_PREVIEW_MAX){
     const html = `<div class="file-preview"><iframe src="${url}" style="width:100%;height:360px;border:0;border-radius:8px;"></iframe></div>`;
     appendMessage({ username:user, html:html, file:true });
   } else {
@@ -98,6 +133,36 @@ socket.on('file', d => {
   }
 });
 
+// a page of a room's history (oldest first); /history asks for the page before it
+const oldestSeq = {};   // room -> oldest seq shown, 0 when there is nothing older
+socket.on('history', d => {
+  const room = d.room || 'lobby';
+  const msgs = d.messages || [];
+  const first = msgs.length ? msgs[0].seq : 0;
+  oldestSeq[room] = first > (d.first_seq || 0) ? first : 0;
+  if(!msgs.length){ appendMessage({ username:'System', text:`No earlier messages in #${room}` }); return; }
+  appendMessage({ username:'System', text:`Earlier in #${room}:` });
+  msgs.forEach(m => {
+    const when = m.ts ? new Date(m.ts * 1000) : null;
+    if(m.type === 'message'){
+      appendMessage({ username:(m.username||'User') + (m.room ? ` #${m.room}` : ''), text:m.text, when });
+    } else if(m.type === 'file_announce'){
+      const url = `/uploads/${encodeURIComponent(m.filename)}`;
+      const link = `<a href="${url}" target="_blank" rel="noopener">${escapeHtml(m.filename)}</a>`;
+      appendMessage({ username:m.username||'User', html:`<div class="text">📎 ${link} (${m.filesize||0} bytes)</div>`, file:true, when });
+    } else {
+      appendMessage({ username:'System', text:m.text, when });
+    }
+  });
+});
+
+socket.on('search', d => {
+  const results = d.results || [];
+  appendMessage({ username:'System', text:`${d.total || 0} found for "${d.q}" (${d.ms} ms)` });
+  results.forEach(r => appendMessage({ username:`${r.username || 'User'} #${r.room}`, text:r.text || '',
+                                       when: r.ts ? new Date(r.ts * 1000) : null }));
+});
+
 socket.on('connect', () => statusEl.textContent = 'Connected');
 socket.on('disconnect', () => statusEl.textContent = 'Disconnected');
 
@@ -107,11 +172,41 @@ connectBtn.addEventListener('click', ()=>{
   statusEl.textContent = 'Connected (joined)';
 });
 
+// /join ROOM, /leave ROOM, /room ROOM (send there), /msg USER TEXT, /history, /search [@USER] WORDS
+let currentRoom = null;   // null = the lobby
+function runCommand(text){
+  const [cmd, ...rest] = text.split(' ');
+  const arg = rest.join(' ').trim();
+  if(cmd === '/join' && arg){ socket.emit('join_room', { room: arg }); currentRoom = arg; socket.emit('history', { room: arg }); }
+  else if(cmd === '/leave' && arg){ socket.emit('leave_room', { room: arg }); if(arg === currentRoom) currentRoom = null; }
+  else if(cmd === '/room'){ currentRoom = arg || null; appendMessage({ username:'System', text:`Sending to #${currentRoom || 'lobby'}` }); }
+  else if(cmd === '/msg' && arg.includes(' ')){
+    const to = arg.slice(0, arg.indexOf(' ')), msg = arg.slice(arg.indexOf(' ') + 1);
+    socket.emit('message', { text: msg, to, username: myName });
+    appendMessage({ username: `You → ${to}`, text: msg, me:true });
+  }
+  else if(cmd === '/history'){
+    const room = currentRoom || 'lobby';
+    if(oldestSeq[room] === 0) appendMessage({ username:'System', text:`No earlier messages in #${room}` });
+    else socket.emit('history', { room: currentRoom, before: oldestSeq[room] });
+  }
+  else if(cmd === '/search' && arg){
+    const words = arg.split(/\s+/);
+    const username = words[0].startsWith('@') ? words.shift().slice(1) : null;
+    socket.emit('search', { q: words.join(' '), username });
+  }
+  else appendMessage({ username:'System', text:'Commands: /join ROOM, /leave ROOM, /room ROOM, /msg USER TEXT, /history, /search [@USER] WORDS' });
+}
+
 sendBtn.addEventListener('click', ()=>{
   const text = msgInput.value.trim();
   if(!text) return;
-  socket.emit('message', { text, username: myName });
-  appendMessage({ username: 'You', text, me:true });
+  if(text.startsWith('/')){
+    runCommand(text);
+  } else {
+    socket.emit('message', { text, username: myName, room: currentRoom });
+    appendMessage({ username: currentRoom ? `You #${currentRoom}` : 'You', text, me:true });
+  }
   msgInput.value = '';
 });
 
@@ -128,35 +223,39 @@ fileInput.addEventListener('change', ()=>{
   sendFileBtn.disabled = false;
 });
 
-// chunked upload
-sendFileBtn.addEventListener('click', async ()=>{
+// upload: the file goes to the bridge as the raw body of one streamed POST
+// (no base64); the bridge answers once the chat server has stored it
+sendFileBtn.addEventListener('click', ()=>{
   const f = fileInput.files[0];
   if(!f) return alert('Choose a file');
-  if(!myName) myName = usernameInput.value.trim() || ('Web' + Math.floor(Math.random()*1000));
-  socket.emit('file-start', { filename: f.name, filesize: f.size, username: myName });
+  if(!myName) return alert('Connect first');
+  const params = new URLSearchParams({ sid: socket.id, filename: f.name });
+  if(currentRoom) params.set('room', currentRoom);
+  const xhr = new XMLHttpRequest();
+  xhr.open('POST', '/upload?' + params.toString());
+  xhr.setRequestHeader('Content-Type', 'application/octet-stream');
   uploadProgress.style.display = 'block';
   uploadProgress.max = f.size;
   uploadProgress.value = 0;
-
-  const CHUNK = 64*1024;
-  let offset = 0;
-  while(offset < f.size){
-    const chunk = f.slice(offset, offset + CHUNK);
-    const buf = await chunk.arrayBuffer();
-    let binary = '';
-    const arr = new Uint8Array(buf);
-    for(let i=0;i<arr.length;i++) binary += String.fromCharCode(arr[i]);
-    const b64 = btoa(binary);
-    socket.emit('file-chunk', { chunk_b64: b64 });
-    offset += CHUNK;
-    uploadProgress.value = Math.min(offset, f.size);
-  }
-  socket.emit('file-end', {});
-  uploadProgress.style.display = 'none';
-  appendMessage({ username:'You', text:`Sent file ${f.name}`, me:true });
-  fileInput.value = '';
-  fileNameLabel.textContent = 'No file chosen';
+  // paced by the bridge, which only reads as fast as the chat server takes the bytes
+  xhr.upload.onprogress = e => { if(e.lengthComputable) uploadProgress.value = e.loaded; };
+  xhr.onload = () => {
+    let reply = {};
+    try { reply = JSON.parse(xhr.responseText); } catch(e) {}
+    if(xhr.status === 200){
+      appendMessage({ username:'You', text:`Sent file ${reply.filename || f.name}`, me:true });
+    } else {
+      appendMessage({ username:'System', text:`Upload of ${f.name} failed: ${reply.error || xhr.status}` });
+    }
+  };
+  xhr.onerror = () => appendMessage({ username:'System', text:`Upload of ${f.name} failed: network error` });
+  xhr.onloadend = () => {
+    uploadProgress.style.display = 'none';
+    fileInput.value = '';
+    fileNameLabel.textContent = 'No file chosen';
+  };
   sendFileBtn.disabled = true;
+  xhr.send(f);
 });
 
 // enter to send
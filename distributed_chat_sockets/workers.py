@@ -0,0 +1,90 @@
+# workers.py
+# Pre-fork mode: several server processes sharing one port
+# Usage: python3 server_tcp.py --workers 4 [--engine asyncio]
+#
+# A single server process does its JSON work and fan-out loops on one core
+# (the GIL). With --workers N the parent forks N workers that each bind the
+# chat port with SO_REUSEPORT, and the kernel spreads new connections over
+# them. Each worker is a cluster node (cluster.py) on a Unix-socket bus:
+# every worker has a direct link to every other one, so an event is sent
+# once per worker and never forwarded. All workers share the upload
+# directory, so files never have to be pulled between them. Sessions are
+# not shared: a reconnect may reach another worker, so workers offer no
+# session resume.
+# Needs fork() and SO_REUSEPORT (Linux, BSD, macOS).
+
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import traceback
+from typing import Callable
+
+from cluster import Cluster, PeerBroker
+
+def bus_path(bus_dir: str, index: int) -> str:
+    return os.path.join(bus_dir, f'worker-{index}.sock')
+
+class WorkerBus(PeerBroker):
+    """Links from one worker to all the others."""
+
+    forwards = False
+
+    def __init__(self, bus_dir: str, index: int, count: int):
+        super().__init__([bus_path(bus_dir, i) for i in range(count) if i != index])
+
+def worker_cluster(bus_dir: str, index: int, count: int, advertise: str, store, deliver: Callable) -> Cluster:
+    return Cluster(f'worker-{index}', advertise, WorkerBus(bus_dir, index, count), store, deliver,
+                   shared_store=True)
+
+def listen_socket(host: str, port: int, reuse_port: bool = False, backlog: int = 100) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+def bus_socket(bus_dir: str, index: int) -> socket.socket:
+    """This worker's end of the bus; the other workers' links connect here."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(bus_path(bus_dir, index))
+    sock.listen(64)
+    return sock
+
+def prefork(count: int, run: Callable):
+    """Fork count workers, each calling run(index, bus_dir), and wait for them."""
+    bus_dir = tempfile.mkdtemp(prefix='chat-bus-')
+    pids = []
+    for index in range(count):
+        sys.stdout.flush()      # or the children print it again
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run(index, bus_dir)
+            except KeyboardInterrupt:
+                pass
+            except Exception:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        pids.append(pid)
+    print(f"Started {count} workers: {' '.join(map(str, pids))}")
+    try:
+        for pid in pids:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        print("Shutting down workers...")
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+    finally:
+        shutil.rmtree(bus_dir, ignore_errors=True)